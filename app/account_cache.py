@@ -0,0 +1,180 @@
+import asyncio
+import collections
+import logging
+import time
+import uuid
+from typing import Dict, Iterable
+
+import asyncpg
+
+from app import crud, replicas
+from app.cache import TTLCache
+from app.config import settings
+from app.database import db
+from app.schemas import ExtendedAccountOut
+
+logger = logging.getLogger(__name__)
+
+# wallet_amount_changed trigger sends account_id to the channel on commit
+CHANNEL = "account_changed"
+
+
+class AccountCache:
+    """
+    Per-worker read-through cache of accounts with wallets. Every worker
+    listens to CHANNEL and drops the account as soon as a transaction changing
+    its wallet is committed. Nothing is cached while the listener connection
+    is down, because invalidations would be missed. The worker which commits
+    a change drops the accounts of its wallets itself before responding, so
+    its client doesn't get the old amount while the notification is on its way
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.accounts = TTLCache(maxsize, ttl)
+        self._listener = None
+        # accounts being read from the database and invalidated meanwhile,
+        # such reads may return the old amount and must not be cached
+        self._loads = collections.Counter()
+        self._invalidated = set()
+        # wallets of cached accounts, writers know only wallets they changed;
+        # wallets of evicted accounts are dropped when there are too many
+        self._wallet_accounts: Dict[uuid.UUID, uuid.UUID] = {}
+        # while accounts are being read: number of the last invalidation of
+        # every wallet invalidated by a writer, so reads started before it
+        # are not cached
+        self._wallet_invalidations = 0
+        self._invalidated_wallets: Dict[uuid.UUID, int] = {}
+        # with read replicas: times of the last db_replica_max_lag seconds of
+        # invalidations, oldest first; other accounts haven't changed since
+        # _changed_before
+        self._changed: "collections.OrderedDict[uuid.UUID, float]" = (
+            collections.OrderedDict()
+        )
+        self._changed_before = float("-inf")
+
+    @property
+    def listening(self) -> bool:
+        return self._listener is not None and not self._listener.is_closed()
+
+    async def get(self, account_id: uuid.UUID) -> ExtendedAccountOut:
+        # entries of other workers may miss a write of the client until its
+        # notification comes
+        if not self.listening or replicas.in_session():
+            return await crud.get_account_with_wallet(account_id)
+        account = self.accounts.get(account_id)
+        if account is not None:
+            return account
+
+        self._loads[account_id] += 1
+        loaded_after = self._wallet_invalidations
+        try:
+            account = await self._load(account_id)
+            wallet_invalidated = self._invalidated_wallets.get(account.wallet_id, 0)
+            if (
+                self.listening
+                and account_id not in self._invalidated
+                and wallet_invalidated <= loaded_after
+            ):
+                self._set(account)
+            return account
+        finally:
+            self._loads[account_id] -= 1
+            if not self._loads[account_id]:
+                del self._loads[account_id]
+                self._invalidated.discard(account_id)
+            if not self._loads:
+                self._invalidated_wallets.clear()
+
+    def _set(self, account: ExtendedAccountOut):
+        self.accounts.set(account.account_id, account)
+        self._wallet_accounts[account.wallet_id] = account.account_id
+        if len(self._wallet_accounts) > 2 * self.accounts.maxsize:
+            self._wallet_accounts = {
+                cached.wallet_id: cached.account_id for cached in self.accounts.values()
+            }
+
+    async def _load(self, account_id: uuid.UUID) -> ExtendedAccountOut:
+        database = replicas.database()
+        changed_at = self._changed.get(account_id, self._changed_before)
+        if replicas.replica_set.caught_up_at(database) < changed_at:
+            # the replica may not have the change which invalidated the
+            # account yet, the entry would be stale until it expires
+            database = db
+        with replicas.reading_from(database):
+            return await crud.get_account_with_wallet(account_id)
+
+    def _record_change(self, account_id: uuid.UUID):
+        now = time.monotonic()
+        self._changed[account_id] = now
+        self._changed.move_to_end(account_id)
+        # replicas which reads go to have older changes
+        expired = now - settings.db_replica_max_lag
+        while True:
+            oldest, changed_at = next(iter(self._changed.items()))
+            if changed_at >= expired:
+                break
+            del self._changed[oldest]
+            self._changed_before = changed_at
+
+    def invalidate(self, account_id: uuid.UUID):
+        self.accounts.pop(account_id)
+        if account_id in self._loads:
+            self._invalidated.add(account_id)
+        if replicas.replica_set.replicas:
+            self._record_change(account_id)
+
+    def invalidate_wallets(self, wallet_ids: Iterable[uuid.UUID]):
+        """Drop accounts of wallets changed by a transaction just committed"""
+        for wallet_id in wallet_ids:
+            account_id = self._wallet_accounts.pop(wallet_id, None)
+            if account_id is not None:
+                self.invalidate(account_id)
+            if self._loads:
+                self._wallet_invalidations += 1
+                self._invalidated_wallets[wallet_id] = self._wallet_invalidations
+        if len(self._invalidated_wallets) > self.accounts.maxsize:
+            # reads never stop: none of the running ones is cached instead
+            self._invalidated.update(self._loads)
+            self._invalidated_wallets.clear()
+
+    def invalidate_all(self):
+        self.accounts.clear()
+        self._wallet_accounts.clear()
+        self._invalidated.update(self._loads)
+        self._invalidated_wallets.clear()
+        self._changed.clear()
+        self._changed_before = time.monotonic()
+
+    def _on_notification(self, connection, pid, channel, payload):
+        self.invalidate(uuid.UUID(payload))
+
+    async def listen(self, dsn: str):
+        """Keep LISTEN connection to the database, reconnect when it is lost"""
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(dsn)
+                closed = asyncio.Event()
+                connection.add_termination_listener(lambda _: closed.set())
+                await connection.add_listener(CHANNEL, self._on_notification)
+                # changes committed while not listening
+                self.invalidate_all()
+                self._listener = connection
+                await closed.wait()
+                logger.warning("account cache listener connection is lost")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                self._listener = None
+                self.invalidate_all()
+                if connection is not None:
+                    connection.terminate()
+            await asyncio.sleep(settings.account_cache_reconnect_delay)
+
+    def stats(self) -> dict:
+        return dict(self.accounts.stats(), listening=self.listening)
+
+
+account_cache = AccountCache(settings.account_cache_size, settings.account_cache_ttl)
@@ -0,0 +1,177 @@
+"""
+Admission control of every worker. Reads (GET requests) and writes (the
+rest) have their own budgets, so a storm of transfers doesn't take the
+slots of balance lookups: a budget runs up to its limit of requests at once,
+up to settings.admission_queue_size more wait for a slot, the rest get 503.
+
+Waiting is bounded as in CoDel: while the queue of a budget hasn't been
+empty for settings.admission_interval, the worker can't keep up and queued
+requests wait settings.admission_target seconds at most (queue_timeout
+otherwise). The limit of writes adapts to the connection pool: it is halved
+(down to admission_min_limit) after every interval in which no connection
+was acquired faster than the target, and grows by one after an interval
+without such standing queue of the pool, so writes stop piling up on
+connections which reads need too
+"""
+import asyncio
+import collections
+import math
+import time
+from typing import Callable, Deque, Optional
+
+from fastapi.responses import JSONResponse
+from prometheus_client import Counter
+from starlette import status
+
+from app.config import settings
+from app.database import db
+
+READ_METHODS = frozenset(("GET", "HEAD"))
+
+rejected_requests = Counter(
+    "admission_rejected_requests_total",
+    "Requests refused by admission control by budget and reason",
+    ["budget", "reason"],
+)
+
+
+class Overloaded(Exception):
+    def __init__(self, reason: str):
+        self.reason = reason
+
+
+class Budget:
+    """Requests running at once with a bounded queue of the next ones"""
+
+    def __init__(
+        self,
+        name: str,
+        limit: int,
+        min_acquire_time: Callable[[], Optional[float]] = None,
+    ):
+        self.name = name
+        self.max_limit = self.limit = limit
+        # makes the limit adaptive, see Database.take_min_acquire_time
+        self.min_acquire_time = min_acquire_time
+        self.running = 0
+        self.waiters: Deque[asyncio.Future] = collections.deque()
+        # when the queue got requests after it was empty last time
+        self._queued_since: Optional[float] = None
+        self._adapted_at = time.monotonic()
+        self.rejected = collections.Counter()
+
+    def _adapt(self, now: float):
+        self._adapted_at = now
+        min_acquire_time = self.min_acquire_time()
+        target = settings.admission_target
+        if min_acquire_time is not None and min_acquire_time > target:
+            self.limit = max(settings.admission_min_limit, self.limit // 2)
+        elif self.limit < self.max_limit:
+            self.limit += 1
+            self._wake()
+
+    def _reject(self, reason: str):
+        self.rejected[reason] += 1
+        rejected_requests.labels(self.name, reason).inc()
+        raise Overloaded(reason)
+
+    def _expire(self, waiter: asyncio.Future):
+        if not waiter.done():
+            self.waiters.remove(waiter)
+            if not self.waiters:
+                self._queued_since = None
+            waiter.set_exception(Overloaded("timeout"))
+
+    def _wake(self):
+        while self.waiters and self.running < self.limit:
+            self.running += 1
+            self.waiters.popleft().set_result(None)
+        if not self.waiters:
+            self._queued_since = None
+
+    async def acquire(self):
+        """Take a slot, raise Overloaded if none is free in time"""
+        now = time.monotonic()
+        interval = settings.admission_interval
+        if self.min_acquire_time is not None and now - self._adapted_at >= interval:
+            self._adapt(now)
+        if self.running < self.limit and not self.waiters:
+            self.running += 1
+            return
+        if len(self.waiters) >= settings.admission_queue_size:
+            self._reject("queue_full")
+
+        timeout = settings.admission_queue_timeout
+        if self._queued_since is None:
+            self._queued_since = now
+        elif now - self._queued_since >= interval:
+            timeout = settings.admission_target
+        loop = asyncio.get_event_loop()
+        waiter = loop.create_future()
+        self.waiters.append(waiter)
+        timer = loop.call_later(timeout, self._expire, waiter)
+        try:
+            await waiter
+        except Overloaded as e:
+            self._reject(e.reason)
+        except asyncio.CancelledError:
+            # the client is gone while waiting, the slot may be given already
+            if waiter.done() and not waiter.cancelled() and not waiter.exception():
+                self.release()
+            elif waiter in self.waiters:
+                self.waiters.remove(waiter)
+            raise
+        finally:
+            timer.cancel()
+
+    def release(self):
+        self.running -= 1
+        self._wake()
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "running": self.running,
+            "queued": len(self.waiters),
+            "rejected": dict(self.rejected),
+        }
+
+
+class AdmissionMiddleware:
+    """Run requests in slots of their budgets, answer 503 if they are overloaded"""
+
+    def __init__(self, app, read_budget: Budget = None, write_budget: Budget = None):
+        self.app = app
+        self.read_budget = read_budget or reads
+        self.write_budget = write_budget or writes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.admission_control:
+            await self.app(scope, receive, send)
+            return
+        if scope["method"] in READ_METHODS:
+            budget = self.read_budget
+        else:
+            budget = self.write_budget
+        try:
+            await budget.acquire()
+        except Overloaded:
+            response = JSONResponse(
+                {"detail": "Server is overloaded, try again later"},
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={
+                    "Retry-After": str(math.ceil(settings.admission_queue_timeout))
+                },
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            budget.release()
+
+
+reads = Budget("reads", settings.admission_read_limit)
+writes = Budget(
+    "writes", settings.admission_write_limit, min_acquire_time=db.take_min_acquire_time
+)
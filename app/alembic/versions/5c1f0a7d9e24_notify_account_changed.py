@@ -0,0 +1,41 @@
+"""notify account_changed channel when wallet amount changes
+
+Revision ID: 5c1f0a7d9e24
+Revises: 109668d0372d
+Create Date: 2026-10-18 14:41:08.512377
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1f0a7d9e24'
+down_revision = '109668d0372d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # notifications are delivered on commit only (and once per account in a
+    # transaction), so listeners drop cached accounts right after the change
+    # becomes visible
+    op.execute("""
+    CREATE FUNCTION notify_account_changed() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('account_changed', NEW.account_id::text);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """)
+    op.execute("""
+    CREATE TRIGGER wallet_amount_changed
+    AFTER UPDATE OF amount ON wallet
+    FOR EACH ROW WHEN (OLD.amount IS DISTINCT FROM NEW.amount)
+    EXECUTE FUNCTION notify_account_changed();
+    """)
+
+
+def downgrade():
+    op.execute("DROP TRIGGER wallet_amount_changed ON wallet;")
+    op.execute("DROP FUNCTION notify_account_changed();")
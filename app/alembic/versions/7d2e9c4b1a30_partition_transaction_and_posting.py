@@ -0,0 +1,162 @@
+"""partition transaction and posting by month
+
+Revision ID: 7d2e9c4b1a30
+Revises: e3b8d5a1f6c2
+Create Date: 2026-10-18 17:05:12.481920
+
+"""
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d2e9c4b1a30'
+down_revision = 'e3b8d5a1f6c2'
+branch_labels = None
+depends_on = None
+
+
+TABLES = ('transaction', 'posting')
+BACKFILL_BATCH_SIZE = 10000
+# monthly partitions created after the legacy one, later ones are created by
+# `python -m app.cli partitions create` and the app itself
+MONTHS_AHEAD = 3
+
+
+def _add_months(start, months):
+    month = start.month - 1 + months
+    return start.replace(year=start.year + month // 12, month=month % 12 + 1)
+
+
+def _backfill_posting_created_at(bind):
+    # small batches in their own transactions: rows are locked for a moment
+    # only and replicas are not flooded by one huge update
+    max_id = bind.execute(sa.text('SELECT max(id) FROM posting')).scalar() or 0
+    for start in range(0, max_id + 1, BACKFILL_BATCH_SIZE):
+        bind.execute(
+            sa.text(
+                'UPDATE posting SET created_at = transaction.created_at '
+                'FROM transaction '
+                'WHERE transaction.id = posting.transaction_id '
+                'AND posting.id >= :start AND posting.id < :end '
+                'AND posting.created_at IS NULL'
+            ),
+            start=start,
+            end=start + BACKFILL_BATCH_SIZE,
+        )
+
+
+def upgrade():
+    """
+    Existing tables become the first partition (from MINVALUE to the legacy
+    boundary) of new partitioned tables, no rows are copied. Everything which
+    scans the tables runs before the swap under locks which don't block
+    writes; the swap itself changes catalog only.
+    Foreign key posting -> transaction is dropped: a key referencing
+    partitioned table has to include created_at and can't be added NOT VALID,
+    its validation would block writes to both tables. Postings are always
+    inserted by the statement or function inserting their transaction.
+    """
+    # posting.created_at defaults to now(), which is the start time of the
+    # database transaction, so it equals created_at of the transaction
+    # inserted in the same database transaction
+    now = datetime.datetime.now(datetime.timezone.utc)
+    # a week of margin so that new rows don't reach the boundary before the swap
+    soon = now + datetime.timedelta(days=7)
+    boundary = datetime.datetime(soon.year, soon.month, 1, tzinfo=datetime.timezone.utc)
+    boundary = _add_months(boundary, 1)
+
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        # fail instead of queueing all queries behind a waiting lock
+        op.execute("SET lock_timeout = '10s'")
+
+        op.execute('ALTER TABLE posting ADD COLUMN created_at timestamptz')
+        op.execute('ALTER TABLE posting ALTER COLUMN created_at SET DEFAULT now()')
+        _backfill_posting_created_at(bind)
+        # SET NOT NULL skips the table scan with a validated CHECK
+        op.execute(
+            'ALTER TABLE posting ADD CONSTRAINT posting_created_at_not_null '
+            'CHECK (created_at IS NOT NULL) NOT VALID'
+        )
+        op.execute('ALTER TABLE posting VALIDATE CONSTRAINT posting_created_at_not_null')
+        op.execute('ALTER TABLE posting ALTER COLUMN created_at SET NOT NULL')
+        op.execute('ALTER TABLE posting DROP CONSTRAINT posting_created_at_not_null')
+
+        for table in TABLES:
+            # ATTACH PARTITION skips the table scan with a validated CHECK
+            op.execute(
+                f'ALTER TABLE {table} ADD CONSTRAINT {table}_legacy_range '
+                f"CHECK (created_at < '{boundary.isoformat()}') NOT VALID"
+            )
+            op.execute(f'ALTER TABLE {table} VALIDATE CONSTRAINT {table}_legacy_range')
+            # primary key of partitioned table must include partition key
+            op.execute(
+                f'CREATE UNIQUE INDEX CONCURRENTLY {table}_id_created_at_key '
+                f'ON {table} (id, created_at)'
+            )
+
+        swap = [
+            'ALTER TABLE posting DROP CONSTRAINT posting_transaction_id_fkey;',
+        ]
+        for table in TABLES:
+            swap += [
+                f'ALTER TABLE {table} DROP CONSTRAINT {table}_pkey, '
+                f'ADD CONSTRAINT {table}_legacy_pkey '
+                f'PRIMARY KEY USING INDEX {table}_id_created_at_key;',
+                f'ALTER TABLE {table} RENAME TO {table}_legacy;',
+                f'CREATE TABLE {table} (LIKE {table}_legacy INCLUDING DEFAULTS) '
+                'PARTITION BY RANGE (created_at);',
+                f'ALTER TABLE {table} ATTACH PARTITION {table}_legacy '
+                f"FOR VALUES FROM (MINVALUE) TO ('{boundary.isoformat()}');",
+                # existing unique index of the legacy partition is attached
+                f'ALTER TABLE {table} ADD PRIMARY KEY (id, created_at);',
+                f'ALTER TABLE {table}_legacy DROP CONSTRAINT {table}_legacy_range;',
+                f'ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id;',
+            ]
+            for month in range(MONTHS_AHEAD):
+                start = _add_months(boundary, month)
+                end = _add_months(boundary, month + 1)
+                swap.append(
+                    f'CREATE TABLE {table}_y{start.year}m{start.month:02d} '
+                    f'PARTITION OF {table} FOR VALUES '
+                    f"FROM ('{start.isoformat()}') TO ('{end.isoformat()}');"
+                )
+        # existing foreign keys of the legacy partition are attached
+        swap += [
+            'ALTER TABLE posting ADD CONSTRAINT posting_wallet_id_fkey '
+            'FOREIGN KEY (wallet_id) REFERENCES wallet (id);',
+            'ALTER TABLE posting ADD CONSTRAINT posting_currency_fkey '
+            'FOREIGN KEY (currency) REFERENCES currency (code);',
+        ]
+        op.execute('BEGIN;\n' + '\n'.join(swap) + '\nCOMMIT;')
+
+        op.execute('CREATE SCHEMA IF NOT EXISTS archive')
+        op.execute('RESET lock_timeout')
+
+
+def downgrade():
+    # not online: rows are copied back into plain tables
+    for table in TABLES:
+        op.execute(f'ALTER TABLE {table} RENAME TO {table}_partitioned')
+        op.execute(
+            f'CREATE TABLE {table} (LIKE {table}_partitioned INCLUDING DEFAULTS)'
+        )
+        op.execute(f'INSERT INTO {table} SELECT * FROM {table}_partitioned')
+        op.execute(f'ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id')
+        op.execute(f'DROP TABLE {table}_partitioned')
+        op.execute(f'ALTER TABLE {table} ADD PRIMARY KEY (id)')
+    op.execute('ALTER TABLE posting DROP COLUMN created_at')
+    op.create_foreign_key(
+        'posting_transaction_id_fkey', 'posting', 'transaction',
+        ['transaction_id'], ['id'],
+    )
+    op.create_foreign_key(
+        'posting_wallet_id_fkey', 'posting', 'wallet', ['wallet_id'], ['id']
+    )
+    op.create_foreign_key(
+        'posting_currency_fkey', 'posting', 'currency', ['currency'], ['code']
+    )
+    op.execute('DROP SCHEMA IF EXISTS archive')
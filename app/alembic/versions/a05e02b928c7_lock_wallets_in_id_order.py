@@ -0,0 +1,87 @@
+"""lock wallets in id order in transfer_money
+
+Revision ID: a05e02b928c7
+Revises: abc23ccf34c3
+Create Date: 2026-10-18 11:03:17.224519
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a05e02b928c7'
+down_revision = 'abc23ccf34c3'
+branch_labels = None
+depends_on = None
+
+
+TRANSFER_MONEY = """
+CREATE OR REPLACE FUNCTION transfer_money(
+    p_from_wallet_id uuid,
+    p_from_currency text,
+    p_to_wallet_id uuid,
+    p_to_currency text,
+    p_amount numeric,
+    p_max_amount numeric,
+    p_transaction_type text,
+    OUT status text,
+    OUT from_amount numeric,
+    OUT to_amount numeric
+) AS $$
+DECLARE
+    v_transaction_id integer;
+BEGIN
+    {lock_wallets}
+    SELECT amount INTO from_amount FROM wallet
+    WHERE id = p_from_wallet_id AND currency = p_from_currency FOR UPDATE;
+    IF NOT FOUND THEN
+        status := 'from_wallet_not_found';
+        RETURN;
+    END IF;
+    IF from_amount - p_amount < 0 THEN
+        status := 'not_enough_amount';
+        RETURN;
+    END IF;
+
+    SELECT amount INTO to_amount FROM wallet
+    WHERE id = p_to_wallet_id AND currency = p_to_currency FOR UPDATE;
+    IF NOT FOUND THEN
+        status := 'to_wallet_not_found';
+        RETURN;
+    END IF;
+    IF to_amount + p_amount > p_max_amount THEN
+        -- to_amount keeps the current amount for the error message
+        status := 'max_amount_exceeded';
+        RETURN;
+    END IF;
+
+    UPDATE wallet SET amount = amount - p_amount
+    WHERE id = p_from_wallet_id RETURNING amount INTO from_amount;
+    UPDATE wallet SET amount = amount + p_amount
+    WHERE id = p_to_wallet_id RETURNING amount INTO to_amount;
+
+    INSERT INTO transaction(type) VALUES (p_transaction_type)
+    RETURNING id INTO v_transaction_id;
+    INSERT INTO posting(transaction_id, wallet_id, amount, currency)
+    VALUES (v_transaction_id, p_from_wallet_id, -p_amount, p_from_currency),
+           (v_transaction_id, p_to_wallet_id, p_amount, p_to_currency);
+
+    status := 'ok';
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# lock both wallets in id order so that concurrent A->B and B->A transfers
+# wait for each other instead of deadlocking
+LOCK_WALLETS = """PERFORM 1 FROM wallet
+    WHERE id IN (p_from_wallet_id, p_to_wallet_id) ORDER BY id FOR UPDATE;
+"""
+
+
+def upgrade():
+    op.execute(TRANSFER_MONEY.replace("{lock_wallets}", LOCK_WALLETS))
+
+
+def downgrade():
+    op.execute(TRANSFER_MONEY.replace("{lock_wallets}", ""))
@@ -0,0 +1,334 @@
+"""use time-ordered bigint ledger ids
+
+Revision ID: a7c4e2f19b03
+Revises: f2c6b8e04d19
+Create Date: 2026-10-18 23:36:20.517843
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c4e2f19b03'
+down_revision = 'f2c6b8e04d19'
+branch_labels = None
+depends_on = None
+
+
+BACKFILL_BATCH_SIZE = 10000
+SWAP_ATTEMPTS = 10
+
+# transaction.id and posting.id: milliseconds since 2026-01-01 (41 bits,
+# until 2095) shifted by 12 bits of a shared sequence (4096 ids a
+# millisecond). Ids fit 53 bits, so they stay exact as JSON numbers, and
+# grow with time, so the ids of a time range are one range of the index.
+# They are made by the database clock: ids made before a moment are below
+# ledger_id_floor() of it, which reconciliation uses as its horizon
+LEDGER_ID = [
+    'CREATE SEQUENCE IF NOT EXISTS ledger_id_seq;',
+    """
+    CREATE OR REPLACE FUNCTION ledger_id_floor(p_at timestamptz) RETURNS bigint AS $$
+        SELECT floor(
+            extract(epoch FROM p_at - '2026-01-01T00:00:00+00:00') * 1000
+        )::bigint << 12;
+    $$ LANGUAGE sql IMMUTABLE;
+    """,
+    """
+    CREATE OR REPLACE FUNCTION next_ledger_id() RETURNS bigint AS $$
+        SELECT ledger_id_floor(clock_timestamp()) | (nextval('ledger_id_seq') & 4095);
+    $$ LANGUAGE sql;
+    """,
+]
+
+# new columns of each table: wide column -> column it replaces
+COLUMNS = {
+    'transaction': {'new_id': 'id'},
+    'posting': {'new_id': 'id', 'new_transaction_id': 'transaction_id'},
+}
+# posting indexes of b4f81e6a2d57 on the replaced columns
+INDEXES = {
+    'ix_posting_wallet_id_transaction_id': (
+        '(wallet_id, new_transaction_id, new_id) '
+        'INCLUDE (amount, currency, created_at)'
+    ),
+    'ix_posting_transaction_id': '(new_transaction_id)',
+}
+
+# rows inserted during the migration get the wide columns from the old ones
+COPY_IDS = """
+CREATE OR REPLACE FUNCTION copy_{table}_ids() RETURNS trigger AS $$
+BEGIN
+    {assignments}
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# transfer_money of d5e1a7c93b48 with bigint transaction id
+TRANSFER_MONEY = """
+CREATE OR REPLACE FUNCTION transfer_money(
+    p_from_wallet_id uuid,
+    p_from_currency text,
+    p_to_wallet_id uuid,
+    p_to_currency text,
+    p_amount numeric,
+    p_max_amount numeric,
+    p_transaction_type text,
+    OUT status text,
+    OUT from_amount numeric,
+    OUT to_amount numeric
+) AS $$
+DECLARE
+    v_transaction_id bigint;
+    v_from_shards integer;
+    v_to_shards integer;
+BEGIN
+    SELECT shards INTO v_from_shards FROM wallet WHERE id = p_from_wallet_id;
+    SELECT shards INTO v_to_shards FROM wallet WHERE id = p_to_wallet_id;
+    IF v_to_shards > 0 AND v_from_shards = 0 THEN
+        -- credit of a sharded wallet doesn't lock its wallet row
+        PERFORM 1 FROM wallet WHERE id = p_from_wallet_id FOR NO KEY UPDATE;
+    ELSE
+        -- lock both wallets in id order so that concurrent A->B and B->A
+        -- transfers wait for each other instead of deadlocking
+        PERFORM 1 FROM wallet
+        WHERE id IN (p_from_wallet_id, p_to_wallet_id) ORDER BY id
+        FOR NO KEY UPDATE;
+    END IF;
+
+    SELECT shards, amount INTO v_from_shards, from_amount
+    FROM lock_wallet_amount(p_from_wallet_id, p_from_currency);
+    IF v_from_shards IS NULL THEN
+        status := 'from_wallet_not_found';
+        RETURN;
+    END IF;
+    IF from_amount - p_amount < 0 THEN
+        status := 'not_enough_amount';
+        RETURN;
+    END IF;
+
+    -- the debit is checked but not applied yet, so nothing is changed
+    -- when the credit fails
+    SELECT credit.status, credit.amount INTO status, to_amount
+    FROM credit_wallet(p_to_wallet_id, p_to_currency, p_amount, p_max_amount)
+    AS credit;
+    IF status = 'not_found' THEN
+        status := 'to_wallet_not_found';
+        RETURN;
+    END IF;
+    IF status <> 'ok' THEN
+        RETURN;
+    END IF;
+    from_amount := debit_locked_wallet(p_from_wallet_id, v_from_shards, p_amount);
+    IF p_from_wallet_id = p_to_wallet_id THEN
+        to_amount := from_amount;
+    END IF;
+
+    INSERT INTO transaction(type) VALUES (p_transaction_type)
+    RETURNING id INTO v_transaction_id;
+    INSERT INTO posting(transaction_id, wallet_id, amount, currency)
+    VALUES (v_transaction_id, p_from_wallet_id, -p_amount, p_from_currency),
+           (v_transaction_id, p_to_wallet_id, p_amount, p_to_currency);
+
+    status := 'ok';
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# transfer_money of d5e1a7c93b48
+PREVIOUS_TRANSFER_MONEY = TRANSFER_MONEY.replace(
+    'v_transaction_id bigint;', 'v_transaction_id integer;'
+)
+
+
+def _partitions(bind, table):
+    return [
+        row[0]
+        for row in bind.execute(
+            sa.text(
+                'SELECT inhrelid::regclass::text FROM pg_inherits '
+                'WHERE inhparent = CAST(:table AS regclass)'
+            ),
+            table=table,
+        )
+    ]
+
+
+def _archived(bind, table):
+    return [
+        row[0]
+        for row in bind.execute(
+            sa.text(
+                "SELECT format('%I.%I', schemaname, tablename) FROM pg_tables "
+                "WHERE schemaname = 'archive' AND tablename LIKE :pattern"
+            ),
+            pattern=f'{table}\\_%',
+        )
+    ]
+
+
+def _backfill(bind, table, columns):
+    # small batches in their own transactions, see 7d2e9c4b1a30
+    assignments = ', '.join(f'{new} = {old}' for new, old in columns.items())
+    max_id = bind.execute(sa.text(f'SELECT max(id) FROM {table}')).scalar() or 0
+    for start in range(0, max_id + 1, BACKFILL_BATCH_SIZE):
+        bind.execute(
+            sa.text(
+                f'UPDATE {table} SET {assignments} '
+                'WHERE id >= :start AND id < :end AND new_id IS NULL'
+            ),
+            start=start,
+            end=start + BACKFILL_BATCH_SIZE,
+        )
+
+
+def upgrade():
+    """
+    int -> bigint rewrites the tables under a lock blocking all queries, so
+    wide columns are added next to the old ones instead: a trigger fills
+    them on insert, existing rows are backfilled by batches, NOT NULL is
+    proved by validated CHECKs and indexes are built CONCURRENTLY. The swap
+    changes catalog only: old columns (with their sequences and indexes) are
+    dropped, wide ones renamed and their default becomes next_ledger_id().
+    Migrated rows keep their ids, new ids are above all of them, so keyset
+    pagination and reconciliation checkpoints of old ids stay valid.
+    Archived partitions are converted in place, nothing writes to them
+    """
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        # fail instead of queueing all queries behind a waiting lock
+        op.execute("SET lock_timeout = '10s'")
+        for statement in LEDGER_ID:
+            op.execute(statement)
+        # bigint variable works with both old and new ids
+        op.execute(TRANSFER_MONEY)
+
+        for table, columns in COLUMNS.items():
+            for new in columns:
+                op.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {new} bigint')
+            assignments = '\n    '.join(
+                f'NEW.{new} := NEW.{old};' for new, old in columns.items()
+            )
+            op.execute(COPY_IDS.format(table=table, assignments=assignments))
+            op.execute(f'DROP TRIGGER IF EXISTS {table}_copy_ids ON {table}')
+            op.execute(
+                f'CREATE TRIGGER {table}_copy_ids BEFORE INSERT ON {table} '
+                f'FOR EACH ROW EXECUTE FUNCTION copy_{table}_ids()'
+            )
+            _backfill(bind, table, columns)
+
+            partitions = _partitions(bind, table)
+            for partition in partitions:
+                for new in columns:
+                    # SET NOT NULL skips the table scan with a validated CHECK
+                    op.execute(
+                        f'ALTER TABLE {partition} '
+                        f'ADD CONSTRAINT {partition}_{new}_not_null '
+                        f'CHECK ({new} IS NOT NULL) NOT VALID'
+                    )
+                    op.execute(
+                        f'ALTER TABLE {partition} '
+                        f'VALIDATE CONSTRAINT {partition}_{new}_not_null'
+                    )
+                op.execute(
+                    f'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS '
+                    f'{partition}_new_id_created_at_key '
+                    f'ON {partition} (new_id, created_at)'
+                )
+            for new in columns:
+                op.execute(f'ALTER TABLE {table} ALTER COLUMN {new} SET NOT NULL')
+                for partition in partitions:
+                    op.execute(
+                        f'ALTER TABLE {partition} '
+                        f'DROP CONSTRAINT {partition}_{new}_not_null'
+                    )
+
+        # see b4f81e6a2d57, replaced indexes are dropped with their columns
+        partitions = _partitions(bind, 'posting')
+        for name, columns in INDEXES.items():
+            op.execute(
+                f'CREATE INDEX IF NOT EXISTS {name}_new ON ONLY posting {columns}'
+            )
+            for partition in partitions:
+                partition_index = f'{partition}_{name[len("ix_posting_"):]}_new_idx'
+                op.execute(
+                    f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {partition_index} '
+                    f'ON {partition} {columns}'
+                )
+                op.execute(f'ALTER INDEX {name}_new ATTACH PARTITION {partition_index}')
+
+        for table, columns in COLUMNS.items():
+            for archived in _archived(bind, table):
+                op.execute(
+                    f'ALTER TABLE {archived} ALTER COLUMN id DROP DEFAULT, '
+                    + ', '.join(
+                        f'ALTER COLUMN {old} TYPE bigint' for old in columns.values()
+                    )
+                )
+
+        # both tables are locked at once in the order writers lock them
+        # (transaction, then posting), so writers wait instead of deadlocking
+        swap = ['LOCK TABLE transaction, posting IN ACCESS EXCLUSIVE MODE;']
+        for table, columns in COLUMNS.items():
+            swap += [
+                f'DROP TRIGGER {table}_copy_ids ON {table};',
+                f'ALTER TABLE {table} DROP CONSTRAINT {table}_pkey;',
+            ]
+            # the primary key of the parent attaches the ones of partitions
+            swap += [
+                f'ALTER TABLE {partition} ADD CONSTRAINT {partition}_pkey '
+                f'PRIMARY KEY USING INDEX {partition}_new_id_created_at_key;'
+                for partition in _partitions(bind, table)
+            ]
+            swap.append(f'ALTER TABLE {table} ADD PRIMARY KEY (new_id, created_at);')
+            for new, old in columns.items():
+                swap += [
+                    f'ALTER TABLE {table} DROP COLUMN {old};',
+                    f'ALTER TABLE {table} RENAME COLUMN {new} TO {old};',
+                ]
+            swap.append(
+                f'ALTER TABLE {table} ALTER COLUMN id SET DEFAULT next_ledger_id();'
+            )
+        swap += [f'ALTER INDEX {name}_new RENAME TO {name};' for name in INDEXES]
+        op.execute('BEGIN;\n' + '\n'.join(swap) + '\nCOMMIT;')
+
+        for table in COLUMNS:
+            op.execute(f'DROP FUNCTION copy_{table}_ids()')
+        for partition in partitions:
+            for name in INDEXES:
+                suffix = name[len('ix_posting_'):]
+                op.execute(
+                    f'ALTER INDEX IF EXISTS {partition}_{suffix}_new_idx '
+                    f'RENAME TO {partition}_{suffix}_idx'
+                )
+        op.execute('RESET lock_timeout')
+
+
+def downgrade():
+    # not online; fails once new ids are written: they don't fit integer
+    for table, columns in COLUMNS.items():
+        op.execute(
+            f'ALTER TABLE {table} ALTER COLUMN id DROP DEFAULT, '
+            + ', '.join(f'ALTER COLUMN {old} TYPE integer' for old in columns.values())
+        )
+        op.execute(f'CREATE SEQUENCE {table}_id_seq OWNED BY {table}.id')
+        op.execute(
+            f"SELECT setval('{table}_id_seq', coalesce(max(id), 0) + 1, false) "
+            f'FROM {table}'
+        )
+        op.execute(
+            f"ALTER TABLE {table} ALTER COLUMN id SET DEFAULT nextval('{table}_id_seq')"
+        )
+    for table, columns in COLUMNS.items():
+        for archived in _archived(op.get_bind(), table):
+            op.execute(
+                f'ALTER TABLE {archived} '
+                + ', '.join(
+                    f'ALTER COLUMN {old} TYPE integer' for old in columns.values()
+                )
+            )
+    op.execute(PREVIOUS_TRANSFER_MONEY)
+    op.execute('DROP FUNCTION next_ledger_id()')
+    op.execute('DROP FUNCTION ledger_id_floor(timestamptz)')
+    op.execute('DROP SEQUENCE ledger_id_seq')
@@ -0,0 +1,114 @@
+"""add outbox
+
+Revision ID: b3e9d4f70a62
+Revises: a7c4e2f19b03
+Create Date: 2026-10-19 00:48:12.093516
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3e9d4f70a62'
+down_revision = 'a7c4e2f19b03'
+branch_labels = None
+depends_on = None
+
+
+# events are written by statement triggers in the transaction which writes
+# the rows, once per statement: transfer_money, batches, replenish CTE and
+# COPY of bulk onboarding all get their events without extra round trips.
+# Ids come from next_ledger_id() after the rows are inserted, so the
+# transaction already has its xid (see app.horizon). Amounts are strings, as
+# JSON numbers lose precision of numeric(19, 2) in most parsers
+OUTBOX_TRANSACTIONS = """
+CREATE FUNCTION outbox_transactions() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO outbox(type, payload)
+    SELECT transaction.type, jsonb_build_object(
+        'transaction_id', transaction.id,
+        'created_at', transaction.created_at,
+        'postings', jsonb_agg(
+            jsonb_build_object(
+                'wallet_id', new_posting.wallet_id,
+                'amount', new_posting.amount::text,
+                'currency', new_posting.currency
+            ) ORDER BY new_posting.id
+        )
+    )
+    FROM new_posting JOIN transaction
+    ON transaction.id = new_posting.transaction_id
+    AND transaction.created_at = new_posting.created_at
+    GROUP BY transaction.id, transaction.created_at, transaction.type
+    ORDER BY transaction.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+OUTBOX_WALLETS = """
+CREATE FUNCTION outbox_wallets() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO outbox(type, payload)
+    SELECT 'ACCOUNT_CREATED', jsonb_build_object(
+        'account_id', account.id,
+        'name', account.name,
+        'wallet_id', new_wallet.id,
+        'currency', new_wallet.currency
+    )
+    FROM new_wallet JOIN account ON account.id = new_wallet.account_id
+    ORDER BY new_wallet.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+def upgrade():
+    op.create_table(
+        'outbox',
+        sa.Column(
+            'id',
+            sa.BigInteger(),
+            server_default=sa.text('next_ledger_id()'),
+            nullable=False,
+        ),
+        sa.Column('type', sa.String(), nullable=False),
+        sa.Column('payload', sa.dialects.postgresql.JSONB(), nullable=False),
+        sa.Column(
+            'created_at',
+            sa.DateTime(timezone=True),
+            server_default=sa.text('now()'),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_table(
+        'outbox_relay',
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('delivered_id', sa.BigInteger(), server_default='0', nullable=False),
+        sa.Column('delivered_at', sa.DateTime(timezone=True), nullable=True),
+        sa.PrimaryKeyConstraint('name'),
+    )
+    op.execute(OUTBOX_TRANSACTIONS)
+    op.execute(OUTBOX_WALLETS)
+    op.execute("""
+    CREATE TRIGGER posting_outbox AFTER INSERT ON posting
+    REFERENCING NEW TABLE AS new_posting
+    FOR EACH STATEMENT EXECUTE FUNCTION outbox_transactions();
+    """)
+    op.execute("""
+    CREATE TRIGGER wallet_outbox AFTER INSERT ON wallet
+    REFERENCING NEW TABLE AS new_wallet
+    FOR EACH STATEMENT EXECUTE FUNCTION outbox_wallets();
+    """)
+
+
+def downgrade():
+    op.execute('DROP TRIGGER wallet_outbox ON wallet;')
+    op.execute('DROP TRIGGER posting_outbox ON posting;')
+    op.execute('DROP FUNCTION outbox_wallets();')
+    op.execute('DROP FUNCTION outbox_transactions();')
+    op.drop_table('outbox_relay')
+    op.drop_table('outbox')
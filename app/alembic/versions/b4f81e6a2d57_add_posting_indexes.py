@@ -0,0 +1,60 @@
+"""add posting indexes
+
+Revision ID: b4f81e6a2d57
+Revises: 7d2e9c4b1a30
+Create Date: 2026-10-18 18:41:03.552017
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b4f81e6a2d57'
+down_revision = '7d2e9c4b1a30'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = {
+    # history of a wallet in keyset order, amount, currency and created_at
+    # (to join transaction partition) are read from the index only
+    'ix_posting_wallet_id_transaction_id': (
+        '(wallet_id, transaction_id, id) INCLUDE (amount, currency, created_at)'
+    ),
+    'ix_posting_transaction_id': '(transaction_id)',
+}
+
+
+def upgrade():
+    """
+    CREATE INDEX on a partitioned table can't be CONCURRENTLY: the index is
+    created on the parent only (invalid until all partitions have theirs),
+    partition indexes are built CONCURRENTLY and attached. Partitions created
+    later get the index on ATTACH PARTITION
+    """
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        partitions = [
+            row[0]
+            for row in bind.execute(
+                sa.text(
+                    'SELECT inhrelid::regclass::text FROM pg_inherits '
+                    "WHERE inhparent = 'posting'::regclass"
+                )
+            )
+        ]
+        for name, columns in INDEXES.items():
+            op.execute(f'CREATE INDEX IF NOT EXISTS {name} ON ONLY posting {columns}')
+            for partition in partitions:
+                partition_index = f'{partition}_{name[len("ix_posting_"):]}_idx'
+                op.execute(
+                    f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {partition_index} '
+                    f'ON {partition} {columns}'
+                )
+                op.execute(f'ALTER INDEX {name} ATTACH PARTITION {partition_index}')
+
+
+def downgrade():
+    for name in INDEXES:
+        op.execute(f'DROP INDEX {name}')
@@ -0,0 +1,37 @@
+"""add reconciliation tables
+
+Revision ID: c8a3f2d61e09
+Revises: b4f81e6a2d57
+Create Date: 2026-10-18 20:12:36.740215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = 'c8a3f2d61e09'
+down_revision = 'b4f81e6a2d57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('reconciled_balance',
+    sa.Column('wallet_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('amount', sa.Numeric(19, 2), nullable=False),
+    sa.ForeignKeyConstraint(['wallet_id'], ['wallet.id'], ),
+    sa.PrimaryKeyConstraint('wallet_id')
+    )
+    op.create_table('reconciliation_checkpoint',
+    sa.Column('wallet_id_from', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('wallet_id_to', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('posting_id', sa.BigInteger(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('wallet_id_from', 'wallet_id_to')
+    )
+
+
+def downgrade():
+    op.drop_table('reconciliation_checkpoint')
+    op.drop_table('reconciled_balance')
@@ -0,0 +1,339 @@
+"""add wallet shards
+
+Revision ID: d5e1a7c93b48
+Revises: c8a3f2d61e09
+Create Date: 2026-10-18 21:12:40.318265
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5e1a7c93b48'
+down_revision = 'c8a3f2d61e09'
+branch_labels = None
+depends_on = None
+
+
+# wallet rows are locked FOR NO KEY UPDATE: credits of a sharded wallet
+# insert postings without the lock of its wallet row, and the foreign key
+# check of posting.wallet_id (FOR KEY SHARE) must not wait for its debits;
+# amount of a sharded wallet is the sum of its shard rows (wallet.amount is 0)
+LOCK_WALLET_AMOUNT = """
+CREATE FUNCTION lock_wallet_amount(
+    p_wallet_id uuid,
+    p_currency text,
+    OUT shards integer,
+    OUT amount numeric
+) AS $$
+BEGIN
+    SELECT wallet.shards, wallet.amount INTO shards, amount FROM wallet
+    WHERE id = p_wallet_id AND currency = p_currency FOR NO KEY UPDATE;
+    IF shards > 0 THEN
+        -- shard rows are locked after wallet rows, in shard order
+        amount := amount + (
+            SELECT sum(locked.amount) FROM (
+                SELECT wallet_shard.amount FROM wallet_shard
+                WHERE wallet_id = p_wallet_id ORDER BY shard FOR UPDATE
+            ) AS locked
+        );
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# wallet must be locked by lock_wallet_amount and have enough amount;
+# the largest shards are debited first
+DEBIT_LOCKED_WALLET = """
+CREATE FUNCTION debit_locked_wallet(
+    p_wallet_id uuid,
+    p_shards integer,
+    p_amount numeric
+) RETURNS numeric AS $$
+DECLARE
+    v_amount numeric;
+BEGIN
+    IF p_shards = 0 THEN
+        UPDATE wallet SET amount = amount - p_amount
+        WHERE id = p_wallet_id RETURNING amount INTO v_amount;
+        RETURN v_amount;
+    END IF;
+
+    UPDATE wallet_shard SET amount = wallet_shard.amount - debit.amount
+    FROM (
+        SELECT shard, least(
+            amount,
+            greatest(
+                p_amount - (sum(amount) OVER (ORDER BY amount DESC, shard) - amount),
+                0
+            )
+        ) AS amount
+        FROM wallet_shard WHERE wallet_id = p_wallet_id
+    ) AS debit
+    WHERE wallet_shard.wallet_id = p_wallet_id
+    AND wallet_shard.shard = debit.shard AND debit.amount > 0;
+    SELECT sum(amount) INTO v_amount FROM wallet_shard WHERE wallet_id = p_wallet_id;
+    RETURN v_amount;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# credit of a sharded wallet updates (and locks) one shard row only, wallet
+# row is not locked; a shard row can't hold more than its max_amount, so
+# concurrent credits of other shards can't exceed max amount of the wallet
+CREDIT_WALLET = """
+CREATE FUNCTION credit_wallet(
+    p_wallet_id uuid,
+    p_currency text,
+    p_amount numeric,
+    p_max_amount numeric,
+    OUT status text,
+    OUT amount numeric
+) AS $$
+DECLARE
+    v_shards integer;
+    v_shard integer;
+    v_credited boolean;
+BEGIN
+    LOOP
+        SELECT shards INTO v_shards FROM wallet
+        WHERE id = p_wallet_id AND currency = p_currency;
+        IF NOT FOUND THEN
+            status := 'not_found';
+            RETURN;
+        END IF;
+
+        IF v_shards > 0 THEN
+            v_shard := floor(random() * v_shards);
+            UPDATE wallet_shard SET amount = wallet_shard.amount + p_amount
+            WHERE wallet_id = p_wallet_id AND shard = v_shard
+            AND wallet_shard.amount + p_amount <= max_amount;
+            v_credited := FOUND;
+            IF NOT v_credited THEN
+                -- the random shard is full: try the least filled one
+                UPDATE wallet_shard SET amount = wallet_shard.amount + p_amount
+                WHERE wallet_id = p_wallet_id AND shard = (
+                    SELECT shard FROM wallet_shard WHERE wallet_id = p_wallet_id
+                    ORDER BY wallet_shard.amount LIMIT 1
+                )
+                AND wallet_shard.amount + p_amount <= max_amount;
+                v_credited := FOUND;
+            END IF;
+            SELECT sum(wallet_shard.amount) INTO amount FROM wallet_shard
+            WHERE wallet_id = p_wallet_id;
+            IF v_credited THEN
+                status := 'ok';
+                RETURN;
+            END IF;
+            IF amount IS NOT NULL THEN
+                -- amount keeps the current amount for the error message
+                status := 'max_amount_exceeded';
+                RETURN;
+            END IF;
+            -- shards were merged meanwhile
+        ELSE
+            SELECT wallet.amount, shards INTO amount, v_shards FROM wallet
+            WHERE id = p_wallet_id FOR NO KEY UPDATE;
+            IF v_shards = 0 THEN
+                IF amount + p_amount > p_max_amount THEN
+                    status := 'max_amount_exceeded';
+                    RETURN;
+                END IF;
+                UPDATE wallet SET amount = wallet.amount + p_amount
+                WHERE id = p_wallet_id RETURNING wallet.amount INTO amount;
+                status := 'ok';
+                RETURN;
+            END IF;
+            -- the wallet was sharded meanwhile
+        END IF;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+TRANSFER_MONEY = """
+CREATE OR REPLACE FUNCTION transfer_money(
+    p_from_wallet_id uuid,
+    p_from_currency text,
+    p_to_wallet_id uuid,
+    p_to_currency text,
+    p_amount numeric,
+    p_max_amount numeric,
+    p_transaction_type text,
+    OUT status text,
+    OUT from_amount numeric,
+    OUT to_amount numeric
+) AS $$
+DECLARE
+    v_transaction_id integer;
+    v_from_shards integer;
+    v_to_shards integer;
+BEGIN
+    SELECT shards INTO v_from_shards FROM wallet WHERE id = p_from_wallet_id;
+    SELECT shards INTO v_to_shards FROM wallet WHERE id = p_to_wallet_id;
+    IF v_to_shards > 0 AND v_from_shards = 0 THEN
+        -- credit of a sharded wallet doesn't lock its wallet row
+        PERFORM 1 FROM wallet WHERE id = p_from_wallet_id FOR NO KEY UPDATE;
+    ELSE
+        -- lock both wallets in id order so that concurrent A->B and B->A
+        -- transfers wait for each other instead of deadlocking
+        PERFORM 1 FROM wallet
+        WHERE id IN (p_from_wallet_id, p_to_wallet_id) ORDER BY id
+        FOR NO KEY UPDATE;
+    END IF;
+
+    SELECT shards, amount INTO v_from_shards, from_amount
+    FROM lock_wallet_amount(p_from_wallet_id, p_from_currency);
+    IF v_from_shards IS NULL THEN
+        status := 'from_wallet_not_found';
+        RETURN;
+    END IF;
+    IF from_amount - p_amount < 0 THEN
+        status := 'not_enough_amount';
+        RETURN;
+    END IF;
+
+    -- the debit is checked but not applied yet, so nothing is changed
+    -- when the credit fails
+    SELECT credit.status, credit.amount INTO status, to_amount
+    FROM credit_wallet(p_to_wallet_id, p_to_currency, p_amount, p_max_amount)
+    AS credit;
+    IF status = 'not_found' THEN
+        status := 'to_wallet_not_found';
+        RETURN;
+    END IF;
+    IF status <> 'ok' THEN
+        RETURN;
+    END IF;
+    from_amount := debit_locked_wallet(p_from_wallet_id, v_from_shards, p_amount);
+    IF p_from_wallet_id = p_to_wallet_id THEN
+        to_amount := from_amount;
+    END IF;
+
+    INSERT INTO transaction(type) VALUES (p_transaction_type)
+    RETURNING id INTO v_transaction_id;
+    INSERT INTO posting(transaction_id, wallet_id, amount, currency)
+    VALUES (v_transaction_id, p_from_wallet_id, -p_amount, p_from_currency),
+           (v_transaction_id, p_to_wallet_id, p_amount, p_to_currency);
+
+    status := 'ok';
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# transfer_money of a05e02b928c7
+PREVIOUS_TRANSFER_MONEY = """
+CREATE OR REPLACE FUNCTION transfer_money(
+    p_from_wallet_id uuid,
+    p_from_currency text,
+    p_to_wallet_id uuid,
+    p_to_currency text,
+    p_amount numeric,
+    p_max_amount numeric,
+    p_transaction_type text,
+    OUT status text,
+    OUT from_amount numeric,
+    OUT to_amount numeric
+) AS $$
+DECLARE
+    v_transaction_id integer;
+BEGIN
+    PERFORM 1 FROM wallet
+    WHERE id IN (p_from_wallet_id, p_to_wallet_id) ORDER BY id FOR UPDATE;
+
+    SELECT amount INTO from_amount FROM wallet
+    WHERE id = p_from_wallet_id AND currency = p_from_currency FOR UPDATE;
+    IF NOT FOUND THEN
+        status := 'from_wallet_not_found';
+        RETURN;
+    END IF;
+    IF from_amount - p_amount < 0 THEN
+        status := 'not_enough_amount';
+        RETURN;
+    END IF;
+
+    SELECT amount INTO to_amount FROM wallet
+    WHERE id = p_to_wallet_id AND currency = p_to_currency FOR UPDATE;
+    IF NOT FOUND THEN
+        status := 'to_wallet_not_found';
+        RETURN;
+    END IF;
+    IF to_amount + p_amount > p_max_amount THEN
+        -- to_amount keeps the current amount for the error message
+        status := 'max_amount_exceeded';
+        RETURN;
+    END IF;
+
+    UPDATE wallet SET amount = amount - p_amount
+    WHERE id = p_from_wallet_id RETURNING amount INTO from_amount;
+    UPDATE wallet SET amount = amount + p_amount
+    WHERE id = p_to_wallet_id RETURNING amount INTO to_amount;
+
+    INSERT INTO transaction(type) VALUES (p_transaction_type)
+    RETURNING id INTO v_transaction_id;
+    INSERT INTO posting(transaction_id, wallet_id, amount, currency)
+    VALUES (v_transaction_id, p_from_wallet_id, -p_amount, p_from_currency),
+           (v_transaction_id, p_to_wallet_id, p_amount, p_to_currency);
+
+    status := 'ok';
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+def upgrade():
+    # constant default: no table rewrite
+    op.add_column(
+        'wallet',
+        sa.Column('shards', sa.Integer(), server_default='0', nullable=False),
+    )
+    op.create_table(
+        'wallet_shard',
+        sa.Column('wallet_id', sa.dialects.postgresql.UUID(), nullable=False),
+        sa.Column('shard', sa.Integer(), nullable=False),
+        sa.Column('amount', sa.Numeric(precision=19, scale=2), nullable=False),
+        sa.Column('max_amount', sa.Numeric(precision=19, scale=2), nullable=False),
+        sa.CheckConstraint(
+            'amount >= 0 AND amount <= max_amount', name='wallet_shard_amount_check'
+        ),
+        sa.ForeignKeyConstraint(['wallet_id'], ['wallet.id']),
+        sa.PrimaryKeyConstraint('wallet_id', 'shard'),
+    )
+    op.execute("""
+    CREATE FUNCTION notify_wallet_shard_changed() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('account_changed', wallet.account_id::text)
+        FROM wallet WHERE wallet.id = NEW.wallet_id;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """)
+    op.execute("""
+    CREATE TRIGGER wallet_shard_amount_changed
+    AFTER UPDATE OF amount ON wallet_shard
+    FOR EACH ROW WHEN (OLD.amount IS DISTINCT FROM NEW.amount)
+    EXECUTE FUNCTION notify_wallet_shard_changed();
+    """)
+    op.execute(LOCK_WALLET_AMOUNT)
+    op.execute(DEBIT_LOCKED_WALLET)
+    op.execute(CREDIT_WALLET)
+    op.execute(TRANSFER_MONEY)
+
+
+def downgrade():
+    # amounts of sharded wallets are moved back to their wallet rows
+    op.execute("""
+    UPDATE wallet SET amount = wallet.amount + shards.amount
+    FROM (
+        SELECT wallet_id, sum(amount) AS amount FROM wallet_shard GROUP BY wallet_id
+    ) AS shards
+    WHERE wallet.id = shards.wallet_id;
+    """)
+    op.execute(PREVIOUS_TRANSFER_MONEY)
+    op.execute('DROP FUNCTION credit_wallet(uuid, text, numeric, numeric);')
+    op.execute('DROP FUNCTION debit_locked_wallet(uuid, integer, numeric);')
+    op.execute('DROP FUNCTION lock_wallet_amount(uuid, text);')
+    op.drop_table('wallet_shard')
+    op.execute('DROP FUNCTION notify_wallet_shard_changed();')
+    op.drop_column('wallet', 'shards')
@@ -0,0 +1,25 @@
+"""add wallet account_id index
+
+Revision ID: e3b8d5a1f6c2
+Revises: 5c1f0a7d9e24
+Create Date: 2026-10-18 15:22:40.193805
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3b8d5a1f6c2'
+down_revision = '5c1f0a7d9e24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # account JOIN wallet of get_account_with_wallet scanned the whole wallet table
+    op.create_index('ix_wallet_account_id', 'wallet', ['account_id'])
+
+
+def downgrade():
+    op.drop_index('ix_wallet_account_id', table_name='wallet')
@@ -0,0 +1,162 @@
+"""add ledger stats
+
+Revision ID: e7a2c9f35b14
+Revises: b3e9d4f70a62
+Create Date: 2026-10-18 21:14:37.512804
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7a2c9f35b14'
+down_revision = 'b3e9d4f70a62'
+branch_labels = None
+depends_on = None
+
+
+SHARDS = 16
+
+# counters are added by a statement trigger in the transaction which inserts
+# the postings, like outbox events. Every write inserts its postings with one
+# statement, so the counter row is the last lock the transaction takes and
+# can't be a part of a deadlock; the row is picked by xid out of SHARDS rows
+# of the day and currency, so concurrent transactions rarely wait for each
+# other. Transfer volume is the sum of credited amounts
+LEDGER_STATS_POSTINGS = f"""
+CREATE FUNCTION ledger_stats_postings() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO ledger_stats AS stats(
+        day, currency, shard,
+        transfers, transfer_volume, replenishments, replenished
+    )
+    SELECT
+        (new_posting.created_at AT TIME ZONE 'UTC')::date,
+        new_posting.currency,
+        pg_current_xact_id()::text::bigint % {SHARDS},
+        count(DISTINCT new_posting.transaction_id)
+            FILTER (WHERE transaction.type = 'TRANSFER'),
+        coalesce(sum(new_posting.amount) FILTER (
+            WHERE transaction.type = 'TRANSFER' AND new_posting.amount > 0
+        ), 0),
+        count(*) FILTER (WHERE transaction.type = 'REPLENISH'),
+        coalesce(sum(new_posting.amount)
+            FILTER (WHERE transaction.type = 'REPLENISH'), 0)
+    FROM new_posting JOIN transaction
+    ON transaction.id = new_posting.transaction_id
+    AND transaction.created_at = new_posting.created_at
+    GROUP BY 1, 2
+    ORDER BY 1, 2
+    ON CONFLICT (day, currency, shard) DO UPDATE SET
+        transfers = stats.transfers + excluded.transfers,
+        transfer_volume = stats.transfer_volume + excluded.transfer_volume,
+        replenishments = stats.replenishments + excluded.replenishments,
+        replenished = stats.replenished + excluded.replenished;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# postings of a table with the type of their transaction
+LEDGER_POSTINGS = """
+SELECT posting.created_at, posting.currency, posting.transaction_id,
+    posting.amount, transaction.type
+FROM {posting} AS posting JOIN {transaction} AS transaction
+ON transaction.id = posting.transaction_id
+AND transaction.created_at = posting.created_at
+"""
+
+# the difference of the ledger and the counters is read in the snapshot of
+# one statement and added to the rows as they are when it writes, so
+# transfers committed meanwhile are counted once
+FILL_LEDGER_STATS = """
+INSERT INTO ledger_stats AS stats(
+    day, currency, shard, transfers, transfer_volume, replenishments, replenished
+)
+SELECT ledger.day, ledger.currency, 0,
+    ledger.transfers - coalesce(counted.transfers, 0),
+    ledger.transfer_volume - coalesce(counted.transfer_volume, 0),
+    ledger.replenishments - coalesce(counted.replenishments, 0),
+    ledger.replenished - coalesce(counted.replenished, 0)
+FROM (
+    SELECT (created_at AT TIME ZONE 'UTC')::date AS day, currency,
+        count(DISTINCT transaction_id) FILTER (WHERE type = 'TRANSFER')
+            AS transfers,
+        coalesce(sum(amount) FILTER (WHERE type = 'TRANSFER' AND amount > 0), 0)
+            AS transfer_volume,
+        count(*) FILTER (WHERE type = 'REPLENISH') AS replenishments,
+        coalesce(sum(amount) FILTER (WHERE type = 'REPLENISH'), 0) AS replenished
+    FROM ({postings}) AS ledger_posting
+    GROUP BY 1, 2
+) AS ledger
+LEFT JOIN (
+    SELECT day, currency, sum(transfers) AS transfers,
+        sum(transfer_volume) AS transfer_volume,
+        sum(replenishments) AS replenishments, sum(replenished) AS replenished
+    FROM ledger_stats GROUP BY day, currency
+) AS counted USING (day, currency)
+ORDER BY 1, 2
+ON CONFLICT (day, currency, shard) DO UPDATE SET
+    transfers = stats.transfers + excluded.transfers,
+    transfer_volume = stats.transfer_volume + excluded.transfer_volume,
+    replenishments = stats.replenishments + excluded.replenishments,
+    replenished = stats.replenished + excluded.replenished;
+"""
+
+
+def upgrade():
+    """
+    Counters start with the trigger and are filled from the ledger in a
+    separate transaction: the table scan doesn't hold the lock of CREATE
+    TRIGGER, which blocks writes of postings
+    """
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        # fail instead of queueing all queries behind a waiting lock
+        op.execute("SET lock_timeout = '10s'")
+        op.execute("""
+        CREATE TABLE ledger_stats (
+            day date NOT NULL,
+            currency varchar(3) NOT NULL,
+            shard smallint NOT NULL,
+            transfers bigint NOT NULL DEFAULT 0,
+            transfer_volume numeric NOT NULL DEFAULT 0,
+            replenishments bigint NOT NULL DEFAULT 0,
+            replenished numeric NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, currency, shard)
+        );
+        """)
+        op.execute(LEDGER_STATS_POSTINGS)
+        op.execute("""
+        CREATE TRIGGER posting_ledger_stats AFTER INSERT ON posting
+        REFERENCING NEW TABLE AS new_posting
+        FOR EACH STATEMENT EXECUTE FUNCTION ledger_stats_postings();
+        """)
+        op.execute("RESET lock_timeout")
+
+        # archived partitions are counted too, they are in the ledger
+        archived = [
+            row[0]
+            for row in bind.execute(
+                sa.text(
+                    "SELECT tablename FROM pg_tables "
+                    "WHERE schemaname = 'archive' AND tablename LIKE 'posting\\_%'"
+                )
+            )
+        ]
+        tables = [('posting', 'transaction')] + [
+            (f'archive."{name}"', f'archive."transaction{name[len("posting"):]}"')
+            for name in sorted(archived)
+        ]
+        postings = ' UNION ALL '.join(
+            LEDGER_POSTINGS.format(posting=posting, transaction=transaction)
+            for posting, transaction in tables
+        )
+        op.execute(FILL_LEDGER_STATS.format(postings=postings))
+
+
+def downgrade():
+    op.execute('DROP TRIGGER posting_ledger_stats ON posting;')
+    op.execute('DROP FUNCTION ledger_stats_postings();')
+    op.drop_table('ledger_stats')
@@ -0,0 +1,125 @@
+"""add balance snapshots
+
+Revision ID: f2c6b8e04d19
+Revises: d5e1a7c93b48
+Create Date: 2026-10-18 22:27:51.904113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2c6b8e04d19'
+down_revision = 'd5e1a7c93b48'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = {
+    # postings of a wallet after its snapshot, amount is read from the index
+    'ix_posting_wallet_id_created_at': '(wallet_id, created_at) INCLUDE (amount)',
+    # postings of a snapshot period; created_at grows with insertion order,
+    # so block ranges are narrow and the index is tiny to maintain
+    'ix_posting_created_at': 'USING brin (created_at)',
+}
+
+# balance of the wallet at the moment: the latest snapshot up to the moment
+# and postings after it; the wallet has no postings in snapshotted periods
+# after its latest snapshot, so postings of one period at most are summed
+WALLET_BALANCE_AT = """
+CREATE FUNCTION wallet_balance_at(
+    p_wallet_id uuid,
+    p_at timestamptz,
+    OUT currency text,
+    OUT amount numeric
+) AS $$
+DECLARE
+    v_taken_at timestamptz;
+    v_table text;
+    v_amount numeric;
+BEGIN
+    SELECT wallet.currency INTO currency FROM wallet WHERE id = p_wallet_id;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    SELECT taken_at, balance_snapshot.amount INTO v_taken_at, amount
+    FROM balance_snapshot WHERE wallet_id = p_wallet_id AND taken_at <= p_at
+    ORDER BY taken_at DESC LIMIT 1;
+    v_taken_at := coalesce(v_taken_at, '-infinity');
+    amount := coalesce(amount, 0);
+
+    SELECT sum(posting.amount) INTO v_amount FROM posting
+    WHERE wallet_id = p_wallet_id AND created_at >= v_taken_at AND created_at <= p_at;
+    amount := amount + coalesce(v_amount, 0);
+    -- partitions moved to the archive schema
+    FOR v_table IN
+        SELECT format('%I.%I', schemaname, tablename) FROM pg_tables
+        WHERE schemaname = 'archive' AND tablename LIKE 'posting\\_%'
+    LOOP
+        EXECUTE format(
+            'SELECT sum(amount) FROM %s '
+            'WHERE wallet_id = $1 AND created_at >= $2 AND created_at <= $3',
+            v_table
+        ) INTO v_amount USING p_wallet_id, v_taken_at, p_at;
+        amount := amount + coalesce(v_amount, 0);
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+def upgrade():
+    op.create_table(
+        'balance_snapshot',
+        sa.Column('wallet_id', sa.dialects.postgresql.UUID(), nullable=False),
+        sa.Column('taken_at', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('amount', sa.Numeric(precision=19, scale=2), nullable=False),
+        sa.ForeignKeyConstraint(['wallet_id'], ['wallet.id']),
+        sa.PrimaryKeyConstraint('wallet_id', 'taken_at'),
+    )
+    op.create_table(
+        'balance_snapshot_run',
+        sa.Column('taken_at', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('wallets', sa.Integer(), nullable=False),
+        sa.Column(
+            'created_at',
+            sa.DateTime(timezone=True),
+            server_default=sa.text('now()'),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint('taken_at'),
+    )
+    op.execute(WALLET_BALANCE_AT)
+
+    # see b4f81e6a2d57: indexes of partitions are built CONCURRENTLY and
+    # attached to the index created on the parent only
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        partitions = [
+            row[0]
+            for row in bind.execute(
+                sa.text(
+                    'SELECT inhrelid::regclass::text FROM pg_inherits '
+                    "WHERE inhparent = 'posting'::regclass"
+                )
+            )
+        ]
+        for name, columns in INDEXES.items():
+            op.execute(f'CREATE INDEX IF NOT EXISTS {name} ON ONLY posting {columns}')
+            for partition in partitions:
+                partition_index = f'{partition}_{name[len("ix_posting_"):]}_idx'
+                op.execute(
+                    f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {partition_index} '
+                    f'ON {partition} {columns}'
+                )
+                op.execute(f'ALTER INDEX {name} ATTACH PARTITION {partition_index}')
+
+
+def downgrade():
+    for name in INDEXES:
+        op.execute(f'DROP INDEX {name}')
+    op.execute('DROP FUNCTION wallet_balance_at(uuid, timestamptz);')
+    op.drop_table('balance_snapshot_run')
+    op.drop_table('balance_snapshot')
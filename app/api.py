@@ -1,18 +1,69 @@
+import datetime
+import json
 import logging
 import uuid
+from typing import Optional
 
 import asyncpg
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Header, HTTPException, Query, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from starlette import status
 
-from app import crud
-from app.schemas import (AccountCreateIn, AccountCreateOut, Currency,
-                         ExtendedAccountOut, ReplenishWalletInfo,
-                         TransferMoneyIn, TransferMoneyOut)
+from app import (admission, crud, idempotency, ledger_stats, metrics, ndjson,
+                 onboarding, replicas, statements)
+from app.account_cache import account_cache
+from app.batcher import transfer_batcher
+from app.config import settings
+from app.database import db
+from app.encoding import ModelResponse
+from app.schemas import (AccountCreateIn, AccountCreateOut, BalanceOut,
+                         BatchItemStatus, Currency, ExtendedAccountOut,
+                         LedgerStatsOut, PostingsPage, ReplenishBatchIn,
+                         ReplenishBatchItemOut, ReplenishBatchOut,
+                         ReplenishWalletInfo, StatementFormat, TransactionType,
+                         TransferBatchIn, TransferBatchItemOut,
+                         TransferBatchOut, TransferMoneyIn, TransferMoneyOut)
 
 logger = logging.getLogger(__name__)
 
-router = APIRouter()
+router = APIRouter(route_class=metrics.TimedRoute)
+
+
+@crud.retry_on_conflict
+async def _run_and_save_response(endpoint, key, data_hash, status_code, operation):
+    async with db.transaction():
+        result = await operation()
+        response = idempotency.StoredResponse(
+            data_hash, status_code, jsonable_encoder(result)
+        )
+        await idempotency.save_response(endpoint, key, response)
+    idempotency.cache.set((endpoint, key), response)
+    return response
+
+
+async def idempotent(endpoint, key, data, status_code, operation):
+    """
+    Run operation at most once per Idempotency-Key: the response is saved in
+    the transaction of the operation and returned again for repeated requests.
+    Only successful responses are saved, failed requests can be retried
+    with the same key
+    """
+    if key is None:
+        return ModelResponse(await operation(), status_code=status_code)
+
+    data_hash = idempotency.request_hash(data)
+    response = await idempotency.get_response(endpoint, key, data_hash)
+    while response is None:
+        try:
+            response = await _run_and_save_response(
+                endpoint, key, data_hash, status_code, operation
+            )
+        except idempotency.KeyTaken:
+            # the response saved first, unless the key has expired since
+            # then and the operation runs again
+            response = await idempotency.get_response(endpoint, key, data_hash)
+    return JSONResponse(response.body, status_code=response.status_code)
 
 
 @router.post(
@@ -20,10 +71,23 @@ router = APIRouter()
     status_code=status.HTTP_201_CREATED,
     response_model=AccountCreateOut,
 )
-async def create_account(account: AccountCreateIn):
+async def create_account(
+    account: AccountCreateIn,
+    idempotency_key: Optional[str] = Header(None, max_length=255),
+):
     """Create account with wallet and return account_id and wallet_id """
     try:
-        return await crud.create_account_with_wallet(account)
+        return await idempotent(
+            "create_account",
+            idempotency_key,
+            account,
+            status.HTTP_201_CREATED,
+            lambda: crud.create_account_with_wallet(account),
+        )
+    except idempotency.KeyReused as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=e.message
+        )
     except asyncpg.exceptions.UniqueViolationError as e:
         logger.exception(e)
         raise HTTPException(
@@ -35,6 +99,89 @@ async def create_account(account: AccountCreateIn):
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+async def _log_stream_errors(lines, error):
+    # response status is already sent, so errors are reported in the stream
+    try:
+        async for line in lines:
+            yield line
+    except Exception as e:
+        logger.exception(e)
+        yield ndjson.dumps({"error": error})
+
+
+class _DuplexStreamingResponse(StreamingResponse):
+    """
+    Streaming response of a body which reads the request body while it's sent.
+    StreamingResponse receives request messages to listen for disconnect at
+    the same time and drops request body chunks, so only the body is sent
+    here; a disconnect ends the request stream with ClientDisconnect
+    """
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+
+async def _read_body(request: Request, max_size: int) -> Optional[bytes]:
+    """Request body, None if it's longer than max_size bytes"""
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > max_size:
+        return None
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > max_size:
+            return None
+    return b"".join(chunks)
+
+
+@router.post(
+    "/accounts/bulk",
+    status_code=status.HTTP_201_CREATED,
+    response_class=StreamingResponse,
+)
+async def create_accounts_bulk(request: Request):
+    """
+    Create accounts with wallets from JSON list (settings.max_bulk_json_size
+    bytes at most) or NDJSON stream (Content-Type: application/x-ndjson) of
+    {"name": ...} objects.
+    Stream back NDJSON line with account_id and wallet_id (or error) per account
+    """
+    if request.headers.get("content-type", "").startswith(ndjson.MEDIA_TYPE):
+        items = onboarding.parse_lines(ndjson.iter_lines(request.stream()))
+        response_class = _DuplexStreamingResponse
+    else:
+        # JSON list is parsed whole, large inputs are streamed as NDJSON
+        body = await _read_body(request, settings.max_bulk_json_size)
+        if body is None:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"JSON body is limited to {settings.max_bulk_json_size} "
+                "bytes; send more accounts as NDJSON stream",
+            )
+        try:
+            accounts = json.loads(body)
+        except ValueError:
+            accounts = None
+        if not isinstance(accounts, list):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="body must be JSON list or NDJSON stream of accounts",
+            )
+        items = onboarding.iterate(accounts)
+        response_class = StreamingResponse
+
+    lines = _log_stream_errors(
+        onboarding.onboard(items), "can't create accounts; try again later"
+    )
+    return response_class(
+        lines, status_code=status.HTTP_201_CREATED, media_type=ndjson.MEDIA_TYPE
+    )
+
+
 @router.get(
     "/accounts/{account_id}",
     status_code=status.HTTP_200_OK,
@@ -43,26 +190,189 @@ async def create_account(account: AccountCreateIn):
 async def get_account(account_id: uuid.UUID):
     """Get account with wallet information by account_id"""
     try:
-        return await crud.get_account_with_wallet(account_id)
+        return ModelResponse(await account_cache.get(account_id))
+    except crud.NotFound as e:
+        metrics.crud_error("get_account", e)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=e.message)
+    except Exception as e:
+        logger.exception(e)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@router.get(
+    "/wallets/{wallet_id}/postings",
+    status_code=status.HTTP_200_OK,
+    response_model=PostingsPage,
+)
+async def get_wallet_postings(
+    wallet_id: uuid.UUID,
+    limit: int = Query(
+        settings.postings_page_size, ge=1, le=settings.max_postings_page_size
+    ),
+    cursor: Optional[str] = None,
+    type: Optional[TransactionType] = None,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+):
+    """
+    Get wallet postings, newest first, optionally of one transaction type and
+    created in [since, until). Pass next_cursor of a page as cursor to get
+    the next one
+    """
+    try:
+        return ModelResponse(
+            await crud.get_postings(wallet_id, limit, cursor, type, since, until)
+        )
+    except crud.NotFound as e:
+        metrics.crud_error("get_postings", e)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=e.message)
+    except crud.CRUDException as e:
+        metrics.crud_error("get_postings", e)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=e.message)
+    except Exception as e:
+        logger.exception(e)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@router.get(
+    "/wallets/{wallet_id}/balance",
+    status_code=status.HTTP_200_OK,
+    response_model=BalanceOut,
+)
+async def get_wallet_balance(wallet_id: uuid.UUID, at: datetime.datetime):
+    """Get wallet amount at the moment, postings created at it included"""
+    try:
+        return ModelResponse(await crud.get_balance(wallet_id, at))
+    except crud.NotFound as e:
+        metrics.crud_error("get_balance", e)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=e.message)
+    except Exception as e:
+        logger.exception(e)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+async def _prepend(first, lines):
+    yield first
+    async for line in lines:
+        yield line
+
+
+@router.get(
+    "/wallets/{wallet_id}/statement",
+    status_code=status.HTTP_200_OK,
+    response_class=StreamingResponse,
+)
+async def get_wallet_statement(
+    wallet_id: uuid.UUID,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+    format: StatementFormat = StatementFormat.csv,
+):
+    """
+    Stream wallet postings created in [since, until), oldest first, with
+    running balance after each of them as CSV or NDJSON lines
+    """
+    lines = statements.stream(wallet_id, since, until, format)
+    try:
+        # wallet is looked up before the response status is sent
+        first = await lines.__anext__()
     except crud.NotFound as e:
+        metrics.crud_error("get_statement", e)
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=e.message)
     except Exception as e:
         logger.exception(e)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    lines = _prepend(first, lines)
+    headers = {}
+    if format is StatementFormat.csv:
+        # CSV has no error line: a failed statement ends without the last
+        # chunk, so clients see a broken response instead of a short one
+        headers["Content-Disposition"] = (
+            f'attachment; filename="statement-{wallet_id}.csv"'
+        )
+    else:
+        lines = _log_stream_errors(lines, "can't export statement; try again later")
+    return StreamingResponse(
+        lines, media_type=statements.media_type(format), headers=headers
+    )
+
+
+@router.get("/stats", status_code=status.HTTP_200_OK, response_model=LedgerStatsOut)
+async def get_ledger_stats(days: int = Query(30, ge=1, le=366)):
+    """
+    Get money in circulation, numbers and volumes of transfers and
+    replenishments per currency, and per day (UTC) of the last days
+    """
+    try:
+        return ModelResponse(await ledger_stats.get_stats(days))
+    except Exception as e:
+        logger.exception(e)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@router.get("/cache/stats", status_code=status.HTTP_200_OK)
+async def get_cache_stats():
+    """Get hit, miss and eviction counters of caches of this worker"""
+    return {
+        "accounts": account_cache.stats(),
+        "idempotency": idempotency.cache.stats(),
+    }
+
+
+@router.get("/pool/stats", status_code=status.HTTP_200_OK)
+async def get_pool_stats():
+    """Get database connection pool usage of this worker"""
+    return db.pool_stats()
+
+
+@router.get("/admission/stats", status_code=status.HTTP_200_OK)
+async def get_admission_stats():
+    """Get limits, running and queued requests of budgets of this worker"""
+    return {"reads": admission.reads.stats(), "writes": admission.writes.stats()}
+
+
+@router.get("/replicas/stats", status_code=status.HTTP_200_OK)
+async def get_replica_stats():
+    """Get positions, lag and reads of read replicas as this worker sees them"""
+    return replicas.replica_set.stats()
+
+
+@router.get("/metrics", response_class=Response)
+async def get_metrics():
+    """Get metrics of all workers in Prometheus text format"""
+    return Response(metrics.latest(), media_type=metrics.CONTENT_TYPE_LATEST)
+
 
 @router.post(
     "/replenish",
     status_code=status.HTTP_200_OK,
     response_model=ReplenishWalletInfo,
 )
-async def replenish_wallet(data: ReplenishWalletInfo):
+async def replenish_wallet(
+    data: ReplenishWalletInfo,
+    idempotency_key: Optional[str] = Header(None, max_length=255),
+):
     """Replenish wallet with by wallet_id"""
     try:
-        return await crud.replenish(data)
+        response = await idempotent(
+            "replenish_wallet",
+            idempotency_key,
+            data,
+            status.HTTP_200_OK,
+            lambda: crud.replenish(data),
+        )
+        account_cache.invalidate_wallets([data.wallet_id])
+        return response
+    except idempotency.KeyReused as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=e.message
+        )
     except crud.NotFound as e:
+        metrics.crud_error("replenish", e)
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=e.message)
     except crud.CRUDException as e:
+        metrics.crud_error("replenish", e)
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=e.message)
     except Exception as e:
         logger.exception(e)
@@ -74,7 +384,10 @@ async def replenish_wallet(data: ReplenishWalletInfo):
     status_code=status.HTTP_200_OK,
     response_model=TransferMoneyOut,
 )
-async def transfer_money(data: TransferMoneyIn):
+async def transfer_money(
+    data: TransferMoneyIn,
+    idempotency_key: Optional[str] = Header(None, max_length=255),
+):
     """Transfers money from one wallet to another"""
     if not data.is_currencies_match():
         raise HTTPException(
@@ -82,11 +395,106 @@ async def transfer_money(data: TransferMoneyIn):
             detail=f"only {Currency.USD.value} currency is supported",
         )
     try:
-        return await crud.transfer(data)
+        if settings.transfer_coalescing and idempotency_key is None:
+            return ModelResponse(await transfer_batcher.transfer(data))
+        # transfers with idempotency key are not coalesced, the key must be
+        # saved in the transaction of the transfer
+        response = await idempotent(
+            "transfer_money",
+            idempotency_key,
+            data,
+            status.HTTP_200_OK,
+            lambda: crud.transfer(data),
+        )
+        account_cache.invalidate_wallets([data.from_wallet_id, data.to_wallet_id])
+        return response
+    except idempotency.KeyReused as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=e.message
+        )
     except crud.NotFound as e:
+        metrics.crud_error("transfer", e)
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=e.message)
     except crud.CRUDException as e:
+        metrics.crud_error("transfer", e)
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=e.message)
+    except crud.RETRYABLE_ERRORS as e:
+        logger.exception(e)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="can't transfer because of concurrent transfers; try again later",
+        )
+    except Exception as e:
+        logger.exception(e)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def batch_item(operation, result, item_out):
+    if isinstance(result, crud.CRUDException):
+        metrics.crud_error(operation, result)
+    if isinstance(result, crud.NotFound):
+        return item_out.construct(
+            status=BatchItemStatus.not_found, error=result.message
+        )
+    if isinstance(result, crud.BatchRolledBack):
+        return item_out.construct(
+            status=BatchItemStatus.rolled_back, error=result.message
+        )
+    if isinstance(result, crud.CRUDException):
+        return item_out.construct(status=BatchItemStatus.failed, error=result.message)
+    return item_out.construct(status=BatchItemStatus.ok, result=result)
+
+
+@router.post(
+    "/transfers/batch",
+    status_code=status.HTTP_200_OK,
+    response_model=TransferBatchOut,
+)
+async def transfer_money_batch(data: TransferBatchIn):
+    """Transfer money between wallets in one transaction, return result per transfer"""
+    try:
+        results = await crud.transfer_batch(data.transfers, data.mode)
+    except crud.RETRYABLE_ERRORS as e:
+        logger.exception(e)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="can't transfer because of concurrent transfers; try again later",
+        )
+    except Exception as e:
+        logger.exception(e)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    account_cache.invalidate_wallets(
+        wallet_id
+        for transfer in data.transfers
+        for wallet_id in (transfer.from_wallet_id, transfer.to_wallet_id)
+    )
+    items = [
+        batch_item("transfer_batch", result, TransferBatchItemOut) for result in results
+    ]
+    return ModelResponse(TransferBatchOut.construct(results=items))
+
+
+@router.post(
+    "/replenish/batch",
+    status_code=status.HTTP_200_OK,
+    response_model=ReplenishBatchOut,
+)
+async def replenish_wallet_batch(data: ReplenishBatchIn):
+    """Replenish wallets in one transaction, return result per replenishment"""
+    try:
+        results = await crud.replenish_batch(data.replenishments, data.mode)
+    except crud.RETRYABLE_ERRORS as e:
+        logger.exception(e)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="can't replenish because of concurrent operations; try again later",
+        )
     except Exception as e:
         logger.exception(e)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    account_cache.invalidate_wallets(item.wallet_id for item in data.replenishments)
+    items = [
+        batch_item("replenish_batch", result, ReplenishBatchItemOut)
+        for result in results
+    ]
+    return ModelResponse(ReplenishBatchOut.construct(results=items))
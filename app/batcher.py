@@ -0,0 +1,123 @@
+import asyncio
+import contextvars
+import logging
+from typing import List, Optional, Tuple
+
+import asyncpg
+
+from app import crud
+from app.account_cache import account_cache
+from app.config import settings
+from app.schemas import BatchMode, TransferMoneyIn, TransferMoneyOut
+
+logger = logging.getLogger(__name__)
+
+# errors after which the batch is known to be rolled back, so its transfers
+# can be applied again; after others (e.g. connection lost during commit) the
+# batch may be committed
+ROLLED_BACK_ERRORS = crud.RETRYABLE_ERRORS + (
+    asyncpg.exceptions.DataError,
+    asyncpg.exceptions.IntegrityConstraintViolationError,
+    crud.CRUDException,
+)
+
+
+class TransferBatcher:
+    """
+    Group commit for transfers: transfers arriving within `window` seconds
+    (or until `max_size` of them are collected) are applied by one
+    crud.transfer_batch call in independent mode, so they share one DB
+    transaction and one commit. Every caller gets its own result or error;
+    when the whole batch is rolled back, its transfers are applied one by one.
+    """
+
+    def __init__(self, window: float, max_size: int):
+        self.window = window
+        self.max_size = max_size
+        self._pending: List[Tuple[TransferMoneyIn, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes = set()
+
+    async def transfer(self, data: TransferMoneyIn) -> TransferMoneyOut:
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending.append((data, future))
+        if len(self._pending) >= self.max_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        # databases keeps the connection in a context variable; started from
+        # empty context the batch gets its own connection instead of sharing
+        # one with the request which triggered the flush
+        flush = contextvars.Context().run(asyncio.ensure_future, self._apply(batch))
+        self._flushes.add(flush)
+        flush.add_done_callback(self._flushes.discard)
+
+    async def _apply(self, batch):
+        try:
+            results = await crud.transfer_batch(
+                [data for data, _ in batch], BatchMode.independent
+            )
+        except ROLLED_BACK_ERRORS as e:
+            # errors of transfers are returned per transfer, so this is a
+            # DB error or a conflict which may be caused by any of them
+            logger.exception(e)
+            await self._apply_each(batch)
+            return
+        except Exception as e:
+            logger.exception(e)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        account_cache.invalidate_wallets(
+            wallet_id
+            for data, _ in batch
+            for wallet_id in (data.from_wallet_id, data.to_wallet_id)
+        )
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                # caller is cancelled
+                continue
+            if isinstance(result, crud.CRUDException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _apply_each(self, batch):
+        """Apply transfers one by one, every caller gets its own error"""
+        for data, future in batch:
+            if future.done():
+                continue
+            try:
+                result = await crud.transfer(data)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                account_cache.invalidate_wallets(
+                    [data.from_wallet_id, data.to_wallet_id]
+                )
+                if not future.done():
+                    future.set_result(result)
+
+    async def close(self):
+        """Apply pending transfers and wait for running batches"""
+        self.flush()
+        if self._flushes:
+            await asyncio.wait(self._flushes)
+
+
+transfer_batcher = TransferBatcher(
+    settings.transfer_coalesce_window, settings.transfer_coalesce_max_size
+)
@@ -0,0 +1,61 @@
+import collections
+import time
+
+
+class TTLCache:
+    """
+    In-process LRU cache of at most maxsize items, every item expires
+    ttl seconds after it is set. Not shared between workers.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._timer = timer
+        self._items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        item = self._items.get(key)
+        if item is not None and item[1] <= self._timer():
+            del self._items[key]
+            item = None
+        if item is None:
+            self.misses += 1
+            return default
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def set(self, key, value, ttl: float = None):
+        """Set the item, which expires in ttl seconds if it's sooner"""
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self._items[key] = (value, self._timer() + ttl)
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        item = self._items.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        self._items.clear()
+
+    def values(self):
+        """Values of all items, expired ones included"""
+        return [value for value, _ in self._items.values()]
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._items),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def __len__(self):
+        return len(self._items)
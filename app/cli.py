@@ -0,0 +1,226 @@
+"""
+Maintenance commands, run from the project root:
+    python -m app.cli <command> --help
+"""
+import argparse
+import asyncio
+import logging
+import sys
+import uuid
+
+from app import (crud, ledger_stats, ndjson, onboarding, outbox, partitions,
+                 reconciliation, snapshots)
+from app.config import settings
+from app.database import db
+
+
+async def _read_lines(file):
+    for line in file:
+        if line.strip():
+            yield line
+
+
+async def onboard(args):
+    """Create accounts from NDJSON file, print account_id and wallet_id per line"""
+    source = sys.stdin.buffer if args.file == "-" else open(args.file, "rb")
+    try:
+        items = onboarding.parse_lines(_read_lines(source))
+        async for line in onboarding.onboard(items):
+            sys.stdout.buffer.write(line)
+    finally:
+        if source is not sys.stdin.buffer:
+            source.close()
+    sys.stdout.buffer.flush()
+
+
+async def create_partitions(args):
+    """Create partitions of coming months, print names of created ones"""
+    for name in await partitions.create_partitions(args.months_ahead):
+        print(name)
+
+
+async def archive_partitions(args):
+    """Move partitions of old months to the archive schema, print their names"""
+    for name in await partitions.archive_partitions(args.keep_months):
+        print(name)
+
+
+async def reconcile(args):
+    """
+    Print NDJSON line per wallet whose amount differs from sum of its postings,
+    summary to stderr; exit with status 1 if there are mismatches
+    """
+
+    def report(mismatch: reconciliation.Mismatch):
+        line = {
+            "wallet_id": str(mismatch.wallet_id),
+            "amount": str(mismatch.amount),
+            "ledger_amount": str(mismatch.ledger_amount),
+        }
+        sys.stdout.buffer.write(ndjson.dumps(line))
+
+    summary = await reconciliation.reconcile(
+        args.shards, args.shard, args.incremental, report
+    )
+    sys.stdout.buffer.flush()
+    summary = summary._asdict()
+    for key in ("wallet_id_from", "wallet_id_to"):
+        summary[key] = str(summary[key])
+    sys.stderr.buffer.write(ndjson.dumps(summary))
+    if summary["mismatches"]:
+        sys.exit(1)
+
+
+async def snapshot_balances(args):
+    """Take balance snapshots of finished periods, print their boundaries"""
+    for boundary in await snapshots.take_snapshots():
+        print(boundary.isoformat())
+
+
+async def shard_wallet(args):
+    """Split wallet amount over shard rows (merge them with 0), print the amount"""
+    try:
+        amount = await crud.shard_wallet(args.wallet_id, args.shards)
+    except crud.CRUDException as e:
+        sys.exit(e.message)
+    print(amount)
+
+
+async def relay_outbox(args):
+    """Append ledger events to NDJSON file as they are committed, until killed"""
+    # throughput and lag of the relay go to stderr
+    logging.basicConfig(level=logging.INFO)
+    sink = outbox.FileSink(args.file)
+    try:
+        await outbox.relay(args.name, sink)
+    finally:
+        sink.close()
+
+
+async def verify_stats(args):
+    """
+    Print NDJSON line per day and currency whose ledger stats differ from the
+    ledger (differences are ledger minus stats); exit with status 1 if there
+    are mismatches, unless they are fixed
+    """
+    mismatches = await ledger_stats.verify(args.fix)
+    for mismatch in mismatches:
+        line = mismatch._asdict()
+        line["day"] = mismatch.day.isoformat()
+        for key in ("transfer_volume", "replenished"):
+            line[key] = str(line[key])
+        sys.stdout.buffer.write(ndjson.dumps(line))
+    sys.stdout.buffer.flush()
+    if mismatches and not args.fix:
+        sys.exit(1)
+
+
+async def run(args):
+    await db.connect()
+    try:
+        await args.func(args)
+    finally:
+        await db.disconnect()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="payment system commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    onboard_parser = subparsers.add_parser(
+        "onboard", help="bulk create accounts with wallets"
+    )
+    onboard_parser.add_argument(
+        "file", help='NDJSON file with {"name": ...} object per line, "-" for stdin'
+    )
+    onboard_parser.set_defaults(func=onboard)
+
+    partitions_parser = subparsers.add_parser(
+        "partitions", help="monthly partitions of transaction and posting"
+    )
+    partitions_subparsers = partitions_parser.add_subparsers(
+        dest="action", required=True
+    )
+    create_parser = partitions_subparsers.add_parser(
+        "create", help="create partitions of coming months"
+    )
+    create_parser.add_argument(
+        "--months-ahead",
+        type=int,
+        default=settings.partition_months_ahead,
+        help="create partitions up to this many months after the current one",
+    )
+    create_parser.set_defaults(func=create_partitions)
+    archive_parser = partitions_subparsers.add_parser(
+        "archive", help=f"detach old partitions to {partitions.ARCHIVE_SCHEMA} schema"
+    )
+    archive_parser.add_argument(
+        "--keep-months",
+        type=int,
+        default=settings.partition_keep_months,
+        help="keep partitions of this many months before the current one",
+    )
+    archive_parser.set_defaults(func=archive_partitions)
+
+    reconcile_parser = subparsers.add_parser(
+        "reconcile", help="compare wallet amounts with sums of their postings"
+    )
+    reconcile_parser.add_argument(
+        "--shards", type=int, default=1, help="split wallet ids into this many ranges"
+    )
+    reconcile_parser.add_argument(
+        "--shard",
+        type=int,
+        default=0,
+        help="reconcile wallets of this range, from 0 to shards - 1",
+    )
+    reconcile_parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="read only postings after the checkpoint of the previous run",
+    )
+    reconcile_parser.set_defaults(func=reconcile)
+
+    snapshot_parser = subparsers.add_parser(
+        "snapshot-balances", help="snapshot wallet balances of finished periods"
+    )
+    snapshot_parser.set_defaults(func=snapshot_balances)
+
+    shard_parser = subparsers.add_parser(
+        "shard-wallet", help="split amount of a hot wallet over sub-balance rows"
+    )
+    shard_parser.add_argument("wallet_id", type=uuid.UUID)
+    shard_parser.add_argument(
+        "--shards",
+        type=int,
+        required=True,
+        help="number of sub-balance rows, 0 merges them back into the wallet",
+    )
+    shard_parser.set_defaults(func=shard_wallet)
+
+    relay_parser = subparsers.add_parser(
+        "relay-outbox", help="deliver ledger events from the outbox to a file"
+    )
+    relay_parser.add_argument(
+        "name", help="name of the sink, it resumes after its last delivered event"
+    )
+    relay_parser.add_argument(
+        "--file", default="-", help='NDJSON file to append events to, "-" for stdout'
+    )
+    relay_parser.set_defaults(func=relay_outbox)
+
+    stats_parser = subparsers.add_parser(
+        "verify-stats", help="compare ledger stats counters with the ledger"
+    )
+    stats_parser.add_argument(
+        "--fix",
+        action="store_true",
+        help="add the differences to the counters, safe while transfers go on",
+    )
+    stats_parser.set_defaults(func=verify_stats)
+
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
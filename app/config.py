@@ -1,4 +1,5 @@
 import decimal
+from typing import Dict, List, Optional, Tuple
 
 from pydantic import BaseSettings, Field
 
@@ -17,6 +18,109 @@ class Settings(BaseSettings):
     decimal_scale: int = 2
     max_amount: decimal.Decimal = get_max_decimal(decimal_precision, decimal_scale)
     min_amount: decimal.Decimal = decimal.Decimal(0)
+    # connection pool of every worker, so workers * (db_pool_max_size + 1 account
+    # cache listener) + cli/migrations must fit into postgres max_connections
+    db_pool_min_size: int = 10
+    db_pool_max_size: int = 10
+    # seconds to wait for free connection before failing the request
+    db_pool_acquire_timeout: Optional[float] = 10
+    # connections older than this are closed when released to the pool
+    db_pool_max_lifetime: Optional[float] = 60 * 60
+    # prepared statements cached per connection, 0 disables the cache
+    db_statement_cache_size: int = 100
+    # read replicas (JSON list of URLs, pools of the same size): GET requests
+    # read from replicas at most max_lag seconds behind the primary which
+    # have replayed the X-Session-Token of the client, positions are checked
+    # every check_interval seconds
+    db_replica_urls: List[str] = []
+    db_replica_max_lag: float = 1
+    db_replica_check_interval: float = 0.1
+    max_batch_size: int = 10000
+    # postings per page of GET /wallets/{wallet_id}/postings
+    postings_page_size: int = 100
+    max_postings_page_size: int = 1000
+    # rows fetched from the server-side cursor at once by statement export
+    statement_chunk_size: int = 1000
+    # accounts created with one COPY by bulk onboarding; JSON list bodies are
+    # parsed whole, so they are limited to max_bulk_json_size bytes (NDJSON
+    # streams of any size take the same memory)
+    copy_chunk_size: int = 5000
+    max_bulk_json_size: int = 1024 * 1024
+    # group commit of /transfer requests: transfers arriving within window
+    # seconds (or max size of them) are applied in one transaction
+    transfer_coalescing: bool = False
+    transfer_coalesce_window: float = 0.002
+    transfer_coalesce_max_size: int = 100
+    # responses of requests with Idempotency-Key header are kept for ttl seconds
+    idempotency_key_ttl: int = 24 * 60 * 60
+    idempotency_cache_size: int = 10000
+    idempotency_purge_interval: float = 10 * 60
+    # per-worker cache of GET /accounts/{account_id}, entries are invalidated
+    # by LISTEN/NOTIFY on wallet change; ttl only limits lifetime of entries
+    account_caching: bool = True
+    account_cache_size: int = 10000
+    account_cache_ttl: float = 60
+    account_cache_reconnect_delay: float = 1
+    # monthly partitions of transaction and posting: partitions of months_ahead
+    # coming months are kept created (checked every check_interval seconds),
+    # `cli partitions archive` detaches the ones older than keep_months
+    partition_months_ahead: int = 3
+    partition_keep_months: int = 12
+    partition_check_interval: float = 6 * 60 * 60
+    # rows fetched from the server-side cursor at once by reconciliation;
+    # it waits for transactions which may still insert postings up to the
+    # checkpoint for reconcile_wait_timeout seconds at most
+    reconcile_chunk_size: int = 10000
+    reconcile_wait_timeout: float = 60
+    # balances are snapshotted at multiples of balance_snapshot_period seconds
+    # since the epoch (checked every check_interval seconds), after
+    # transactions started before the boundary end (wait_timeout at most)
+    balance_snapshot_period: int = 24 * 60 * 60
+    balance_snapshot_check_interval: float = 10 * 60
+    balance_snapshot_wait_timeout: float = 60
+    # ledger events are relayed from the outbox to sinks by batches of
+    # outbox_batch_size, polled every poll_interval seconds when there are no
+    # new ones; relays wait wait_timeout seconds at most for transactions
+    # which may still write events, delete events delivered to all sinks every
+    # purge_interval seconds and log throughput every stats_interval seconds
+    outbox_batch_size: int = 1000
+    outbox_poll_interval: float = 0.1
+    outbox_wait_timeout: float = 60
+    outbox_purge_interval: float = 60
+    outbox_stats_interval: float = 10
+    # rate limits of every client per route: {"METHOD /route/template":
+    # [requests per second, burst]}, "*" limits all routes without their own
+    # limit together; client_rate_limits replace them for particular clients,
+    # {} for both disables rate limiting. Clients are told apart by
+    # rate_limit_client_header (set by the gateway which authenticates them)
+    # or by address. Buckets of all workers of the host are rate_limit_slots
+    # slots of 16 bytes in rate_limit_file, checked under record locks unless
+    # rate_limit_locking is off, which lets concurrent requests of a client
+    # in different workers past a limit now and then for cheaper checks
+    rate_limits: Dict[str, Tuple[float, int]] = {}
+    client_rate_limits: Dict[str, Dict[str, Tuple[float, int]]] = {}
+    rate_limit_client_header: Optional[str] = None
+    rate_limit_file: str = "/dev/shm/payment-system-rate-limit"
+    rate_limit_slots: int = 65536
+    rate_limit_locking: bool = True
+    # admission control of every worker: up to read_limit GET and write_limit
+    # other requests run at once, queue_size more wait queue_timeout seconds
+    # at most (target seconds while the queue is never empty for interval),
+    # the rest get 503. The write limit is halved (down to min_limit) after
+    # every interval in which no connection was acquired within target and
+    # grows by one after other intervals
+    admission_control: bool = True
+    admission_read_limit: int = 64
+    admission_write_limit: int = 32
+    admission_min_limit: int = 2
+    admission_queue_size: int = 128
+    admission_queue_timeout: float = 1
+    admission_target: float = 0.005
+    admission_interval: float = 0.1
+    # retries of transactions aborted by deadlock or serialization failure
+    db_retry_attempts: int = 3
+    db_retry_base_delay: float = 0.005
+    db_retry_max_delay: float = 0.1
 
 
 settings = Settings()
@@ -1,12 +1,36 @@
+import asyncio
+import base64
+import datetime
+import decimal
+import enum
+import functools
+import logging
+import random
 import uuid
+from typing import Dict, List, Optional, Tuple, Union
 
-from app import config
+import asyncpg
+
+from app import config, dal, metrics
 from app.config import settings
 from app.database import db
 from app.dbmodels import accounts, wallets
-from app.schemas import (AccountCreateIn, AccountCreateOut, Currency,
-                         ExtendedAccountOut, ReplenishWalletInfo,
-                         TransactionType, TransferMoneyIn, TransferMoneyOut)
+from app.schemas import (AccountCreateIn, AccountCreateOut, BalanceOut,
+                         BatchMode, Currency, ExtendedAccountOut, PostingOut,
+                         PostingsPage, ReplenishWalletInfo, TransactionType,
+                         TransferMoneyIn, TransferMoneyOut)
+
+logger = logging.getLogger(__name__)
+
+# errors after which the whole transaction can be safely run again
+RETRYABLE_ERRORS = (
+    asyncpg.exceptions.DeadlockDetectedError,
+    asyncpg.exceptions.SerializationError,
+)
+
+lock_wallets_latency = metrics.query_latency.labels("lock_wallets_batch")
+update_wallets_latency = metrics.query_latency.labels("update_wallets_batch")
+insert_ledger_latency = metrics.query_latency.labels("insert_ledger_batch")
 
 
 class CRUDException(Exception):
@@ -21,6 +45,75 @@ class NotFound(CRUDException):
         super().__init__(self.message)
 
 
+class BatchRolledBack(CRUDException):
+    """Item of atomic batch which is not applied because another item failed"""
+
+
+class TransferStatus(enum.Enum):
+    """Statuses returned by transfer_money stored function"""
+
+    ok = "ok"
+    from_wallet_not_found = "from_wallet_not_found"
+    not_enough_amount = "not_enough_amount"
+    to_wallet_not_found = "to_wallet_not_found"
+    max_amount_exceeded = "max_amount_exceeded"
+
+
+class CreditStatus(enum.Enum):
+    """Statuses returned by credit_wallet stored function"""
+
+    ok = "ok"
+    not_found = "not_found"
+    max_amount_exceeded = "max_amount_exceeded"
+
+
+def retry_delay(attempt: int) -> float:
+    """Exponential backoff with full jitter"""
+    delay = settings.db_retry_base_delay * 2 ** attempt
+    return random.uniform(0, min(delay, settings.db_retry_max_delay))
+
+
+async def _in_transaction() -> bool:
+    async with db.connection() as connection:
+        return connection.raw_connection.is_in_transaction()
+
+
+def retry_on_conflict(func):
+    """
+    Run func again when the database aborted it because of deadlock or
+    serialization failure. Func must run its own transaction; when called
+    inside outer transaction the error is raised as is because outer
+    transaction can't be continued
+    """
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        nested = await _in_transaction()
+        attempt = 0
+        while True:
+            try:
+                async with db.connection():
+                    return await func(*args, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                error = type(e).__name__
+                attempt += 1
+                if nested or attempt > settings.db_retry_attempts:
+                    metrics.db_retries.labels(error, "gave_up").inc()
+                    raise
+                metrics.db_retries.labels(error, "retried").inc()
+                logger.warning(
+                    "%s failed with %s; retry %s of %s",
+                    func.__name__,
+                    error,
+                    attempt,
+                    settings.db_retry_attempts,
+                )
+            # the connection goes back to the pool while backing off
+            await asyncio.sleep(retry_delay(attempt))
+
+    return wrapper
+
+
 async def create_account_with_wallet(account: AccountCreateIn) -> AccountCreateOut:
     wallet_id = uuid.uuid4()
     account_id = uuid.uuid4()
@@ -44,175 +137,532 @@ async def create_account_with_wallet(account: AccountCreateIn) -> AccountCreateO
     )
 
 
+async def create_accounts_bulk(
+    accounts: List[AccountCreateIn],
+) -> List[AccountCreateOut]:
+    """
+    Create accounts with wallets in one transaction loading rows with COPY
+    instead of two inserts per account
+    """
+    account_rows = [(uuid.uuid4(), account.name) for account in accounts]
+    wallet_rows = [
+        (uuid.uuid4(), account_id, Currency.USD.value, 0)
+        for account_id, _ in account_rows
+    ]
+    async with db.connection() as connection:
+        async with db.transaction():
+            await connection.raw_connection.copy_records_to_table(
+                "account", records=account_rows, columns=["id", "name"]
+            )
+            await connection.raw_connection.copy_records_to_table(
+                "wallet",
+                records=wallet_rows,
+                columns=["id", "account_id", "currency", "amount"],
+            )
+
+    return [
+        AccountCreateOut(account_id=str(account_id), wallet_id=str(wallet_id))
+        for (account_id, _), (wallet_id, _, _, _) in zip(account_rows, wallet_rows)
+    ]
+
+
 async def get_account_with_wallet(
     account_id: uuid.UUID,
 ) -> ExtendedAccountOut:
-    query = (
-        "SELECT "
-        "account.id as account_id, account.name, "
-        "account.created_at, wallet.id as wallet_id, "
-        "wallet.currency, wallet.amount "
-        "FROM account JOIN wallet "
-        "ON wallet.account_id = account.id  "
-        "WHERE  account.id = :account_id;"
-    )
-
-    values = {"account_id": account_id}
-    row = await db.fetch_one(query=query, values=values)
+    row = await dal.select_account_with_wallet(account_id)
     if row is None:
-        raise NotFound("account", values)
+        raise NotFound("account", {"account_id": account_id})
 
-    return ExtendedAccountOut(
+    # rows are trusted, construct() skips validation
+    return ExtendedAccountOut.construct(
         account_id=row["account_id"],
         name=row["name"],
         wallet_id=row["wallet_id"],
-        currency=row["currency"],
+        currency=Currency(row["currency"]),
         amount=row["amount"],
         created_at=row["created_at"],
     )
 
 
-async def get_wallet(wallet_id, currency):
-    query = (
-        "SELECT * FROM wallet WHERE id = :wallet_id "
-        "AND currency = :currency FOR UPDATE;"
+def _wallet_not_found(wallet_id: uuid.UUID, currency: Currency) -> NotFound:
+    return NotFound("wallet", {"wallet_id": wallet_id, "currency": currency.value})
+
+
+def _encode_cursor(transaction_id: int, posting_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{transaction_id}:{posting_id}".encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> Tuple[int, int]:
+    try:
+        decoded = base64.urlsafe_b64decode(cursor.encode()).decode()
+        transaction_id, posting_id = decoded.split(":")
+        return int(transaction_id), int(posting_id)
+    except ValueError:
+        raise CRUDException(f"invalid cursor '{cursor}'")
+
+
+async def get_postings(
+    wallet_id: uuid.UUID,
+    limit: int,
+    cursor: Optional[str] = None,
+    transaction_type: Optional[TransactionType] = None,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+) -> PostingsPage:
+    """
+    Page of wallet postings, newest transactions first, created in
+    [since, until). Cursor is next_cursor of the previous page
+    """
+    after = _decode_cursor(cursor) if cursor is not None else None
+    # one more row tells whether there is a next page
+    rows = await dal.select_postings(
+        wallet_id,
+        since,
+        until,
+        transaction_type.value if transaction_type is not None else None,
+        limit + 1,
+        after,
     )
-    values = {"wallet_id": wallet_id, "currency": currency.value}
-    wallet = await db.fetch_one(query=query, values=values)
-    if wallet is None:
-        raise NotFound("wallet", values)
-    return wallet
+    if not rows and not await dal.wallet_exists(wallet_id):
+        raise NotFound("wallet", {"wallet_id": wallet_id})
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1]["transaction_id"], rows[-1]["id"])
+    postings = [
+        PostingOut.construct(
+            transaction_id=row["transaction_id"],
+            type=TransactionType(row["type"]),
+            amount=row["amount"],
+            currency=Currency(row["currency"]),
+            created_at=row["created_at"],
+        )
+        for row in rows
+    ]
+    return PostingsPage.construct(postings=postings, next_cursor=next_cursor)
 
 
-async def _log_transfer_transaction(data):
+async def get_balance(wallet_id: uuid.UUID, at: datetime.datetime) -> BalanceOut:
     """
-    MUST BE RUN INSIDE TRANSACTION
-    Save transfer transaction info
-    - one row in transaction table
-    - 2 rows in posting table connected with transaction row
+    Amount of the wallet at the moment (postings created up to it included):
+    the nearest earlier balance snapshot plus postings after it
     """
-    add_transaction = (
-        "INSERT INTO transaction(type) VALUES (:transaction_type) RETURNING id;"
+    row = await dal.select_balance_at(wallet_id, at)
+    if row["currency"] is None:
+        raise NotFound("wallet", {"wallet_id": wallet_id})
+    return BalanceOut.construct(
+        wallet_id=wallet_id,
+        at=at,
+        currency=Currency(row["currency"]),
+        amount=row["amount"],
     )
 
-    transaction_id = await db.execute(
-        add_transaction, values={"transaction_type": TransactionType.transfer.value}
+
+def _not_enough_amount(data: TransferMoneyIn) -> CRUDException:
+    return CRUDException(
+        f"can't transfer {data.amount} {data.from_currency.value} "
+        f"from wallet {data.from_wallet_id}: "
+        f"not enough amount"
     )
-    add_posting = (
-        "INSERT INTO posting(transaction_id, wallet_id, amount, currency) "
-        "VALUES(:transaction_id, :wallet_id, :amount, :currency);"
+
+
+def _max_amount_exceeded(data: TransferMoneyIn, current_amount) -> CRUDException:
+    return CRUDException(
+        f"can't transfer to {data.to_wallet_id}; "
+        f"resulting amount is greater that max amount = {settings.max_amount}; "
+        f"current amount = {current_amount}"
     )
-    values = {
-        "transaction_id": transaction_id,
-        "wallet_id": data.from_wallet_id,
-        "amount": -data.amount,
-        "currency": data.from_currency.value,
-    }
-    await db.execute(add_posting, values=values)
-    values = {
-        "transaction_id": transaction_id,
-        "wallet_id": data.to_wallet_id,
-        "amount": data.amount,
-        "currency": data.to_currency.value,
-    }
-    await db.execute(add_posting, values=values)
 
 
-async def _log_replenish_transaction(data):
+@retry_on_conflict
+async def transfer(data: TransferMoneyIn) -> TransferMoneyOut:
     """
-    MUST BE RUN INSIDE TRANSACTION
-    Save transfer transaction info
-    - one row in transaction table
-    - one row in posting table connected with transaction row
+    Transfer is performed by transfer_money stored function in one round trip,
+    so wallet rows are locked only for the time of the transfer itself
     """
-    add_transaction = (
-        "INSERT INTO transaction(type) VALUES(:transaction_type) RETURNING id;"
+    row = await dal.transfer_money(
+        data.from_wallet_id,
+        data.from_currency.value,
+        data.to_wallet_id,
+        data.to_currency.value,
+        data.amount,
+        settings.max_amount,
+        TransactionType.transfer.value,
     )
-    transaction_id = await db.execute(
-        add_transaction, values={"transaction_type": TransactionType.replenish.value}
+
+    status = TransferStatus(row["status"])
+    if status == TransferStatus.from_wallet_not_found:
+        raise _wallet_not_found(data.from_wallet_id, data.from_currency)
+    if status == TransferStatus.not_enough_amount:
+        raise _not_enough_amount(data)
+    if status == TransferStatus.to_wallet_not_found:
+        raise _wallet_not_found(data.to_wallet_id, data.to_currency)
+    if status == TransferStatus.max_amount_exceeded:
+        raise _max_amount_exceeded(data, row["to_amount"])
+
+    return TransferMoneyOut.construct(
+        from_wallet_id=data.from_wallet_id,
+        from_amount=row["from_amount"],
+        from_currency=data.from_currency,
+        to_wallet_id=data.to_wallet_id,
+        to_amount=row["to_amount"],
+        to_currency=data.to_currency,
     )
-    add_posting = (
+
+
+async def _lock_wallets(wallet_ids) -> Dict[uuid.UUID, dict]:
+    """
+    MUST BE RUN INSIDE TRANSACTION
+    Lock wallets once each in id order (the same order as transfer_money
+    uses, so batches and single transfers don't deadlock each other)
+    """
+    query = (
+        "SELECT id, currency, amount, shards FROM wallet "
+        "WHERE id = ANY(:wallet_ids) ORDER BY id FOR NO KEY UPDATE;"
+    )
+    values = {"wallet_ids": sorted(set(wallet_ids))}
+    with lock_wallets_latency.time():
+        rows = await db.fetch_all(query, values=values)
+    locked_wallets = {
+        row["id"]: dict(row, max_amount=settings.max_amount) for row in rows
+    }
+
+    sharded = sorted(id for id, wallet in locked_wallets.items() if wallet["shards"])
+    if sharded:
+        # shard rows are locked after wallet rows, as in lock_wallet_amount
+        query = (
+            "SELECT wallet_id, sum(amount) AS amount, "
+            "sum(max_amount) AS max_amount FROM ("
+            "SELECT wallet_id, amount, max_amount FROM wallet_shard "
+            "WHERE wallet_id = ANY(:wallet_ids) ORDER BY wallet_id, shard FOR UPDATE"
+            ") AS locked GROUP BY wallet_id;"
+        )
+        with lock_wallets_latency.time():
+            rows = await db.fetch_all(query, values={"wallet_ids": sharded})
+        for row in rows:
+            wallet = locked_wallets[row["wallet_id"]]
+            wallet["amount"] += row["amount"]
+            wallet["max_amount"] = row["max_amount"]
+    return locked_wallets
+
+
+def _shard_max_amount(shards: int) -> decimal.Decimal:
+    """Max amount of every shard row of a wallet split into shards"""
+    quantum = decimal.Decimal(1).scaleb(-settings.decimal_scale)
+    return (settings.max_amount / shards).quantize(quantum, decimal.ROUND_DOWN)
+
+
+def _spread(amount: decimal.Decimal, shards: int) -> List[decimal.Decimal]:
+    """Split amount into shards parts which differ by the smallest unit at most"""
+    unit = decimal.Decimal(1).scaleb(-settings.decimal_scale)
+    base, remainder = divmod(int(amount / unit), shards)
+    return [(base + (shard < remainder)) * unit for shard in range(shards)]
+
+
+async def _update_wallets(locked_wallets: Dict[uuid.UUID, dict], wallet_ids):
+    """
+    MUST BE RUN INSIDE TRANSACTION
+    Save amounts of locked wallets with one statement (and one more for
+    sharded wallets, whose amounts are spread evenly over their shard rows)
+    """
+    wallet_ids = sorted(wallet_ids)
+    plain = [id for id in wallet_ids if not locked_wallets[id]["shards"]]
+    if plain:
+        query = (
+            "UPDATE wallet SET amount = new.amount "
+            "FROM unnest(CAST(:wallet_ids AS uuid[]), CAST(:amounts AS numeric[])) "
+            "AS new(id, amount) WHERE wallet.id = new.id;"
+        )
+        values = {
+            "wallet_ids": plain,
+            "amounts": [locked_wallets[wallet_id]["amount"] for wallet_id in plain],
+        }
+        with update_wallets_latency.time():
+            await db.execute(query, values=values)
+
+    shard_wallet_ids, shards, amounts = [], [], []
+    for wallet_id in wallet_ids:
+        wallet = locked_wallets[wallet_id]
+        if not wallet["shards"]:
+            continue
+        for shard, amount in enumerate(_spread(wallet["amount"], wallet["shards"])):
+            shard_wallet_ids.append(wallet_id)
+            shards.append(shard)
+            amounts.append(amount)
+    if shard_wallet_ids:
+        query = (
+            "UPDATE wallet_shard SET amount = new.amount "
+            "FROM unnest(CAST(:wallet_ids AS uuid[]), CAST(:shards AS integer[]), "
+            "CAST(:amounts AS numeric[])) AS new(wallet_id, shard, amount) "
+            "WHERE wallet_shard.wallet_id = new.wallet_id "
+            "AND wallet_shard.shard = new.shard;"
+        )
+        values = {"wallet_ids": shard_wallet_ids, "shards": shards, "amounts": amounts}
+        with update_wallets_latency.time():
+            await db.execute(query, values=values)
+
+
+async def _log_transactions(transaction_type: TransactionType, postings):
+    """
+    MUST BE RUN INSIDE TRANSACTION
+    Save transactions of one type with one statement
+    - postings is a list of (wallet_id, amount, currency) lists, one per transaction
+    - transaction ids grow in the order of postings
+    """
+    numbers, wallet_ids, amounts, currencies = [], [], [], []
+    for number, transaction_postings in enumerate(postings, start=1):
+        for wallet_id, amount, currency in transaction_postings:
+            numbers.append(number)
+            wallet_ids.append(wallet_id)
+            amounts.append(amount)
+            currencies.append(currency.value)
+
+    query = (
+        "WITH added AS ("
+        "INSERT INTO transaction(type) "
+        "SELECT :transaction_type FROM generate_series(1, :count) RETURNING id"
+        "), numbered AS ("
+        "SELECT id, row_number() OVER (ORDER BY id) AS number FROM added"
+        ") "
         "INSERT INTO posting(transaction_id, wallet_id, amount, currency) "
-        "VALUES(:transaction_id, :wallet_id, :amount, :currency);"
+        "SELECT numbered.id, p.wallet_id, p.amount, p.currency "
+        "FROM unnest(CAST(:numbers AS bigint[]), CAST(:wallet_ids AS uuid[]), "
+        "CAST(:amounts AS numeric[]), CAST(:currencies AS text[])) "
+        "WITH ORDINALITY AS p(number, wallet_id, amount, currency, ord) "
+        "JOIN numbered USING (number) ORDER BY p.ord;"
     )
     values = {
-        "transaction_id": transaction_id,
-        "wallet_id": data.wallet_id,
-        "amount": data.amount,
-        "currency": data.currency.value,
+        "transaction_type": transaction_type.value,
+        "count": len(postings),
+        "numbers": numbers,
+        "wallet_ids": wallet_ids,
+        "amounts": amounts,
+        "currencies": currencies,
     }
-    await db.execute(add_posting, values=values)
+    with insert_ledger_latency.time():
+        await db.execute(query, values=values)
 
 
-async def transfer(data: TransferMoneyIn) -> TransferMoneyOut:
+def _apply_transfer(
+    data: TransferMoneyIn, locked_wallets: Dict[uuid.UUID, dict]
+) -> TransferMoneyOut:
+    """
+    Check transfer against locked wallets the same way transfer_money does
+    and apply it to their amounts
+    """
+    if not data.is_currencies_match():
+        raise CRUDException(f"only {Currency.USD.value} currency is supported")
+
+    from_wallet = locked_wallets.get(data.from_wallet_id)
+    if from_wallet is None or from_wallet["currency"] != data.from_currency.value:
+        raise _wallet_not_found(data.from_wallet_id, data.from_currency)
+    if from_wallet["amount"] - data.amount < 0:
+        raise _not_enough_amount(data)
+
+    to_wallet = locked_wallets.get(data.to_wallet_id)
+    if to_wallet is None or to_wallet["currency"] != data.to_currency.value:
+        raise _wallet_not_found(data.to_wallet_id, data.to_currency)
+    if to_wallet["amount"] + data.amount > to_wallet["max_amount"]:
+        raise _max_amount_exceeded(data, to_wallet["amount"])
+
+    from_wallet["amount"] -= data.amount
+    from_amount = from_wallet["amount"]
+    to_wallet["amount"] += data.amount
+    return TransferMoneyOut.construct(
+        from_wallet_id=data.from_wallet_id,
+        from_amount=from_amount,
+        from_currency=data.from_currency,
+        to_wallet_id=data.to_wallet_id,
+        to_amount=to_wallet["amount"],
+        to_currency=data.to_currency,
+    )
+
+
+async def _run_batch(items, mode: BatchMode, apply, postings, transaction_type):
+    """
+    Lock wallets of all items once, apply items one by one and save applied
+    items with one update of wallets and one insert of transactions.
+    - apply(item, locked_wallets) checks item, changes locked wallets amounts
+      and returns item result or raises CRUDException
+    - postings(item) returns (wallet_id, amount, currency) list of the item
+    """
     async with db.transaction():
-        # getting from wallet and check constraints
-        from_wallet = await get_wallet(data.from_wallet_id, data.from_currency)
-        from_wallet_amount = from_wallet["amount"] - data.amount
-        if from_wallet_amount < 0:
-            raise CRUDException(
-                f"can't transfer {data.amount} {data.from_currency.value} "
-                f"from wallet {data.from_wallet_id}: "
-                f"not enough amount"
-            )
+        wallet_ids = set()
+        for item in items:
+            wallet_ids.update(wallet_id for wallet_id, _, _ in postings(item))
+        locked_wallets = await _lock_wallets(wallet_ids)
 
-        # getting to wallet and check constraints
-        to_wallet = await get_wallet(data.to_wallet_id, data.to_currency)
-        to_wallet_amount = to_wallet["amount"] + data.amount
-        if to_wallet_amount > settings.max_amount:
-            raise CRUDException(
-                f"can't transfer to {data.to_wallet_id}; "
-                f"resulting amount is greater that max amount = {settings.max_amount}; "
-                f"current amount = {to_wallet['amount']}"
-            )
+        results = []
+        for item in items:
+            try:
+                results.append(apply(item, locked_wallets))
+            except CRUDException as e:
+                results.append(e)
+
+        failed = [i for i, r in enumerate(results) if isinstance(r, CRUDException)]
+        if failed and mode == BatchMode.atomic:
+            rolled_back = BatchRolledBack(f"not applied: item #{failed[0]} failed")
+            return [r if isinstance(r, CRUDException) else rolled_back for r in results]
+
+        applied = [
+            postings(item)
+            for item, result in zip(items, results)
+            if not isinstance(result, CRUDException)
+        ]
+        if applied:
+            changed = {wallet_id for p in applied for wallet_id, _, _ in p}
+            await _update_wallets(locked_wallets, changed)
+            await _log_transactions(transaction_type, applied)
+        return results
 
-        # performing transfer transaction
-        update_wallet = "UPDATE wallet SET amount = :amount WHERE id = :wallet_id;"
-        from_wallet_values = {
-            "wallet_id": data.from_wallet_id,
-            "amount": from_wallet_amount,
-        }
-        await db.execute(query=update_wallet, values=from_wallet_values)
-        to_wallet_values = {"wallet_id": data.to_wallet_id, "amount": to_wallet_amount}
-        await db.execute(query=update_wallet, values=to_wallet_values)
-
-        # logging transaction
-        await _log_transfer_transaction(data)
-
-        return TransferMoneyOut(
-            from_wallet_id=data.from_wallet_id,
-            from_amount=from_wallet_amount,
-            from_currency=data.from_currency,
-            to_wallet_id=data.to_wallet_id,
-            to_amount=to_wallet_amount,
-            to_currency=data.to_currency,
-        )
+
+def _transfer_postings(data: TransferMoneyIn):
+    return [
+        (data.from_wallet_id, -data.amount, data.from_currency),
+        (data.to_wallet_id, data.amount, data.to_currency),
+    ]
+
+
+@retry_on_conflict
+async def transfer_batch(
+    transfers: List[TransferMoneyIn], mode: BatchMode
+) -> List[Union[TransferMoneyOut, CRUDException]]:
+    """
+    Perform transfers in one transaction and return result or error of each.
+    In atomic mode nothing is saved if any transfer fails, in independent mode
+    failed transfers are skipped
+    """
+    return await _run_batch(
+        transfers,
+        mode,
+        _apply_transfer,
+        _transfer_postings,
+        TransactionType.transfer,
+    )
+
+
+def _replenish_max_amount_exceeded(
+    data: ReplenishWalletInfo, current_amount
+) -> CRUDException:
+    return CRUDException(
+        f"can't replenish to {data.wallet_id}; "
+        f"resulting amount is greater that max amount = {settings.max_amount}; "
+        f"current amount = {current_amount}"
+    )
+
+
+def _apply_replenish(
+    data: ReplenishWalletInfo, locked_wallets: Dict[uuid.UUID, dict]
+) -> ReplenishWalletInfo:
+    """Check replenish against locked wallet the same way replenish does and apply it"""
+    wallet = locked_wallets.get(data.wallet_id)
+    if wallet is None or wallet["currency"] != data.currency.value:
+        raise _wallet_not_found(data.wallet_id, data.currency)
+    if wallet["amount"] + data.amount > wallet["max_amount"]:
+        raise _replenish_max_amount_exceeded(data, wallet["amount"])
+
+    wallet["amount"] += data.amount
+    return ReplenishWalletInfo.construct(
+        wallet_id=data.wallet_id, amount=wallet["amount"], currency=data.currency
+    )
+
+
+def _replenish_postings(data: ReplenishWalletInfo):
+    return [(data.wallet_id, data.amount, data.currency)]
+
+
+@retry_on_conflict
+async def replenish_batch(
+    replenishments: List[ReplenishWalletInfo], mode: BatchMode
+) -> List[Union[ReplenishWalletInfo, CRUDException]]:
+    """
+    Replenish wallets in one transaction and return result or error of each.
+    Several replenishments of one wallet are applied in order, each of them
+    checked against max amount
+    """
+    return await _run_batch(
+        replenishments,
+        mode,
+        _apply_replenish,
+        _replenish_postings,
+        TransactionType.replenish,
+    )
 
 
 async def replenish(data: ReplenishWalletInfo):
+    """
+    Replenishment is checked and applied by credit_wallet stored function,
+    which credits a sharded wallet without locking its wallet row
+    """
     async with db.transaction():
-        query = (
-            "SELECT * FROM wallet WHERE id = :wallet_id "
-            "AND currency = :currency FOR UPDATE;"
+        row = await dal.credit_wallet(
+            data.wallet_id, data.currency.value, data.amount, settings.max_amount
+        )
+
+        status = CreditStatus(row["status"])
+        if status == CreditStatus.not_found:
+            raise _wallet_not_found(data.wallet_id, data.currency)
+        if status == CreditStatus.max_amount_exceeded:
+            raise _replenish_max_amount_exceeded(data, row["amount"])
+
+        await dal.insert_transaction_with_posting(
+            TransactionType.replenish.value,
+            data.wallet_id,
+            data.amount,
+            data.currency.value,
+        )
+        return ReplenishWalletInfo.construct(
+            wallet_id=data.wallet_id, amount=row["amount"], currency=data.currency
         )
 
-        values = {"wallet_id": data.wallet_id, "currency": data.currency.value}
-        wallet = await db.fetch_one(query=query, values=values)
+
+async def shard_wallet(wallet_id: uuid.UUID, shards: int) -> decimal.Decimal:
+    """
+    Split amount of the wallet over shards wallet_shard rows (0 merges them
+    back into the wallet row) and return the amount. Transfers and
+    replenishments of the wallet wait for the change
+    """
+    if shards < 0:
+        raise CRUDException("number of shards can't be negative")
+    async with db.transaction():
+        wallet = (await _lock_wallets([wallet_id])).get(wallet_id)
         if wallet is None:
-            raise NotFound("wallet", values)
-
-        amount = wallet["amount"] + data.amount
-        if amount > settings.max_amount:
-            raise CRUDException(
-                f"can't replenish to {data.wallet_id}; "
-                f"resulting amount is greater that max amount = {settings.max_amount}; "
-                f"current amount = {wallet['amount']}"
-            )
+            raise NotFound("wallet", {"wallet_id": wallet_id})
+        amount = wallet["amount"]
 
-        update = "UPDATE wallet SET amount = :amount WHERE id = :wallet_id;"
-        values = {"amount": amount, "wallet_id": data.wallet_id}
-        await db.execute(update, values=values)
-        await _log_replenish_transaction(data)
-        return ReplenishWalletInfo(
-            wallet_id=data.wallet_id, amount=amount, currency=data.currency
+        await db.execute(
+            "DELETE FROM wallet_shard WHERE wallet_id = :wallet_id;",
+            {"wallet_id": wallet_id},
+        )
+        if shards:
+            max_amount = _shard_max_amount(shards)
+            if amount > max_amount * shards:
+                raise CRUDException(
+                    f"amount {amount} of wallet {wallet_id} "
+                    f"doesn't fit into {shards} shards"
+                )
+            await db.execute_many(
+                "INSERT INTO wallet_shard(wallet_id, shard, amount, max_amount) "
+                "VALUES (:wallet_id, :shard, :amount, :max_amount);",
+                [
+                    {
+                        "wallet_id": wallet_id,
+                        "shard": shard,
+                        "amount": shard_amount,
+                        "max_amount": max_amount,
+                    }
+                    for shard, shard_amount in enumerate(_spread(amount, shards))
+                ],
+            )
+        values = {
+            "wallet_id": wallet_id,
+            "amount": 0 if shards else amount,
+            "shards": shards,
+        }
+        await db.execute(
+            "UPDATE wallet SET amount = :amount, shards = :shards "
+            "WHERE id = :wallet_id;",
+            values,
         )
+    return amount
@@ -0,0 +1,209 @@
+"""
+Hot statements of crud executed by asyncpg directly: positional arguments,
+binary codecs and no SQLAlchemy compilation and result mapping of databases.
+asyncpg prepares every statement on first use on a connection and keeps it
+in the connection statement cache (settings.db_statement_cache_size), so
+statements below are parsed and planned once per pool connection.
+All functions run on the connection of the current databases context, so
+they take part in the transaction started by db.transaction(); reads run on
+the database of the request (app.replicas)
+"""
+import datetime
+import decimal
+import functools
+import uuid
+from typing import List, Optional, Tuple
+
+import asyncpg
+
+from app import metrics, replicas
+from app.database import db
+
+# amount of sharded wallet is the sum of its shard rows
+WALLET_AMOUNT = (
+    "CASE WHEN wallet.shards > 0 THEN "
+    "(SELECT sum(wallet_shard.amount) FROM wallet_shard "
+    "WHERE wallet_shard.wallet_id = wallet.id) "
+    "ELSE wallet.amount END"
+)
+SELECT_ACCOUNT_WITH_WALLET = (
+    "SELECT "
+    "account.id AS account_id, account.name, "
+    "account.created_at, wallet.id AS wallet_id, "
+    f"wallet.currency, {WALLET_AMOUNT} AS amount "
+    "FROM account JOIN wallet ON wallet.account_id = account.id "
+    "WHERE account.id = $1;"
+)
+INSERT_TRANSACTION_WITH_POSTING = (
+    "WITH new_transaction AS ("
+    "INSERT INTO transaction(type) VALUES ($1) RETURNING id"
+    ") "
+    "INSERT INTO posting(transaction_id, wallet_id, amount, currency) "
+    "SELECT id, $2, $3, $4 FROM new_transaction;"
+)
+CREDIT_WALLET = "SELECT status, amount FROM credit_wallet($1, $2, $3, $4);"
+TRANSFER_MONEY = (
+    "SELECT status, from_amount, to_amount "
+    "FROM transfer_money($1, $2, $3, $4, $5, $6, $7);"
+)
+# type is looked up per posting row in index order (a join estimated to
+# return few rows is planned as hash join of whole tables)
+TRANSACTION_TYPE = (
+    "(SELECT type FROM transaction "
+    "WHERE transaction.id = posting.transaction_id "
+    "AND transaction.created_at = posting.created_at)"
+)
+SELECT_WALLET_EXISTS = "SELECT EXISTS (SELECT 1 FROM wallet WHERE id = $1);"
+SELECT_BALANCE_AT = "SELECT currency, amount FROM wallet_balance_at($1, $2);"
+
+# labels are bound once, labels() lookup on every call is not free
+select_account_latency = metrics.query_latency.labels("select_account")
+credit_wallet_latency = metrics.query_latency.labels("credit_wallet")
+insert_ledger_latency = metrics.query_latency.labels("insert_ledger")
+transfer_money_latency = metrics.query_latency.labels("transfer_money")
+select_postings_latency = metrics.query_latency.labels("select_postings")
+select_balance_latency = metrics.query_latency.labels("select_balance")
+
+
+async def select_account_with_wallet(
+    account_id: uuid.UUID,
+) -> Optional[asyncpg.Record]:
+    async with replicas.database().connection() as connection:
+        with select_account_latency.time():
+            return await connection.raw_connection.fetchrow(
+                SELECT_ACCOUNT_WITH_WALLET, account_id
+            )
+
+
+async def credit_wallet(
+    wallet_id: uuid.UUID,
+    currency: str,
+    amount: decimal.Decimal,
+    max_amount: decimal.Decimal,
+) -> asyncpg.Record:
+    async with db.connection() as connection:
+        with credit_wallet_latency.time():
+            return await connection.raw_connection.fetchrow(
+                CREDIT_WALLET, wallet_id, currency, amount, max_amount
+            )
+
+
+async def insert_transaction_with_posting(
+    transaction_type: str,
+    wallet_id: uuid.UUID,
+    amount: decimal.Decimal,
+    currency: str,
+):
+    async with db.connection() as connection:
+        with insert_ledger_latency.time():
+            await connection.raw_connection.execute(
+                INSERT_TRANSACTION_WITH_POSTING,
+                transaction_type,
+                wallet_id,
+                amount,
+                currency,
+            )
+
+
+async def transfer_money(
+    from_wallet_id: uuid.UUID,
+    from_currency: str,
+    to_wallet_id: uuid.UUID,
+    to_currency: str,
+    amount: decimal.Decimal,
+    max_amount: decimal.Decimal,
+    transaction_type: str,
+) -> asyncpg.Record:
+    async with db.connection() as connection:
+        with transfer_money_latency.time():
+            return await connection.raw_connection.fetchrow(
+                TRANSFER_MONEY,
+                from_wallet_id,
+                from_currency,
+                to_wallet_id,
+                to_currency,
+                amount,
+                max_amount,
+                transaction_type,
+            )
+
+
+@functools.lru_cache()
+def _select_postings_query(
+    since: bool, until: bool, transaction_type: bool, after: bool
+) -> str:
+    # a statement per combination of filters: "$n IS NULL OR" conditions
+    # make generic plans of prepared statements sort all wallet postings
+    # $1 is wallet_id, $2 is limit
+    conditions = ["posting.wallet_id = $1"]
+    if since:
+        conditions.append(f"posting.created_at >= ${len(conditions) + 2}")
+    if until:
+        conditions.append(f"posting.created_at < ${len(conditions) + 2}")
+    if transaction_type:
+        conditions.append(f"{TRANSACTION_TYPE} = ${len(conditions) + 2}")
+    if after:
+        conditions.append(
+            "(posting.transaction_id, posting.id) < "
+            f"(${len(conditions) + 2}, ${len(conditions) + 3})"
+        )
+    # newest first; the page after a cursor starts with an index seek, so its
+    # time doesn't depend on the number of pages before it
+    return (
+        "SELECT "
+        "posting.id, posting.transaction_id, "
+        f"{TRANSACTION_TYPE} AS type, "
+        "posting.amount, posting.currency, posting.created_at "
+        "FROM posting "
+        f"WHERE {' AND '.join(conditions)} "
+        "ORDER BY posting.transaction_id DESC, posting.id DESC "
+        "LIMIT $2;"
+    )
+
+
+async def select_postings(
+    wallet_id: uuid.UUID,
+    since: Optional[datetime.datetime],
+    until: Optional[datetime.datetime],
+    transaction_type: Optional[str],
+    limit: int,
+    after: Optional[Tuple[int, int]] = None,
+) -> List[asyncpg.Record]:
+    """Postings of the wallet before after=(transaction_id, posting id)"""
+    query = _select_postings_query(
+        since is not None,
+        until is not None,
+        transaction_type is not None,
+        after is not None,
+    )
+    args = [wallet_id, limit]
+    args.extend(arg for arg in (since, until, transaction_type) if arg is not None)
+    if after is not None:
+        args.extend(after)
+    async with replicas.database().connection() as connection:
+        raw_connection = connection.raw_connection
+        with select_postings_latency.time():
+            if since is None or until is None:
+                return await raw_connection.fetch(query, *args)
+            # generic plan estimates created_at between two parameters at
+            # 0.5% of rows and sorts whole range instead of reading one page
+            async with raw_connection.transaction():
+                await raw_connection.execute(
+                    "SET LOCAL plan_cache_mode = force_custom_plan;"
+                )
+                return await raw_connection.fetch(query, *args)
+
+
+async def wallet_exists(wallet_id: uuid.UUID) -> bool:
+    async with replicas.database().connection() as connection:
+        return await connection.raw_connection.fetchval(SELECT_WALLET_EXISTS, wallet_id)
+
+
+async def select_balance_at(
+    wallet_id: uuid.UUID, at: datetime.datetime
+) -> asyncpg.Record:
+    async with replicas.database().connection() as connection:
+        with select_balance_latency.time():
+            return await connection.raw_connection.fetchrow(
+                SELECT_BALANCE_AT, wallet_id, at
+            )
@@ -1,9 +1,17 @@
-import databases
 from sqlalchemy import MetaData
 
 from app.config import settings
+from app.pool import Database
 
 metadata = MetaData()
 
 
-db = databases.Database(settings.db_url, force_rollback=settings.is_testing)
+db = Database(
+    settings.db_url,
+    force_rollback=settings.is_testing,
+    min_size=settings.db_pool_min_size,
+    max_size=settings.db_pool_max_size,
+    acquire_timeout=settings.db_pool_acquire_timeout,
+    max_lifetime=settings.db_pool_max_lifetime,
+    statement_cache_size=settings.db_statement_cache_size,
+)
@@ -1,6 +1,7 @@
-from sqlalchemy import (Column, DateTime, ForeignKey, Integer, Numeric, String,
-                        Table, func)
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import (BigInteger, CheckConstraint, Column, Date, DateTime,
+                        ForeignKey, Index, Integer, Numeric, SmallInteger,
+                        String, Table, func, text)
+from sqlalchemy.dialects.postgresql import JSONB, UUID
 
 from app.config import settings
 from app.database import metadata
@@ -24,7 +25,7 @@ wallets = Table(
     "wallet",
     metadata,
     Column("id", UUID(as_uuid=True), primary_key=True),
-    Column("account_id", ForeignKey("account.id"), nullable=False),
+    Column("account_id", ForeignKey("account.id"), nullable=False, index=True),
     Column("currency", ForeignKey("currency.code"), nullable=False),
     Column(
         "amount",
@@ -35,25 +36,59 @@ wallets = Table(
         "created_at", DateTime(timezone=True), server_default=func.now(), nullable=False
     ),
     Column("updated_at", DateTime(timezone=True), onupdate=func.now()),
+    # number of wallet_shard rows holding the amount of a sharded wallet
+    # (amount is 0 then), 0 for ordinary wallets
+    Column("shards", Integer, server_default="0", nullable=False),
+)
+
+# sub-balances of sharded wallet: credits go to one random shard row, so
+# transfers to a hot wallet don't wait for the lock of its wallet row;
+# every row is limited by its part of max amount
+wallet_shards = Table(
+    "wallet_shard",
+    metadata,
+    Column("wallet_id", ForeignKey("wallet.id"), primary_key=True),
+    Column("shard", Integer, primary_key=True),
+    Column(
+        "amount",
+        Numeric(precision=settings.decimal_precision, scale=settings.decimal_scale),
+        nullable=False,
+    ),
+    Column(
+        "max_amount",
+        Numeric(precision=settings.decimal_precision, scale=settings.decimal_scale),
+        nullable=False,
+    ),
+    CheckConstraint("amount >= 0 AND amount <= max_amount"),
 )
 
 currencies = Table("currency", metadata, Column("code", String(3), primary_key=True))
 
+# transaction and posting are partitioned by month of created_at (see
+# app.partitions), so created_at is a part of primary keys;
+# posting.created_at is created_at of its transaction; ids are time-ordered
+# (milliseconds since 2026-01-01 and 12 bits of ledger_id_seq), made by
+# next_ledger_id() of the database
 transactions = Table(
     "transaction",
     metadata,
-    Column("id", Integer, primary_key=True),
+    Column("id", BigInteger, server_default=text("next_ledger_id()"), primary_key=True),
     Column("type", String, nullable=False),
     Column(
-        "created_at", DateTime(timezone=True), server_default=func.now(), nullable=False
+        "created_at",
+        DateTime(timezone=True),
+        server_default=func.now(),
+        nullable=False,
+        primary_key=True,
     ),
+    postgresql_partition_by="RANGE (created_at)",
 )
 
 posting = Table(
     "posting",
     metadata,
-    Column("id", Integer, primary_key=True),
-    Column("transaction_id", ForeignKey("transaction.id"), nullable=False),
+    Column("id", BigInteger, server_default=text("next_ledger_id()"), primary_key=True),
+    Column("transaction_id", BigInteger, nullable=False, index=True),
     Column("wallet_id", ForeignKey("wallet.id"), nullable=False),
     Column(
         "amount",
@@ -61,4 +96,120 @@ posting = Table(
         nullable=False,
     ),
     Column("currency", ForeignKey("currency.code"), nullable=False),
+    Column(
+        "created_at",
+        DateTime(timezone=True),
+        server_default=func.now(),
+        nullable=False,
+        primary_key=True,
+    ),
+    # wallet history in keyset order; the migration also includes amount,
+    # currency and created_at into the index
+    Index("ix_posting_wallet_id_transaction_id", "wallet_id", "transaction_id", "id"),
+    # postings of a wallet after its balance snapshot (with amount included)
+    # and postings of a snapshot period
+    Index("ix_posting_wallet_id_created_at", "wallet_id", "created_at"),
+    Index("ix_posting_created_at", "created_at", postgresql_using="brin"),
+    postgresql_partition_by="RANGE (created_at)",
+)
+
+# responses of write requests made with Idempotency-Key header;
+# saved in the same transaction as the operation itself
+idempotency_keys = Table(
+    "idempotency_key",
+    metadata,
+    Column("endpoint", String, primary_key=True),
+    Column("key", String(255), primary_key=True),
+    Column("request_hash", String(64), nullable=False),
+    Column("status_code", Integer, nullable=False),
+    Column("response", JSONB, nullable=False),
+    Column(
+        "created_at", DateTime(timezone=True), server_default=func.now(), nullable=False
+    ),
+    Column("expires_at", DateTime(timezone=True), nullable=False, index=True),
+)
+
+# ledger balance of wallets summed by reconciliation up to the posting id of
+# the checkpoint of their wallet id range (see app.reconciliation)
+reconciled_balances = Table(
+    "reconciled_balance",
+    metadata,
+    Column("wallet_id", ForeignKey("wallet.id"), primary_key=True),
+    Column(
+        "amount",
+        Numeric(precision=settings.decimal_precision, scale=settings.decimal_scale),
+        nullable=False,
+    ),
+)
+
+reconciliation_checkpoints = Table(
+    "reconciliation_checkpoint",
+    metadata,
+    Column("wallet_id_from", UUID(as_uuid=True), primary_key=True),
+    Column("wallet_id_to", UUID(as_uuid=True), primary_key=True),
+    Column("posting_id", BigInteger, nullable=False),
+    Column(
+        "created_at", DateTime(timezone=True), server_default=func.now(), nullable=False
+    ),
+)
+
+# balance of wallets at period boundaries (see app.snapshots); a wallet has
+# a row only for periods with its postings
+balance_snapshots = Table(
+    "balance_snapshot",
+    metadata,
+    Column("wallet_id", ForeignKey("wallet.id"), primary_key=True),
+    Column("taken_at", DateTime(timezone=True), primary_key=True),
+    Column(
+        "amount",
+        Numeric(precision=settings.decimal_precision, scale=settings.decimal_scale),
+        nullable=False,
+    ),
+)
+
+# period boundaries whose snapshots are taken
+balance_snapshot_runs = Table(
+    "balance_snapshot_run",
+    metadata,
+    Column("taken_at", DateTime(timezone=True), primary_key=True),
+    Column("wallets", Integer, nullable=False),
+    Column(
+        "created_at", DateTime(timezone=True), server_default=func.now(), nullable=False
+    ),
+)
+
+# ledger and account events written by triggers in the transaction of their
+# rows (see app.outbox); id is the offset of the event
+outbox = Table(
+    "outbox",
+    metadata,
+    Column("id", BigInteger, server_default=text("next_ledger_id()"), primary_key=True),
+    Column("type", String, nullable=False),
+    Column("payload", JSONB, nullable=False),
+    Column(
+        "created_at", DateTime(timezone=True), server_default=func.now(), nullable=False
+    ),
+)
+
+# offset of the last event delivered to each sink
+outbox_relays = Table(
+    "outbox_relay",
+    metadata,
+    Column("name", String, primary_key=True),
+    Column("delivered_id", BigInteger, server_default="0", nullable=False),
+    Column("delivered_at", DateTime(timezone=True)),
+)
+
+# counters of ledger_stats_postings trigger (see app.ledger_stats), split into
+# shard rows of every day and currency
+ledger_stats = Table(
+    "ledger_stats",
+    metadata,
+    Column("day", Date, primary_key=True),
+    Column("currency", String(3), primary_key=True),
+    Column("shard", SmallInteger, primary_key=True),
+    Column("transfers", BigInteger, server_default="0", nullable=False),
+    Column("transfer_volume", Numeric, server_default="0", nullable=False),
+    Column("replenishments", BigInteger, server_default="0", nullable=False),
+    Column("replenished", Numeric, server_default="0", nullable=False),
 )
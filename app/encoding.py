@@ -0,0 +1,137 @@
+"""
+JSON responses of models built from trusted database rows (Model.construct).
+Output is byte for byte the same as FastAPI response_model serialization
+(jsonable_encoder + JSONResponse): Decimal as float, UUID and datetime as
+strings, enums by value. But the model is not validated again and not walked
+generically: encoder of every model class is built once from its fields
+"""
+
+import datetime
+import decimal
+import enum
+import json
+import uuid
+from json.encoder import encode_basestring
+from typing import Callable, Dict, Type
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+from pydantic.fields import SHAPE_LIST, SHAPE_SINGLETON, ModelField
+from pydantic.json import ENCODERS_BY_TYPE
+from starlette.responses import Response
+
+Encoder = Callable[[object], str]
+
+_decimal_to_number = ENCODERS_BY_TYPE[decimal.Decimal]
+
+_model_encoders: Dict[Type[BaseModel], Encoder] = {}
+
+
+def _dumps(value) -> str:
+    # the same options as starlette JSONResponse
+    return json.dumps(
+        jsonable_encoder(value),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    )
+
+
+def _encode_decimal(value: decimal.Decimal) -> str:
+    # float, or int for decimals without fraction in newer pydantic versions;
+    # json encodes numbers with their __repr__
+    number = _decimal_to_number(value)
+    if isinstance(number, float):
+        return float.__repr__(number)
+    return int.__repr__(number)
+
+
+def _encode_uuid(value: uuid.UUID) -> str:
+    return f'"{value}"'
+
+
+def _encode_datetime(value: datetime.datetime) -> str:
+    return f'"{value.isoformat()}"'
+
+
+def _encode_enum(value: enum.Enum) -> str:
+    if isinstance(value.value, str):
+        return encode_basestring(value.value)
+    return _dumps(value.value)
+
+
+def _type_encoder(type_) -> Encoder:
+    if isinstance(type_, type):
+        if issubclass(type_, BaseModel):
+            return _model_encoder(type_)
+        if issubclass(type_, enum.Enum):
+            return _encode_enum
+        if issubclass(type_, str):
+            return encode_basestring
+        if issubclass(type_, decimal.Decimal):
+            return _encode_decimal
+        if issubclass(type_, uuid.UUID):
+            return _encode_uuid
+        if issubclass(type_, datetime.datetime):
+            return _encode_datetime
+    return _dumps
+
+
+def _field_encoder(field: ModelField) -> Encoder:
+    encode = _type_encoder(field.type_)
+    if field.shape == SHAPE_LIST:
+        encode_item = encode
+
+        def encode(values):
+            return "[" + ",".join([encode_item(value) for value in values]) + "]"
+
+    elif field.shape != SHAPE_SINGLETON:
+        encode = _dumps
+
+    if field.allow_none:
+        encode_value = encode
+
+        def encode(value):
+            return "null" if value is None else encode_value(value)
+
+    return encode
+
+
+def _model_encoder(model_class: Type[BaseModel]) -> Encoder:
+    encoder = _model_encoders.get(model_class)
+    if encoder is not None:
+        return encoder
+
+    fields = []
+
+    def encode_model(model):
+        if not fields:
+            return "{}"
+        values = model.__dict__
+        return (
+            "".join([key + encode(values[name]) for name, key, encode in fields]) + "}"
+        )
+
+    # registered before fields are filled in, so recursive models work
+    _model_encoders[model_class] = encode_model
+    for i, (name, field) in enumerate(model_class.__fields__.items()):
+        key = ("{" if i == 0 else ",") + encode_basestring(field.alias) + ":"
+        fields.append((name, key, _field_encoder(field)))
+    return encode_model
+
+
+def encode(model: BaseModel) -> bytes:
+    return _model_encoder(type(model))(model).encode("utf-8")
+
+
+class ModelResponse(Response):
+    """
+    Response with model encoded by encode(), returned from endpoints instead
+    of the model itself so FastAPI doesn't validate and serialize it again
+    """
+
+    media_type = "application/json"
+
+    def render(self, content: BaseModel) -> bytes:
+        return encode(content)
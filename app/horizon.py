@@ -0,0 +1,51 @@
+"""
+Horizon of ledger ids: the id up to which all rows with ids made by
+next_ledger_id() (transaction, posting, outbox) are committed or rolled
+back, so readers of ids up to it never see a smaller id appear later.
+Ids are made by the database clock, so ids made up to now are up to
+ledger_id_floor(now) - 1; any of them may belong to a running transaction,
+which is waited for. Rows get their ids after the first row written by
+their transaction (the transaction row, the posting, the wallet), so the
+transaction already has its xid
+"""
+import asyncio
+import time
+
+import asyncpg
+
+SELECT_HORIZON = "SELECT ledger_id_floor(clock_timestamp()) - 1;"
+# every transaction holds the lock of its xid from its assignment until it
+# ends (pg_current_snapshot() misses xids above the latest completed one)
+SELECT_RUNNING_XIDS = (
+    "SELECT coalesce(array_agg(transactionid::text), '{}') FROM pg_locks "
+    "WHERE locktype = 'transactionid' AND mode = 'ExclusiveLock' AND granted "
+    "AND pid <> pg_backend_pid();"
+)
+SELECT_STILL_RUNNING_XIDS = (
+    "SELECT coalesce(array_agg(transactionid::text), '{}') FROM pg_locks "
+    "WHERE locktype = 'transactionid' AND mode = 'ExclusiveLock' AND granted "
+    "AND transactionid::text = ANY($1::text[]);"
+)
+
+
+class HorizonTimeout(Exception):
+    pass
+
+
+async def wait_for_horizon(connection: asyncpg.Connection, timeout: float) -> int:
+    """
+    Id of now after transactions running at this moment end, waiting for
+    them timeout seconds at most
+    """
+    horizon = await connection.fetchval(SELECT_HORIZON)
+    xids = await connection.fetchval(SELECT_RUNNING_XIDS)
+    deadline = time.monotonic() + timeout
+    while xids:
+        if time.monotonic() > deadline:
+            raise HorizonTimeout(
+                f"transactions {', '.join(xids)} are running longer than "
+                f"{timeout} seconds"
+            )
+        await asyncio.sleep(0.01)
+        xids = await connection.fetchval(SELECT_STILL_RUNNING_XIDS, xids)
+    return horizon
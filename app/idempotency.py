@@ -0,0 +1,126 @@
+import asyncio
+import datetime
+import hashlib
+import json
+import logging
+from typing import NamedTuple, Optional
+
+from pydantic import BaseModel
+
+from app.cache import TTLCache
+from app.config import settings
+from app.database import db
+
+logger = logging.getLogger(__name__)
+
+
+class StoredResponse(NamedTuple):
+    request_hash: str
+    status_code: int
+    body: object
+
+
+class KeyReused(Exception):
+    def __init__(self, key: str):
+        self.message = f"Idempotency-Key '{key}' is already used for another request"
+        super().__init__(self.message)
+
+
+class KeyTaken(Exception):
+    """Concurrent request with the same key saved its response first"""
+
+
+# answers hot replays without going to the database
+cache = TTLCache(settings.idempotency_cache_size, settings.idempotency_key_ttl)
+
+
+def request_hash(data: BaseModel) -> str:
+    return hashlib.sha256(data.json(sort_keys=True).encode()).hexdigest()
+
+
+async def get_response(
+    endpoint: str, key: str, data_hash: str
+) -> Optional[StoredResponse]:
+    """Get response saved for the key, raise KeyReused if request differs"""
+    stored = cache.get((endpoint, key))
+    if stored is None:
+        query = (
+            "SELECT request_hash, status_code, response, "
+            "extract(epoch FROM expires_at - now()) AS ttl FROM idempotency_key "
+            "WHERE endpoint = :endpoint AND key = :key AND expires_at > now();"
+        )
+        row = await db.fetch_one(query, values={"endpoint": endpoint, "key": key})
+        if row is None:
+            return None
+        stored = StoredResponse(
+            row["request_hash"], row["status_code"], json.loads(row["response"])
+        )
+        # not replayed after the key expires
+        cache.set((endpoint, key), stored, ttl=float(row["ttl"]))
+
+    if stored.request_hash != data_hash:
+        raise KeyReused(key)
+    return stored
+
+
+async def save_response(endpoint: str, key: str, response: StoredResponse):
+    """
+    MUST BE RUN INSIDE TRANSACTION of the operation
+    Save response for the key, raise KeyTaken if it's already saved
+    (expired keys which are not purged yet are overwritten)
+    """
+    query = (
+        "INSERT INTO idempotency_key"
+        "(endpoint, key, request_hash, status_code, response, expires_at) "
+        "VALUES (:endpoint, :key, :request_hash, :status_code, "
+        "CAST(:response AS jsonb), :expires_at) "
+        "ON CONFLICT (endpoint, key) DO UPDATE SET "
+        "request_hash = excluded.request_hash, status_code = excluded.status_code, "
+        "response = excluded.response, created_at = now(), "
+        "expires_at = excluded.expires_at "
+        "WHERE idempotency_key.expires_at <= now() "
+        "RETURNING key;"
+    )
+    expires_at = datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(
+        seconds=settings.idempotency_key_ttl
+    )
+    values = {
+        "endpoint": endpoint,
+        "key": key,
+        "request_hash": response.request_hash,
+        "status_code": response.status_code,
+        "response": json.dumps(response.body),
+        "expires_at": expires_at,
+    }
+    if await db.execute(query, values=values) is None:
+        raise KeyTaken()
+
+
+async def purge_expired() -> int:
+    """Delete expired keys by small batches, return number of deleted keys"""
+    query = (
+        "WITH expired AS ("
+        "SELECT endpoint, key FROM idempotency_key WHERE expires_at <= now() "
+        "LIMIT :limit FOR UPDATE SKIP LOCKED"
+        ") "
+        "DELETE FROM idempotency_key USING expired "
+        "WHERE idempotency_key.endpoint = expired.endpoint "
+        "AND idempotency_key.key = expired.key "
+        "RETURNING 1;"
+    )
+    deleted = 0
+    while True:
+        rows = await db.fetch_all(query, values={"limit": 1000})
+        deleted += len(rows)
+        if len(rows) < 1000:
+            return deleted
+
+
+async def purge_periodically():
+    while True:
+        await asyncio.sleep(settings.idempotency_purge_interval)
+        try:
+            deleted = await purge_expired()
+            logger.info("%s expired idempotency keys purged", deleted)
+        except Exception as e:
+            logger.exception(e)
@@ -0,0 +1,156 @@
+"""
+System-wide ledger statistics: numbers and amounts of transfers and
+replenishments per day (UTC) and currency. They are counters in ledger_stats,
+which a trigger on posting adds to in the transaction of every write (see the
+add_ledger_stats migration), so they are as consistent as the ledger and
+reading them doesn't scan it. Counters of a day and currency are split into
+shard rows, transactions add to the row of their xid, so the counters are not
+a hot row which every transfer waits for.
+
+Counters are verified against the ledger (archived partitions included) in the
+snapshot of one statement, and fixed by adding the difference to the rows as
+they are when it's written, so transfers go on while they are fixed
+"""
+import datetime
+import decimal
+from typing import List, NamedTuple
+
+from app import partitions, replicas
+from app.database import db
+from app.schemas import Currency, CurrencyStats, DailyStats, LedgerStatsOut
+
+# totals of currencies (day is null) and counters of days from $1 to $2, in
+# one snapshot
+SELECT_STATS = (
+    "SELECT day, currency, sum(transfers)::bigint AS transfers, "
+    "sum(transfer_volume) AS transfer_volume, "
+    "sum(replenishments)::bigint AS replenishments, "
+    "sum(replenished) AS replenished "
+    "FROM ledger_stats GROUP BY GROUPING SETS ((currency), (day, currency)) "
+    "HAVING day IS NULL OR day BETWEEN $1 AND $2 "
+    "ORDER BY day NULLS FIRST, currency;"
+)
+
+SELECT_ARCHIVED_POSTINGS = (
+    "SELECT tablename FROM pg_tables "
+    "WHERE schemaname = :schema AND tablename LIKE 'posting\\_%';"
+)
+# postings of an archived month are joined with its archived transactions
+SELECT_POSTINGS = (
+    "SELECT posting.created_at, posting.currency, posting.transaction_id, "
+    "posting.amount, transaction.type "
+    "FROM {posting} AS posting JOIN {transaction} AS transaction "
+    "ON transaction.id = posting.transaction_id "
+    "AND transaction.created_at = posting.created_at"
+)
+# counters the ledger should have minus the counters there are, by day and
+# currency, the same as the trigger counts them
+DIFFERENCE = (
+    "WITH ledger AS ("
+    "SELECT (created_at AT TIME ZONE 'UTC')::date AS day, currency, "
+    "count(DISTINCT transaction_id) FILTER (WHERE type = 'TRANSFER') AS transfers, "
+    "coalesce(sum(amount) FILTER (WHERE type = 'TRANSFER' AND amount > 0), 0) "
+    "AS transfer_volume, "
+    "count(*) FILTER (WHERE type = 'REPLENISH') AS replenishments, "
+    "coalesce(sum(amount) FILTER (WHERE type = 'REPLENISH'), 0) AS replenished "
+    "FROM ({postings}) AS posting GROUP BY 1, 2"
+    "), counted AS ("
+    "SELECT day, currency, sum(transfers)::bigint AS transfers, "
+    "sum(transfer_volume) AS transfer_volume, "
+    "sum(replenishments)::bigint AS replenishments, "
+    "sum(replenished) AS replenished "
+    "FROM ledger_stats GROUP BY day, currency"
+    "), difference AS ("
+    "SELECT day, currency, "
+    "coalesce(ledger.transfers, 0) - coalesce(counted.transfers, 0) AS transfers, "
+    "coalesce(ledger.transfer_volume, 0) - coalesce(counted.transfer_volume, 0) "
+    "AS transfer_volume, "
+    "coalesce(ledger.replenishments, 0) - coalesce(counted.replenishments, 0) "
+    "AS replenishments, "
+    "coalesce(ledger.replenished, 0) - coalesce(counted.replenished, 0) "
+    "AS replenished "
+    "FROM ledger FULL JOIN counted USING (day, currency)"
+    "), mismatch AS ("
+    "SELECT * FROM difference WHERE transfers <> 0 OR transfer_volume <> 0 "
+    "OR replenishments <> 0 OR replenished <> 0"
+    ") "
+)
+SELECT_MISMATCHES = "SELECT * FROM mismatch ORDER BY day, currency;"
+# shard 0 takes the difference, only the sum of shards matters
+FIX_MISMATCHES = (
+    ", fixed AS ("
+    "INSERT INTO ledger_stats AS stats(day, currency, shard, transfers, "
+    "transfer_volume, replenishments, replenished) "
+    "SELECT day, currency, 0, transfers, transfer_volume, replenishments, "
+    "replenished FROM mismatch ORDER BY day, currency "
+    "ON CONFLICT (day, currency, shard) DO UPDATE SET "
+    "transfers = stats.transfers + excluded.transfers, "
+    "transfer_volume = stats.transfer_volume + excluded.transfer_volume, "
+    "replenishments = stats.replenishments + excluded.replenishments, "
+    "replenished = stats.replenished + excluded.replenished"
+    ") "
+) + SELECT_MISMATCHES
+
+
+class Mismatch(NamedTuple):
+    # counters of the ledger minus the counted ones
+    day: datetime.date
+    currency: str
+    transfers: int
+    transfer_volume: decimal.Decimal
+    replenishments: int
+    replenished: decimal.Decimal
+
+
+async def get_stats(days: int) -> LedgerStatsOut:
+    """Totals per currency and counters of the last days, today included"""
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    since = today - datetime.timedelta(days=days - 1)
+    async with replicas.database().connection() as connection:
+        rows = await connection.raw_connection.fetch(SELECT_STATS, since, today)
+    totals, daily = [], []
+    for row in rows:
+        if row["day"] is None:
+            totals.append(
+                CurrencyStats.construct(
+                    currency=Currency(row["currency"]),
+                    in_circulation=row["replenished"],
+                    transfers=row["transfers"],
+                    transfer_volume=row["transfer_volume"],
+                    replenishments=row["replenishments"],
+                    replenished=row["replenished"],
+                )
+            )
+        else:
+            daily.append(
+                DailyStats.construct(
+                    day=row["day"],
+                    currency=Currency(row["currency"]),
+                    transfers=row["transfers"],
+                    transfer_volume=row["transfer_volume"],
+                    replenishments=row["replenishments"],
+                    replenished=row["replenished"],
+                )
+            )
+    return LedgerStatsOut.construct(totals=totals, days=daily)
+
+
+async def verify(fix: bool = False) -> List[Mismatch]:
+    """Days and currencies whose counters differ from the ledger, fixed if fix"""
+    archived = await db.fetch_all(
+        SELECT_ARCHIVED_POSTINGS, {"schema": partitions.ARCHIVE_SCHEMA}
+    )
+    tables = [("posting", "transaction")] + [
+        (
+            f'{partitions.ARCHIVE_SCHEMA}."{name}"',
+            f'{partitions.ARCHIVE_SCHEMA}."transaction{name[len("posting"):]}"',
+        )
+        for name in sorted(row[0] for row in archived)
+    ]
+    postings = " UNION ALL ".join(
+        SELECT_POSTINGS.format(posting=posting, transaction=transaction)
+        for posting, transaction in tables
+    )
+    query = DIFFERENCE.format(postings=postings)
+    query += FIX_MISMATCHES if fix else SELECT_MISMATCHES
+    return [Mismatch(**dict(row)) for row in await db.fetch_all(query)]
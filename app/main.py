@@ -1,9 +1,17 @@
+import asyncio
 import logging
 
 from fastapi import FastAPI
 
+from app import idempotency, partitions, snapshots
 from app.database import db
 from app.api import router
+from app.account_cache import account_cache
+from app.admission import AdmissionMiddleware
+from app.batcher import transfer_batcher
+from app.config import settings
+from app.ratelimit import RateLimitMiddleware
+from app.replicas import ReplicaMiddleware, replica_set
 
 logger = logging.getLogger(__name__)
 
@@ -11,16 +19,34 @@ logger = logging.getLogger(__name__)
 # https://twitter.com/nikmostovoy/status/1403740216893095940
 
 app = FastAPI()
+# the last added runs first: clients over their limits take no slots
+app.add_middleware(ReplicaMiddleware)
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(RateLimitMiddleware)
+background_tasks = []
 
 
 @app.on_event("startup")
 async def startup():
     if not db.is_connected:
         await db.connect()
+    background_tasks.append(asyncio.ensure_future(idempotency.purge_periodically()))
+    background_tasks.append(asyncio.ensure_future(partitions.create_periodically()))
+    background_tasks.append(asyncio.ensure_future(snapshots.take_periodically()))
+    if replica_set.replicas:
+        background_tasks.append(asyncio.ensure_future(replica_set.check_periodically()))
+    if settings.account_caching:
+        listen = account_cache.listen(settings.db_url)
+        background_tasks.append(asyncio.ensure_future(listen))
 
 
 @app.on_event("shutdown")
 async def shutdown():
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    await transfer_batcher.close()
+    await replica_set.disconnect()
     if db.is_connected:
         await db.disconnect()
 
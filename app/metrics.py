@@ -0,0 +1,84 @@
+"""
+Prometheus metrics served by GET /metrics.
+Under gunicorn set PROMETHEUS_MULTIPROC_DIR to an empty directory (see
+prestart.sh): every worker writes its values to its own mmap files there and
+/metrics sums files of all workers, so any worker answers for the server
+"""
+import os
+import time
+
+from fastapi.exceptions import RequestValidationError
+from fastapi.routing import APIRoute
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY,
+                               CollectorRegistry, Counter, Histogram,
+                               generate_latest, multiprocess)
+from starlette import status
+from starlette.exceptions import HTTPException
+
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+request_latency = Histogram(
+    "http_request_duration_seconds",
+    "Request handling time by route and response status",
+    ["method", "route", "status"],
+)
+query_latency = Histogram(
+    "db_query_duration_seconds",
+    "Time of named crud queries",
+    ["query"],
+    buckets=DB_BUCKETS,
+)
+commit_latency = Histogram(
+    "db_commit_duration_seconds", "Time of transaction commits", buckets=DB_BUCKETS
+)
+crud_errors = Counter(
+    "crud_errors_total",
+    "CRUDException and NotFound outcomes by operation",
+    ["operation", "error"],
+)
+
+
+db_retries = Counter(
+    "db_retries_total",
+    "Transactions aborted by conflicts by error and outcome (retried, gave_up)",
+    ["error", "outcome"],
+)
+
+
+def crud_error(operation: str, error: Exception):
+    crud_errors.labels(operation, type(error).__name__).inc()
+
+
+def latest() -> bytes:
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+class TimedRoute(APIRoute):
+    """Route which observes request_latency labelled with its path template"""
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def timed_handler(request):
+            start = time.perf_counter()
+            status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+            try:
+                response = await handler(request)
+                status_code = response.status_code
+                return response
+            except HTTPException as e:
+                status_code = e.status_code
+                raise
+            except RequestValidationError:
+                status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+                raise
+            finally:
+                request_latency.labels(request.method, self.path, status_code).observe(
+                    time.perf_counter() - start
+                )
+
+        return timed_handler
@@ -0,0 +1,20 @@
+import json
+from typing import AsyncIterable, AsyncIterator
+
+MEDIA_TYPE = "application/x-ndjson"
+
+
+async def iter_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    """Split stream of byte chunks to non empty lines without reading it whole"""
+    tail = b""
+    async for chunk in chunks:
+        *lines, tail = (tail + chunk).split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if tail.strip():
+        yield tail
+
+
+def dumps(obj) -> bytes:
+    return json.dumps(obj, separators=(",", ":")).encode() + b"\n"
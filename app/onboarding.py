@@ -0,0 +1,61 @@
+import json
+from typing import AsyncIterable, AsyncIterator
+
+from pydantic import ValidationError
+
+from app import crud, ndjson
+from app.config import settings
+from app.schemas import AccountCreateIn
+
+
+async def iterate(items) -> AsyncIterator:
+    for item in items:
+        yield item
+
+
+async def parse_lines(lines: AsyncIterable[bytes]) -> AsyncIterator:
+    """Parse NDJSON lines, lines which are not JSON are passed as errors"""
+    async for line in lines:
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield e
+
+
+def _account_or_error(obj):
+    if isinstance(obj, Exception):
+        return f"invalid JSON: {obj}"
+    try:
+        return AccountCreateIn.parse_obj(obj)
+    except ValidationError as e:
+        return str(e)
+
+
+async def _create_chunk(chunk) -> AsyncIterator[bytes]:
+    accounts = [item for item in chunk if isinstance(item, AccountCreateIn)]
+    created = iter(await crud.create_accounts_bulk(accounts) if accounts else [])
+    for item in chunk:
+        if isinstance(item, AccountCreateIn):
+            yield ndjson.dumps(next(created).dict())
+        else:
+            yield ndjson.dumps({"error": item})
+
+
+async def onboard(items: AsyncIterable) -> AsyncIterator[bytes]:
+    """
+    Create accounts with wallets from a stream of {"name": ...} objects.
+    Accounts are saved by chunks of settings.copy_chunk_size, so memory doesn't
+    depend on the stream size; every chunk is a separate transaction.
+    Yields NDJSON line with account_id and wallet_id (or error) per item
+    in the order of items
+    """
+    chunk = []
+    async for obj in items:
+        chunk.append(_account_or_error(obj))
+        if len(chunk) >= settings.copy_chunk_size:
+            async for line in _create_chunk(chunk):
+                yield line
+            chunk = []
+    if chunk:
+        async for line in _create_chunk(chunk):
+            yield line
@@ -0,0 +1,208 @@
+"""
+Transactional outbox of ledger events. Triggers on posting and wallet write
+an event to outbox in the transaction of every transfer, replenish and
+account creation (see the add_outbox migration), so an event exists if and
+only if its operation is committed.
+
+Relays deliver events to sinks at least once, by batches in order of ids,
+which are offsets of the stream: ids are time-ordered, and only events up to
+the horizon (app.horizon) are read, so events with smaller ids can't commit
+after a batch is delivered and offsets of a sink only grow. The delivered
+offset of every sink is kept in its outbox_relay row, which is locked while
+a batch is delivered (relays of the same sink skip it instead of delivering
+it twice); it is updated after the sink has written the batch, so a batch
+interrupted before commit is delivered again with the same offsets
+"""
+import asyncio
+import datetime
+import json
+import logging
+import os
+import sys
+import time
+from typing import BinaryIO, List, NamedTuple
+
+from prometheus_client import Counter, Gauge
+
+from app import horizon, ndjson
+from app.config import settings
+from app.database import db
+
+logger = logging.getLogger(__name__)
+
+INSERT_RELAY = "INSERT INTO outbox_relay(name) VALUES (:name) ON CONFLICT DO NOTHING;"
+SELECT_DELIVERED = (
+    "SELECT delivered_id FROM outbox_relay WHERE name = :name "
+    "FOR UPDATE SKIP LOCKED;"
+)
+SELECT_EVENTS = (
+    "SELECT id, type, created_at, payload FROM outbox "
+    "WHERE id > :delivered_id AND id <= :horizon ORDER BY id LIMIT :limit;"
+)
+UPDATE_DELIVERED = (
+    "UPDATE outbox_relay SET delivered_id = :delivered_id, delivered_at = now() "
+    "WHERE name = :name;"
+)
+# events are kept until every sink has them
+PURGE_DELIVERED = (
+    "WITH delivered AS ("
+    "SELECT id FROM outbox "
+    "WHERE id <= (SELECT min(delivered_id) FROM outbox_relay) "
+    "ORDER BY id LIMIT :limit FOR UPDATE SKIP LOCKED"
+    ") "
+    "DELETE FROM outbox USING delivered WHERE outbox.id = delivered.id RETURNING 1;"
+)
+
+relayed_events = Counter(
+    "outbox_relayed_events_total", "Events delivered to the sink", ["relay"]
+)
+relay_lag = Gauge(
+    "outbox_relay_lag_seconds",
+    "Age of the last delivered event when it was delivered",
+    ["relay"],
+    multiprocess_mode="liveall",
+)
+
+
+class Event(NamedTuple):
+    offset: int
+    type: str
+    created_at: datetime.datetime
+    payload: dict
+
+
+class Sink:
+    """Destination of relayed events"""
+
+    async def write(self, events: List[Event]):
+        """Write the batch durably, the batch is delivered again if it fails"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class FileSink(Sink):
+    """NDJSON line per event appended to the file, "-" for stdout"""
+
+    def __init__(self, path: str):
+        self.file: BinaryIO = (
+            sys.stdout.buffer if path == "-" else open(path, "ab", buffering=0)
+        )
+
+    async def write(self, events: List[Event]):
+        self.file.write(
+            b"".join(
+                ndjson.dumps(
+                    {
+                        "offset": event.offset,
+                        "type": event.type,
+                        "created_at": event.created_at.isoformat(),
+                        "payload": event.payload,
+                    }
+                )
+                for event in events
+            )
+        )
+        self.file.flush()
+        if self.file is not sys.stdout.buffer:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not sys.stdout.buffer:
+            self.file.close()
+
+
+async def register(name: str):
+    """Add the sink, it starts from the oldest event which is not purged"""
+    await db.execute(INSERT_RELAY, {"name": name})
+
+
+async def relay_batch(name: str, sink: Sink, horizon_id: int) -> List[Event]:
+    """
+    Deliver the next batch of events up to horizon_id to the sink, return
+    the events (none if another relay delivers to the sink)
+    """
+    async with db.transaction():
+        delivered_id = await db.fetch_val(SELECT_DELIVERED, {"name": name})
+        if delivered_id is None:
+            return []
+        rows = await db.fetch_all(
+            SELECT_EVENTS,
+            {
+                "delivered_id": delivered_id,
+                "horizon": horizon_id,
+                "limit": settings.outbox_batch_size,
+            },
+        )
+        if not rows:
+            return []
+        events = [
+            Event(row["id"], row["type"], row["created_at"], json.loads(row["payload"]))
+            for row in rows
+        ]
+        await sink.write(events)
+        await db.execute(
+            UPDATE_DELIVERED, {"name": name, "delivered_id": events[-1].offset}
+        )
+    relayed_events.labels(name).inc(len(events))
+    return events
+
+
+async def purge_delivered() -> int:
+    """Delete events delivered to all sinks by small batches, return their number"""
+    deleted = 0
+    while True:
+        rows = await db.fetch_all(PURGE_DELIVERED, {"limit": 1000})
+        deleted += len(rows)
+        if len(rows) < 1000:
+            return deleted
+
+
+async def _wait_for_horizon() -> int:
+    async with db.connection() as connection:
+        return await horizon.wait_for_horizon(
+            connection.raw_connection, settings.outbox_wait_timeout
+        )
+
+
+async def relay(name: str, sink: Sink):
+    """Deliver events to the sink as they are committed, until cancelled"""
+    await register(name)
+    relayed, lag = 0, 0.0
+    stats_at = purged_at = time.monotonic()
+    while True:
+        try:
+            horizon_id = await _wait_for_horizon()
+        except horizon.HorizonTimeout as e:
+            logger.warning("%s, relay %s waits for them", e, name)
+            continue
+        # events up to the horizon are relayed by full batches before the
+        # next one is taken
+        events = await relay_batch(name, sink, horizon_id)
+        while events:
+            relayed += len(events)
+            delivered_at = datetime.datetime.now(datetime.timezone.utc)
+            lag = (delivered_at - events[-1].created_at).total_seconds()
+            relay_lag.labels(name).set(lag)
+            if len(events) < settings.outbox_batch_size:
+                break
+            events = await relay_batch(name, sink, horizon_id)
+        if not events:
+            lag = 0.0
+            relay_lag.labels(name).set(lag)
+            await asyncio.sleep(settings.outbox_poll_interval)
+
+        now = time.monotonic()
+        if now - stats_at >= settings.outbox_stats_interval:
+            logger.info(
+                "relay %s: %s events, %.0f events/s, lag %.3f s",
+                name,
+                relayed,
+                relayed / (now - stats_at),
+                lag,
+            )
+            relayed, stats_at = 0, now
+        if now - purged_at >= settings.outbox_purge_interval:
+            logger.info("%s delivered events purged", await purge_delivered())
+            purged_at = now
@@ -0,0 +1,144 @@
+"""
+Monthly range partitions of transaction and posting by created_at (UTC
+months). Partitions of coming months are created ahead by the app and by
+`python -m app.cli partitions create`; partitions of old months are detached
+and moved to the archive schema by `python -m app.cli partitions archive`,
+from where they can be dumped and dropped without touching live tables.
+Postings are in the partition of the same month as their transaction
+(posting.created_at is created_at of the transaction)
+"""
+import asyncio
+import datetime
+import logging
+from typing import List, NamedTuple, Optional
+
+from app.config import settings
+from app.database import db
+
+logger = logging.getLogger(__name__)
+
+TABLES = ("transaction", "posting")
+ARCHIVE_SCHEMA = "archive"
+
+SELECT_PARTITIONS = (
+    "SELECT child.relname AS name, "
+    "substring(pg_get_expr(child.relpartbound, child.oid) "
+    "FROM 'FROM \\(''(.*)''\\) TO')::timestamptz AS lower_bound, "
+    "substring(pg_get_expr(child.relpartbound, child.oid) "
+    "FROM 'TO \\(''(.*)''\\)')::timestamptz AS upper_bound "
+    "FROM pg_inherits "
+    "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+    "WHERE pg_inherits.inhparent = CAST(:table AS regclass) "
+    "ORDER BY upper_bound;"
+)
+
+
+class Partition(NamedTuple):
+    name: str
+    # None for MINVALUE
+    lower_bound: Optional[datetime.datetime]
+    upper_bound: datetime.datetime
+
+
+def month_start(moment: datetime.datetime) -> datetime.datetime:
+    moment = moment.astimezone(datetime.timezone.utc)
+    return datetime.datetime(moment.year, moment.month, 1, tzinfo=datetime.timezone.utc)
+
+
+def add_months(start: datetime.datetime, months: int) -> datetime.datetime:
+    month = start.month - 1 + months
+    return start.replace(year=start.year + month // 12, month=month % 12 + 1)
+
+
+def partition_name(table: str, start: datetime.datetime) -> str:
+    return f"{table}_y{start.year}m{start.month:02d}"
+
+
+async def list_partitions(table: str) -> List[Partition]:
+    rows = await db.fetch_all(SELECT_PARTITIONS, values={"table": table})
+    return [
+        Partition(row["name"], row["lower_bound"], row["upper_bound"]) for row in rows
+    ]
+
+
+async def _lock():
+    # one maintenance at a time across app workers and cli; DDL fails
+    # instead of queueing all queries of the table behind its lock
+    await db.execute("SELECT pg_advisory_xact_lock(hashtext('partitions'));")
+    await db.execute("SET LOCAL lock_timeout = '5s';")
+
+
+async def create_partitions(
+    months_ahead: int = None, now: datetime.datetime = None
+) -> List[str]:
+    """
+    Create missing partitions from the current month to months_ahead months
+    ahead, return their names. Months covered by existing partitions are
+    skipped
+    """
+    if months_ahead is None:
+        months_ahead = settings.partition_months_ahead
+    current = month_start(now or datetime.datetime.now(datetime.timezone.utc))
+    created = []
+    async with db.transaction():
+        await _lock()
+        for table in TABLES:
+            partitions = await list_partitions(table)
+            covered_until = max((p.upper_bound for p in partitions), default=None)
+            for month in range(months_ahead + 1):
+                start = add_months(current, month)
+                if covered_until is not None and start < covered_until:
+                    continue
+                name = partition_name(table, start)
+                end = add_months(start, 1)
+                # unlike CREATE TABLE ... PARTITION OF, ATTACH PARTITION
+                # doesn't block queries of the partitioned table
+                await db.execute(
+                    f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS);"
+                )
+                await db.execute(
+                    f"ALTER TABLE {table} ATTACH PARTITION {name} "
+                    f"FOR VALUES FROM ('{start.isoformat()}') "
+                    f"TO ('{end.isoformat()}');"
+                )
+                created.append(name)
+    return created
+
+
+async def archive_partitions(
+    keep_months: int = None, now: datetime.datetime = None
+) -> List[str]:
+    """
+    Detach partitions which end before the last keep_months months (and the
+    current one), move them to the archive schema, return their names
+    """
+    if keep_months is None:
+        keep_months = settings.partition_keep_months
+    current = month_start(now or datetime.datetime.now(datetime.timezone.utc))
+    cutoff = add_months(current, -keep_months)
+    archived = []
+    for table in TABLES:
+        for partition in await list_partitions(table):
+            if partition.upper_bound > cutoff:
+                continue
+            async with db.transaction():
+                await _lock()
+                await db.execute(
+                    f"ALTER TABLE {table} DETACH PARTITION {partition.name};"
+                )
+                await db.execute(
+                    f"ALTER TABLE {partition.name} SET SCHEMA {ARCHIVE_SCHEMA};"
+                )
+            archived.append(partition.name)
+    return archived
+
+
+async def create_periodically():
+    while True:
+        try:
+            created = await create_partitions()
+            if created:
+                logger.info("partitions created: %s", ", ".join(created))
+        except Exception as e:
+            logger.exception(e)
+        await asyncio.sleep(settings.partition_check_interval)
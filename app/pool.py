@@ -0,0 +1,183 @@
+import asyncio
+import bisect
+import itertools
+import time
+from typing import Dict, Optional, Sequence
+
+import databases
+from databases.backends import postgres
+
+from app import metrics
+
+# seconds
+ACQUIRE_TIME_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+
+class Histogram:
+    """Histogram of observed values with cumulative buckets as in Prometheus"""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self._counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def stats(self) -> dict:
+        bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+        return {
+            "buckets": dict(zip(bounds, itertools.accumulate(self._counts))),
+            "count": self.count,
+            "sum": self.sum,
+        }
+
+
+class PoolStats:
+    def __init__(self):
+        self.in_use = 0
+        self.waiting = 0
+        self.acquired = 0
+        self.timeouts = 0
+        self.expired = 0
+        self.acquire_time = Histogram(ACQUIRE_TIME_BUCKETS)
+        # the shortest acquire time since the last take_min_acquire_time()
+        self.min_acquire_time = float("inf")
+
+
+class PostgresTransaction(postgres.PostgresTransaction):
+    """Transaction which observes commit time (of root transactions only)"""
+
+    async def start(self, is_root: bool, extra_options: dict) -> None:
+        self._is_root = is_root
+        await super().start(is_root, extra_options)
+
+    async def commit(self) -> None:
+        if not self._is_root:
+            await super().commit()
+            return
+        with metrics.commit_latency.time():
+            await super().commit()
+
+
+class PostgresConnection(postgres.PostgresConnection):
+    async def acquire(self) -> None:
+        assert self._connection is None, "Connection is already acquired"
+        backend = self._database
+        assert backend._pool is not None, "DatabaseBackend is not running"
+        stats = backend.stats
+
+        stats.waiting += 1
+        start = time.perf_counter()
+        try:
+            self._connection = await backend._pool.acquire(
+                timeout=backend.acquire_timeout
+            )
+        except asyncio.TimeoutError:
+            stats.timeouts += 1
+            raise
+        finally:
+            stats.waiting -= 1
+        acquire_time = time.perf_counter() - start
+        stats.acquire_time.observe(acquire_time)
+        stats.min_acquire_time = min(stats.min_acquire_time, acquire_time)
+        stats.acquired += 1
+        stats.in_use += 1
+
+    async def release(self) -> None:
+        assert self._connection is not None, "Connection is not acquired"
+        backend = self._database
+        assert backend._pool is not None, "DatabaseBackend is not running"
+        connection, self._connection = self._connection, None
+        backend.stats.in_use -= 1
+        if backend.is_expired(connection):
+            # the pool opens new connection instead of closed one when needed
+            backend.stats.expired += 1
+            backend.forget(connection)
+            await connection.close()
+        await backend._pool.release(connection)
+
+    def transaction(self) -> PostgresTransaction:
+        return PostgresTransaction(self)
+
+
+class PostgresBackend(postgres.PostgresBackend):
+    """
+    asyncpg backend which counts pool usage, limits time to wait for
+    connection (acquire_timeout) and closes connections older than
+    max_lifetime seconds when they are released
+    """
+
+    def __init__(
+        self,
+        database_url,
+        acquire_timeout: Optional[float] = None,
+        max_lifetime: Optional[float] = None,
+        **options,
+    ):
+        super().__init__(database_url, init=self._on_connect, **options)
+        self.acquire_timeout = acquire_timeout
+        self.max_lifetime = max_lifetime
+        self.stats = PoolStats()
+        # connection open time by backend pid
+        self._opened_at: Dict[int, float] = {}
+
+    async def _on_connect(self, connection):
+        self._opened_at[connection.get_server_pid()] = time.monotonic()
+
+    def is_expired(self, connection) -> bool:
+        opened_at = self._opened_at.get(connection.get_server_pid())
+        if self.max_lifetime is None or opened_at is None:
+            return False
+        return time.monotonic() - opened_at > self.max_lifetime
+
+    def forget(self, connection):
+        self._opened_at.pop(connection.get_server_pid(), None)
+
+    def connection(self) -> PostgresConnection:
+        return PostgresConnection(self, self._dialect)
+
+    def take_min_acquire_time(self) -> Optional[float]:
+        """
+        The shortest time to acquire a connection since the previous call,
+        None if no connection was acquired or waited for meanwhile (inf if
+        connections were waited for, but none was acquired)
+        """
+        stats = self.stats
+        min_acquire_time, stats.min_acquire_time = stats.min_acquire_time, float("inf")
+        if min_acquire_time == float("inf") and not stats.waiting:
+            return None
+        return min_acquire_time
+
+    def pool_stats(self) -> dict:
+        stats = self.stats
+        size = self._pool.get_size() if self._pool is not None else 0
+        return {
+            "size": size,
+            "min_size": self._options.get("min_size"),
+            "max_size": self._options.get("max_size"),
+            "in_use": stats.in_use,
+            "idle": size - stats.in_use,
+            "waiting": stats.waiting,
+            "acquired": stats.acquired,
+            "timeouts": stats.timeouts,
+            "expired": stats.expired,
+            "acquire_time": stats.acquire_time.stats(),
+        }
+
+
+class Database(databases.Database):
+    SUPPORTED_BACKENDS = dict(
+        databases.Database.SUPPORTED_BACKENDS,
+        postgresql="app.pool:PostgresBackend",
+        postgres="app.pool:PostgresBackend",
+    )
+
+    def pool_stats(self) -> dict:
+        return self._backend.pool_stats()
+
+    def take_min_acquire_time(self) -> Optional[float]:
+        return self._backend.take_min_acquire_time()
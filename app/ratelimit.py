@@ -0,0 +1,235 @@
+"""
+Rate limiting of API clients per route. Every client has a token bucket per
+limited route (and one for the rest of routes with "*" limit), checked with
+GCRA: the bucket is a single time, the theoretical arrival time of the next
+request (in nanoseconds, so sums of intervals are exact), and a request
+passes if it is at most burst - 1 emission intervals ahead of now.
+
+Buckets of all workers of the host are slots of one mmap'ed file
+(settings.rate_limit_file, better in tmpfs), so the limits hold for the
+server, and time is CLOCK_MONOTONIC, which is the same for all processes.
+Workers take a bucket under a POSIX record lock of the slots where it may be,
+so the check and the update are atomic and limits are exact. A check takes
+about 1.8 microseconds, 1 of them in the lock and unlock syscalls (a CAS of
+the slot from Python costs as much). With settings.rate_limit_locking off a
+check takes under a microsecond, but concurrent requests of a client in
+different workers may both pass on one token
+"""
+import fcntl
+import mmap
+import os
+import time
+import zlib
+from typing import Dict, List, NamedTuple, Optional, Pattern, Tuple
+
+from fastapi.responses import JSONResponse
+from prometheus_client import Counter
+from starlette import status
+
+from app.config import settings
+
+DEFAULT_ROUTE = "*"
+# slots of a key are probed from its hash on, a key which finds none of them
+# free waits until one is: buckets of other keys are never taken over
+PROBES = 4
+
+# a slot is two words: key tag (0 is a free slot) and theoretical arrival time
+WORD_SIZE = 8
+SLOT_SIZE = 2 * WORD_SIZE
+
+rate_limited = Counter(
+    "rate_limited_requests_total", "Requests refused by rate limits", ["route"]
+)
+slots_taken = Counter(
+    "rate_limit_slots_taken_total",
+    "Requests refused because other clients' buckets took all slots of theirs",
+)
+
+
+class Limit(NamedTuple):
+    # nanoseconds per request and how far ahead of now buckets may be
+    interval: int
+    tolerance: int
+
+    @classmethod
+    def from_rate(cls, rate: float, burst: int) -> "Limit":
+        interval = round(1e9 / rate)
+        return cls(interval, (burst - 1) * interval)
+
+
+class RateLimiter:
+    """GCRA buckets in shared memory"""
+
+    def __init__(self, path: str, slots: int, locking: bool = True):
+        self.path = path
+        self.slots = slots
+        # without locks, workers checking one bucket at once may both pass
+        self.locking = locking
+        self._fd: Optional[int] = None
+        self._words: Optional[memoryview] = None
+        # tags of recent keys: checksums, unlike hash(), are the same in
+        # every worker
+        self._tags: Dict[bytes, int] = {}
+
+    def _open(self) -> memoryview:
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        # probes of the last slots go on past them instead of wrapping around,
+        # so the slots of a key are one range to lock
+        size = (self.slots + PROBES - 1) * SLOT_SIZE
+        # workers start at once, growing the file to the same size is safe
+        if os.fstat(fd).st_size < size:
+            os.ftruncate(fd, size)
+        self._fd = fd
+        self._words = memoryview(mmap.mmap(fd, size)).cast("Q")
+        return self._words
+
+    def acquire(self, key: bytes, limit: Limit) -> float:
+        """Take a request from the bucket of key, 0 or seconds to retry after"""
+        words = self._words
+        if words is None:
+            words = self._open()
+        tag = self._tags.get(key)
+        if tag is None:
+            if len(self._tags) >= self.slots:
+                self._tags.clear()
+            tag = self._tags[key] = (zlib.crc32(key) << 32 | zlib.adler32(key)) or 1
+        # crc32 spreads similar keys, adler32 of short keys hardly does
+        first = (tag >> 32) % self.slots
+        if not self.locking:
+            return self._take(words, first, tag, limit)
+        fd = self._fd
+        fcntl.lockf(fd, fcntl.LOCK_EX, PROBES * SLOT_SIZE, first * SLOT_SIZE)
+        try:
+            return self._take(words, first, tag, limit)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN, PROBES * SLOT_SIZE, first * SLOT_SIZE)
+
+    def _take(self, words: memoryview, first: int, tag: int, limit: Limit) -> float:
+        now = time.monotonic_ns()
+        index = 2 * first
+        if words[index] != tag:
+            index = self._find(words, first, tag, now)
+            if index is None:
+                slots_taken.inc()
+                earliest = min(words[2 * first + 1 : 2 * (first + PROBES) : 2])
+                return (earliest - now) / 1e9
+        arrival = words[index + 1]
+        # a bucket can't be further ahead unless it's left from previous
+        # boot or limit has changed
+        if (
+            words[index] != tag
+            or arrival < now
+            or arrival - now > limit.tolerance + limit.interval
+        ):
+            arrival = now
+        wait = arrival - now - limit.tolerance
+        if wait > 0:
+            return wait / 1e9
+        words[index] = tag
+        words[index + 1] = arrival + limit.interval
+        return 0
+
+    @staticmethod
+    def _find(words: memoryview, first: int, tag: int, now: int) -> Optional[int]:
+        """
+        Word index of the bucket of tag in slots from first on or of a free
+        one to take, None if buckets of other keys are in all of them
+        """
+        # a bucket which is full again is the same as no bucket
+        free = None
+        for index in range(2 * first, 2 * (first + PROBES), 2):
+            if words[index] == tag:
+                return index
+            if free is None and words[index + 1] <= now:
+                free = index
+        return free
+
+
+class RateLimitMiddleware:
+    """
+    Refuse requests of clients over their limits with 429. Limits are
+    {"METHOD /route/template": (requests per second, burst)}, "*" is of all
+    routes without their own limit; client_limits override limits of
+    particular clients. Clients are told apart by client_header or by
+    address of the connection
+    """
+
+    def __init__(
+        self,
+        app,
+        limits: Dict[str, Tuple[float, int]] = None,
+        client_limits: Dict[str, Dict[str, Tuple[float, int]]] = None,
+        client_header: Optional[str] = None,
+        limiter: RateLimiter = None,
+    ):
+        self.app = app
+        if limits is None:
+            limits = settings.rate_limits
+        if client_limits is None:
+            client_limits = settings.client_rate_limits
+        if client_header is None:
+            client_header = settings.rate_limit_client_header
+        self.limits = self._parse(limits)
+        self.client_limits = {
+            client: self._parse(client_routes)
+            for client, client_routes in client_limits.items()
+        }
+        self.client_header = client_header and client_header.lower().encode()
+        self.limiter = limiter or RateLimiter(
+            settings.rate_limit_file,
+            settings.rate_limit_slots,
+            settings.rate_limit_locking,
+        )
+        self.route_keys = set(self.limits).union(*self.client_limits.values())
+        self.route_keys.discard(DEFAULT_ROUTE)
+        self._routes: Optional[List[Tuple[str, Pattern, str]]] = None
+
+    @staticmethod
+    def _parse(limits: Dict[str, Tuple[float, int]]) -> Dict[str, Limit]:
+        return {
+            key: Limit.from_rate(rate, burst) for key, (rate, burst) in limits.items()
+        }
+
+    def _match_route(self, scope) -> str:
+        if self._routes is None:
+            # routes of limits, in the order of the router
+            self._routes = [
+                (method, route.path_regex, f"{method} {route.path}")
+                for route in scope["app"].routes
+                for method in getattr(route, "methods", None) or ()
+                if f"{method} {route.path}" in self.route_keys
+            ]
+        method, path = scope["method"], scope["path"]
+        for route_method, path_regex, key in self._routes:
+            if route_method == method and path_regex.match(path):
+                return key
+        return DEFAULT_ROUTE
+
+    def _client(self, scope) -> str:
+        if self.client_header:
+            for name, value in scope["headers"]:
+                if name == self.client_header:
+                    return value.decode("latin-1")
+        client = scope.get("client")
+        return client[0] if client else ""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not (self.limits or self.client_limits):
+            await self.app(scope, receive, send)
+            return
+        client = self._client(scope)
+        limits = self.client_limits.get(client, self.limits)
+        route = self._match_route(scope) if self.route_keys else DEFAULT_ROUTE
+        limit = limits.get(route) or limits.get(DEFAULT_ROUTE)
+        if limit is not None:
+            wait = self.limiter.acquire(f"{client}\0{route}".encode(), limit)
+            if wait:
+                rate_limited.labels(route).inc()
+                response = JSONResponse(
+                    {"detail": "Rate limit exceeded"},
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    headers={"Retry-After": str(int(wait) + 1)},
+                )
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
@@ -0,0 +1,241 @@
+"""
+Reconciliation of wallet amounts with the ledger: amount of every wallet must
+be the sum of its postings. Postings (archived partitions included) and
+wallet amounts are read in one repeatable read snapshot, so transfers go on
+while the job runs, and postings are streamed through a server-side cursor,
+so neither the database nor the job holds all of them at once.
+
+Wallet ids are split into shards: ranges of the uuid space, even because
+uuid4 is random. Every shard can be reconciled by its own process. Sums of
+postings are saved to reconciled_balance with a checkpoint (posting id) of
+the shard range, incremental runs read only postings after the checkpoint
+"""
+import decimal
+import logging
+import uuid
+from typing import AsyncIterator, Callable, Dict, List, NamedTuple, Tuple
+
+import asyncpg
+
+from app import dal, horizon, partitions
+from app.config import settings
+from app.database import db
+
+logger = logging.getLogger(__name__)
+
+UUID_SPACE = 2 ** 128
+
+SELECT_ARCHIVED_POSTINGS = (
+    "SELECT format('%I.%I', schemaname, tablename) FROM pg_tables "
+    "WHERE schemaname = $1 AND tablename LIKE 'posting\\_%';"
+)
+SELECT_POSTINGS = (
+    "SELECT wallet_id, amount, id FROM {table} "
+    "WHERE id > $1 AND wallet_id BETWEEN $2 AND $3"
+)
+SELECT_WALLETS = (
+    f"SELECT wallet.id, {dal.WALLET_AMOUNT} AS amount, "
+    "reconciled_balance.amount AS reconciled "
+    "FROM wallet LEFT JOIN reconciled_balance "
+    "ON reconciled_balance.wallet_id = wallet.id "
+    "WHERE wallet.id BETWEEN $1 AND $2;"
+)
+SELECT_CHECKPOINT = (
+    "SELECT posting_id FROM reconciliation_checkpoint "
+    "WHERE wallet_id_from = $1 AND wallet_id_to = $2;"
+)
+DELETE_BALANCES = "DELETE FROM reconciled_balance WHERE wallet_id BETWEEN $1 AND $2;"
+UPSERT_BALANCES = (
+    "INSERT INTO reconciled_balance(wallet_id, amount) "
+    "SELECT * FROM unnest(CAST($1 AS uuid[]), CAST($2 AS numeric[])) "
+    "ON CONFLICT (wallet_id) DO UPDATE SET amount = EXCLUDED.amount;"
+)
+# balances of overlapping ranges of other shard counts are overwritten
+DELETE_OVERLAPPING_CHECKPOINTS = (
+    "DELETE FROM reconciliation_checkpoint "
+    "WHERE wallet_id_from <= $2 AND wallet_id_to >= $1 "
+    "AND (wallet_id_from, wallet_id_to) <> ($1, $2);"
+)
+UPSERT_CHECKPOINT = (
+    "INSERT INTO reconciliation_checkpoint(wallet_id_from, wallet_id_to, posting_id) "
+    "VALUES ($1, $2, $3) ON CONFLICT (wallet_id_from, wallet_id_to) "
+    "DO UPDATE SET posting_id = EXCLUDED.posting_id, created_at = now();"
+)
+
+
+class ReconciliationError(Exception):
+    pass
+
+
+class Mismatch(NamedTuple):
+    wallet_id: uuid.UUID
+    amount: decimal.Decimal
+    ledger_amount: decimal.Decimal
+
+
+class Summary(NamedTuple):
+    wallet_id_from: uuid.UUID
+    wallet_id_to: uuid.UUID
+    # postings after this id were read, 0 for full reconciliation
+    from_posting_id: int
+    checkpoint: int
+    postings: int
+    wallets: int
+    mismatches: int
+
+
+def shard_range(shards: int, shard: int) -> Tuple[uuid.UUID, uuid.UUID]:
+    """First and last wallet id of the shard"""
+    if not 0 <= shard < shards:
+        raise ValueError(f"shard must be in [0, {shards})")
+    return (
+        uuid.UUID(int=UUID_SPACE * shard // shards),
+        uuid.UUID(int=UUID_SPACE * (shard + 1) // shards - 1),
+    )
+
+
+async def _fetch_chunks(
+    connection: asyncpg.Connection, query: str, *args
+) -> AsyncIterator[List[asyncpg.Record]]:
+    cursor = await connection.cursor(query, *args)
+    while True:
+        rows = await cursor.fetch(settings.reconcile_chunk_size)
+        if not rows:
+            return
+        yield rows
+
+
+async def _save(
+    connection: asyncpg.Connection,
+    wallet_id_from: uuid.UUID,
+    wallet_id_to: uuid.UUID,
+    full: bool,
+    balances: Dict[uuid.UUID, decimal.Decimal],
+    checkpoint: int,
+):
+    async with connection.transaction():
+        if full:
+            await connection.execute(DELETE_BALANCES, wallet_id_from, wallet_id_to)
+        items = list(balances.items())
+        for start in range(0, len(items), settings.reconcile_chunk_size):
+            chunk = items[start:start + settings.reconcile_chunk_size]
+            await connection.execute(
+                UPSERT_BALANCES,
+                [wallet_id for wallet_id, _ in chunk],
+                [amount for _, amount in chunk],
+            )
+        await connection.execute(
+            DELETE_OVERLAPPING_CHECKPOINTS, wallet_id_from, wallet_id_to
+        )
+        await connection.execute(
+            UPSERT_CHECKPOINT, wallet_id_from, wallet_id_to, checkpoint
+        )
+
+
+async def reconcile(
+    shards: int = 1,
+    shard: int = 0,
+    incremental: bool = False,
+    report: Callable[[Mismatch], None] = None,
+) -> Summary:
+    """
+    Compare amounts of wallets of the shard with sums of their postings, pass
+    every mismatch to report. Incremental run starts from reconciled balances
+    and the checkpoint of the previous run of the same shard (full run if
+    there is none)
+    """
+    wallet_id_from, wallet_id_to = shard_range(shards, shard)
+    async with db.connection() as connection:
+        raw_connection = connection.raw_connection
+        locked = await raw_connection.fetchval(
+            "SELECT pg_try_advisory_lock(hashtext('reconciliation'), hashtext($1));",
+            str(wallet_id_from),
+        )
+        if not locked:
+            raise ReconciliationError(f"shard {shard} of {shards} is already running")
+        try:
+            from_posting_id = 0
+            if incremental:
+                from_posting_id = await raw_connection.fetchval(
+                    SELECT_CHECKPOINT, wallet_id_from, wallet_id_to
+                )
+                if from_posting_id is None:
+                    logger.info("no checkpoint of shard %s, full run", shard)
+                    from_posting_id = 0
+            full = from_posting_id == 0
+            try:
+                # postings up to it may belong to transactions running now
+                checkpoint = await horizon.wait_for_horizon(
+                    raw_connection, settings.reconcile_wait_timeout
+                )
+            except horizon.HorizonTimeout as e:
+                raise ReconciliationError(str(e))
+
+            archived = await raw_connection.fetch(
+                SELECT_ARCHIVED_POSTINGS, partitions.ARCHIVE_SCHEMA
+            )
+            tables = ["posting"] + [row[0] for row in archived]
+            select_postings = " UNION ALL ".join(
+                SELECT_POSTINGS.format(table=table) for table in tables
+            )
+            # sums of all visible postings and of postings up to checkpoint
+            # which are saved as new reconciled balances
+            sums: Dict[uuid.UUID, decimal.Decimal] = {}
+            settled: Dict[uuid.UUID, decimal.Decimal] = {}
+            balances: Dict[uuid.UUID, decimal.Decimal] = {}
+            postings = wallets = mismatches = 0
+            # nested into outer transaction (tests) uses its snapshot
+            isolation = None
+            if not raw_connection.is_in_transaction():
+                isolation = "repeatable_read"
+            async with raw_connection.transaction(isolation=isolation, readonly=True):
+                async for rows in _fetch_chunks(
+                    raw_connection,
+                    select_postings,
+                    from_posting_id,
+                    wallet_id_from,
+                    wallet_id_to,
+                ):
+                    postings += len(rows)
+                    for wallet_id, amount, posting_id in rows:
+                        sums[wallet_id] = sums.get(wallet_id, 0) + amount
+                        if posting_id <= checkpoint:
+                            settled[wallet_id] = settled.get(wallet_id, 0) + amount
+
+                async for rows in _fetch_chunks(
+                    raw_connection, SELECT_WALLETS, wallet_id_from, wallet_id_to
+                ):
+                    wallets += len(rows)
+                    for wallet_id, amount, reconciled in rows:
+                        base = 0 if full or reconciled is None else reconciled
+                        ledger_amount = base + sums.get(wallet_id, 0)
+                        if ledger_amount != amount:
+                            mismatches += 1
+                            if report is not None:
+                                report(Mismatch(wallet_id, amount, ledger_amount))
+                        if wallet_id in settled:
+                            balances[wallet_id] = base + settled[wallet_id]
+
+            await _save(
+                raw_connection,
+                wallet_id_from,
+                wallet_id_to,
+                full,
+                balances,
+                checkpoint,
+            )
+        finally:
+            await raw_connection.execute(
+                "SELECT pg_advisory_unlock(hashtext('reconciliation'), hashtext($1));",
+                str(wallet_id_from),
+            )
+
+    return Summary(
+        wallet_id_from,
+        wallet_id_to,
+        from_posting_id,
+        checkpoint,
+        postings,
+        wallets,
+        mismatches,
+    )
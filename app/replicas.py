@@ -0,0 +1,324 @@
+"""
+Routing of reads to read replicas (settings.db_replica_urls). GET requests
+read from a replica which is at most settings.db_replica_max_lag seconds
+behind the primary, round robin, or from the primary if there is none; other
+requests use the primary only.
+
+Every worker checks positions every db_replica_check_interval seconds: the
+WAL position (LSN) of the primary is sampled, and a replica which has
+replayed the LSN of a sample has every transaction committed before the
+sample, so its lag is the age of the newest such sample. Positions only grow,
+so a replica is never ahead of what the worker knows of it.
+
+Read-your-writes: responses of successful writes have X-Session-Token header,
+an LSN of the primary taken after the write is committed. Clients send the
+latest token they got with their reads, which then go to a replica which has
+replayed it (or to the primary) and skip caches of the worker, so clients
+never miss their own writes. Streamed responses have no token: their writes
+are committed while the body is sent, after the headers
+"""
+import asyncio
+import collections
+import contextlib
+import contextvars
+import itertools
+import logging
+import time
+from typing import Deque, Iterator, List, Optional, Tuple
+
+from databases import DatabaseURL
+
+from app.admission import READ_METHODS
+from app.config import settings
+from app.database import db
+from app.pool import Database
+
+logger = logging.getLogger(__name__)
+
+SESSION_HEADER = "X-Session-Token"
+_SESSION_HEADER = SESSION_HEADER.lower().encode()
+
+SELECT_PRIMARY_LSN = "SELECT pg_current_wal_lsn();"
+# a primary listed as replica is never behind
+SELECT_REPLAY_LSN = (
+    "SELECT CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() "
+    "ELSE pg_current_wal_lsn() END;"
+)
+
+# database of reads of the current request, the primary if not set
+_database: "contextvars.ContextVar[Optional[Database]]" = contextvars.ContextVar(
+    "replica_database", default=None
+)
+# whether the current request has a session token
+_session: "contextvars.ContextVar[bool]" = contextvars.ContextVar(
+    "replica_session", default=False
+)
+
+
+def format_lsn(lsn: int) -> str:
+    return f"{lsn >> 32:X}/{lsn & 0xFFFFFFFF:X}"
+
+
+def parse_lsn(token: str) -> int:
+    high, low = token.split("/")
+    return int(high, 16) << 32 | int(low, 16)
+
+
+def database() -> Database:
+    """Database which reads of the current request go to"""
+    return _database.get() or db
+
+
+def in_session() -> bool:
+    """Whether reads of the current request must see the writes of its client"""
+    return _session.get()
+
+
+@contextlib.contextmanager
+def reading_from(database: Database, session: bool = False) -> Iterator[None]:
+    token = _database.set(database)
+    session_token = _session.set(session)
+    try:
+        yield
+    finally:
+        _session.reset(session_token)
+        _database.reset(token)
+
+
+class LsnQuery:
+    """
+    LSN query shared by callers which come before it is sent, so the LSN is
+    at least as late as the position at the call of each of them
+    """
+
+    def __init__(self, database: Database, query: str):
+        self.database = database
+        self.query = query
+        self._next: Optional[asyncio.Future] = None
+
+    async def fetch(self) -> int:
+        if self._next is None:
+            # started from empty context the query gets its own connection
+            # instead of sharing the one of the caller, which databases
+            # leaves unusable if acquiring it fails
+            self._next = contextvars.Context().run(asyncio.ensure_future, self._run())
+        return await asyncio.shield(self._next)
+
+    async def _run(self) -> int:
+        # callers from now on need the next query
+        if self._next is asyncio.current_task():
+            self._next = None
+        async with self.database.connection() as connection:
+            # replay LSN is null while recovery hasn't replayed anything yet
+            return await connection.raw_connection.fetchval(self.query) or 0
+
+
+class Replica:
+    def __init__(self, url: str):
+        self.db = Database(
+            url,
+            min_size=settings.db_pool_min_size,
+            max_size=settings.db_pool_max_size,
+            acquire_timeout=settings.db_pool_acquire_timeout,
+            max_lifetime=settings.db_pool_max_lifetime,
+            statement_cache_size=settings.db_statement_cache_size,
+        )
+        # without credentials, for stats and logs
+        url = DatabaseURL(url)
+        self.name = f"{url.hostname}:{url.port or 5432}/{url.database}"
+        self.available = False
+        # positions as of the last check
+        self.replay_lsn = 0
+        # transactions committed on the primary before this time are replayed
+        self.caught_up_at = float("-inf")
+        self.reads = 0
+        self._replay_lsn = LsnQuery(self.db, SELECT_REPLAY_LSN)
+
+    def lag(self, now: float) -> float:
+        return now - self.caught_up_at
+
+    async def update_replay_lsn(self):
+        self.replay_lsn = max(self.replay_lsn, await self._replay_lsn.fetch())
+
+
+class ReplicaSet:
+    """Replicas of the primary with their positions"""
+
+    def __init__(self, urls: List[str], primary: Database):
+        self.primary = primary
+        self.replicas = [Replica(url) for url in urls]
+        # (time, LSN) of the primary, from the oldest one
+        self._samples: Deque[Tuple[float, int]] = collections.deque()
+        self._turn = itertools.count()
+        self.primary_reads = 0
+        self._primary_lsn = LsnQuery(primary, SELECT_PRIMARY_LSN)
+
+    async def disconnect(self):
+        for replica in self.replicas:
+            if replica.db.is_connected:
+                await replica.db.disconnect()
+
+    async def check(self):
+        """Update positions of replicas"""
+        sampled_at = time.monotonic()
+        self._samples.append((sampled_at, await self._primary_lsn.fetch()))
+        # replicas which need older samples lag too much anyway
+        while self._samples[0][0] < sampled_at - settings.db_replica_max_lag:
+            self._samples.popleft()
+
+        for replica in self.replicas:
+            try:
+                # replicas which are down don't stop the app from starting
+                if not replica.db.is_connected:
+                    await replica.db.connect()
+                await replica.update_replay_lsn()
+            except Exception as e:
+                if replica.available:
+                    logger.warning("replica %s is not available: %s", replica.name, e)
+                replica.available = False
+                continue
+            if not replica.available:
+                logger.info("replica %s is available", replica.name)
+            replica.available = True
+            for sample_time, sample_lsn in reversed(self._samples):
+                if sample_lsn <= replica.replay_lsn:
+                    replica.caught_up_at = max(replica.caught_up_at, sample_time)
+                    break
+
+    async def check_periodically(self):
+        while True:
+            try:
+                await self.check()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(e)
+            await asyncio.sleep(settings.db_replica_check_interval)
+
+    def caught_up_at(self, database: Database) -> float:
+        """Time before which commits of the primary are seen in the database"""
+        for replica in self.replicas:
+            if replica.db is database:
+                return replica.caught_up_at
+        return float("inf")
+
+    def _candidates(self, min_lsn: Optional[int]) -> List[Replica]:
+        now = time.monotonic()
+        return [
+            replica
+            for replica in self.replicas
+            if replica.available
+            and replica.lag(now) <= settings.db_replica_max_lag
+            and (min_lsn is None or replica.replay_lsn >= min_lsn)
+        ]
+
+    def choose(self, min_lsn: Optional[int] = None) -> Database:
+        """Replica which is not behind and has replayed min_lsn, or the primary"""
+        candidates = self._candidates(min_lsn)
+        if not candidates:
+            self.primary_reads += 1
+            return self.primary
+        replica = candidates[next(self._turn) % len(candidates)]
+        replica.reads += 1
+        return replica.db
+
+    async def choose_replayed(self, min_lsn: int) -> Database:
+        """
+        Replica which has replayed min_lsn, or the primary. Tokens are
+        usually newer than the last check, replicas which are not behind are
+        asked for their positions then
+        """
+        if not self._candidates(min_lsn):
+            behind = self._candidates(None)
+            await asyncio.gather(
+                *(replica.update_replay_lsn() for replica in behind),
+                return_exceptions=True,
+            )
+        return self.choose(min_lsn)
+
+    async def commit_lsn(self) -> int:
+        """LSN of the primary after every commit finished before the call"""
+        return await self._primary_lsn.fetch()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "primary_reads": self.primary_reads,
+            "replicas": [
+                {
+                    "name": replica.name,
+                    "available": replica.available,
+                    "replay_lsn": format_lsn(replica.replay_lsn),
+                    "lag": round(replica.lag(now), 3) if replica.available else None,
+                    "reads": replica.reads,
+                }
+                for replica in self.replicas
+            ],
+        }
+
+
+class ReplicaMiddleware:
+    """
+    Route reads of GET requests, add X-Session-Token header to responses of
+    successful writes which aren't streamed
+    """
+
+    def __init__(self, app, replicas: ReplicaSet = None):
+        self.app = app
+        self.replicas = replicas or replica_set
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.replicas.replicas:
+            await self.app(scope, receive, send)
+            return
+        if scope["method"] in READ_METHODS:
+            token = None
+            for name, value in scope["headers"]:
+                if name == _SESSION_HEADER:
+                    token = value.decode("latin-1")
+            if token is None:
+                database = self.replicas.choose()
+            else:
+                try:
+                    min_lsn = parse_lsn(token)
+                except ValueError:
+                    # can't tell which writes the client has made
+                    database = self.replicas.primary
+                else:
+                    database = await self.replicas.choose_replayed(min_lsn)
+            with reading_from(database, session=token is not None):
+                await self.app(scope, receive, send)
+            return
+
+        start = None
+
+        async def send_with_token(message):
+            nonlocal start
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                # held until the body shows whether the response is streamed
+                start = message
+                return
+            if start is not None:
+                message_start, start = start, None
+                if not message.get("more_body", False):
+                    message_start = await self._with_token(message_start)
+                await send(message_start)
+            await send(message)
+
+        await self.app(scope, receive, send_with_token)
+
+    async def _with_token(self, message: dict) -> dict:
+        try:
+            lsn = await self.replicas.commit_lsn()
+        except Exception as e:
+            # the write is done, the client keeps its previous token
+            logger.warning("can't get commit LSN: %s", e)
+            return message
+        message = dict(message)
+        message["headers"] = list(message.get("headers", ())) + [
+            (_SESSION_HEADER, format_lsn(lsn).encode())
+        ]
+        return message
+
+
+replica_set = ReplicaSet(settings.db_replica_urls, db)
@@ -2,6 +2,7 @@ import datetime
 import decimal
 import enum
 import uuid
+from typing import List, Optional
 
 from pydantic import BaseModel, Field, validator
 
@@ -17,6 +18,26 @@ class Currency(enum.Enum):
     USD = "USD"
 
 
+class BatchMode(enum.Enum):
+    # all or nothing
+    atomic = "atomic"
+    # each item succeeds or fails on its own
+    independent = "independent"
+
+
+class StatementFormat(enum.Enum):
+    csv = "csv"
+    ndjson = "ndjson"
+
+
+class BatchItemStatus(enum.Enum):
+    ok = "ok"
+    not_found = "not_found"
+    failed = "failed"
+    # atomic batch item not applied because another item failed
+    rolled_back = "rolled_back"
+
+
 def decimal_validator(dec):
     if not (0 <= dec <= settings.max_amount):
         raise ValueError(f"amount in range [{0}, {settings.max_amount}] allowed")
@@ -92,6 +113,23 @@ class TransferMoneyOut(BaseModel):
         return decimal_validator(v)
 
 
+class TransferBatchIn(BaseModel):
+    mode: BatchMode = BatchMode.independent
+    transfers: List[TransferMoneyIn] = Field(
+        ..., min_items=1, max_items=settings.max_batch_size
+    )
+
+
+class TransferBatchItemOut(BaseModel):
+    status: BatchItemStatus
+    result: Optional[TransferMoneyOut] = None
+    error: Optional[str] = None
+
+
+class TransferBatchOut(BaseModel):
+    results: List[TransferBatchItemOut]
+
+
 class ReplenishWalletInfo(BaseModel):
     wallet_id: uuid.UUID
     currency: Currency
@@ -106,6 +144,23 @@ class ReplenishWalletInfo(BaseModel):
         return currency_validator(v)
 
 
+class ReplenishBatchIn(BaseModel):
+    mode: BatchMode = BatchMode.independent
+    replenishments: List[ReplenishWalletInfo] = Field(
+        ..., min_items=1, max_items=settings.max_batch_size
+    )
+
+
+class ReplenishBatchItemOut(BaseModel):
+    status: BatchItemStatus
+    result: Optional[ReplenishWalletInfo] = None
+    error: Optional[str] = None
+
+
+class ReplenishBatchOut(BaseModel):
+    results: List[ReplenishBatchItemOut]
+
+
 class ReplenishTransaction(BaseModel):
     wallet_id: uuid.UUID
     currency: Currency
@@ -118,3 +173,49 @@ class ReplenishTransaction(BaseModel):
     @validator("currency")
     def currency_validator(cls, v):
         return currency_validator(v)
+
+
+class PostingOut(BaseModel):
+    transaction_id: int
+    type: TransactionType
+    amount: decimal.Decimal
+    currency: Currency
+    created_at: datetime.datetime
+
+
+class PostingsPage(BaseModel):
+    postings: List[PostingOut]
+    # pass as cursor to get the next page, null on the last page
+    next_cursor: Optional[str] = None
+
+
+class BalanceOut(BaseModel):
+    wallet_id: uuid.UUID
+    at: datetime.datetime
+    currency: Currency
+    amount: decimal.Decimal
+
+
+class CurrencyStats(BaseModel):
+    currency: Currency
+    # money comes into the system only by replenishments
+    in_circulation: decimal.Decimal
+    transfers: int
+    transfer_volume: decimal.Decimal
+    replenishments: int
+    replenished: decimal.Decimal
+
+
+class DailyStats(BaseModel):
+    day: datetime.date
+    currency: Currency
+    transfers: int
+    transfer_volume: decimal.Decimal
+    replenishments: int
+    replenished: decimal.Decimal
+
+
+class LedgerStatsOut(BaseModel):
+    totals: List[CurrencyStats]
+    # the last days, oldest first
+    days: List[DailyStats]
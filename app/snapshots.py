@@ -0,0 +1,150 @@
+"""
+Balance snapshots: balances of wallets at period boundaries (multiples of
+settings.balance_snapshot_period seconds since the epoch) saved to
+balance_snapshot, so balance at a moment is the nearest earlier snapshot of
+the wallet plus its postings after it (wallet_balance_at stored function).
+A wallet gets a row only for periods with its postings: its previous
+snapshot plus postings of the period. Periods are taken in order by the app
+and by `python -m app.cli snapshot-balances`, taken boundaries are recorded
+in balance_snapshot_run
+"""
+import asyncio
+import datetime
+import logging
+import time
+from typing import List
+
+from app import partitions
+from app.config import settings
+from app.database import db
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+SELECT_LAST_RUN = "SELECT max(taken_at) FROM balance_snapshot_run;"
+# posting.created_at is the start of its transaction, so postings before a
+# boundary may be inserted until transactions started before it end
+SELECT_RUNNING_BEFORE = (
+    "SELECT count(*) FROM pg_stat_activity "
+    "WHERE datname = current_database() AND backend_type = 'client backend' "
+    "AND pid <> pg_backend_pid() AND xact_start < :boundary;"
+)
+SELECT_ARCHIVED_POSTINGS = (
+    "SELECT format('%I.%I', schemaname, tablename) FROM pg_tables "
+    "WHERE schemaname = :schema AND tablename LIKE 'posting\\_%';"
+)
+INSERT_SNAPSHOTS = (
+    "WITH taken AS ("
+    "INSERT INTO balance_snapshot(wallet_id, taken_at, amount) "
+    "SELECT period.wallet_id, :taken_at, "
+    "coalesce(previous.amount, 0) + period.amount "
+    "FROM ("
+    "SELECT wallet_id, sum(amount) AS amount FROM {postings} "
+    "WHERE created_at >= :since AND created_at < :taken_at GROUP BY wallet_id"
+    ") AS period "
+    "LEFT JOIN LATERAL ("
+    "SELECT amount FROM balance_snapshot "
+    "WHERE balance_snapshot.wallet_id = period.wallet_id "
+    "ORDER BY taken_at DESC LIMIT 1"
+    ") AS previous ON true RETURNING wallet_id"
+    ") "
+    "INSERT INTO balance_snapshot_run(taken_at, wallets) "
+    "SELECT :taken_at, count(*) FROM taken;"
+)
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def period_start(moment: datetime.datetime) -> datetime.datetime:
+    """The last boundary up to the moment"""
+    period = datetime.timedelta(seconds=settings.balance_snapshot_period)
+    return EPOCH + (moment - EPOCH) // period * period
+
+
+async def _wait_for_transactions(boundary: datetime.datetime):
+    deadline = time.monotonic() + settings.balance_snapshot_wait_timeout
+    while True:
+        running = await db.fetch_val(SELECT_RUNNING_BEFORE, {"boundary": boundary})
+        if not running:
+            return
+        if time.monotonic() > deadline:
+            raise SnapshotError(
+                f"{running} transactions started before {boundary.isoformat()} "
+                f"are running longer than {settings.balance_snapshot_wait_timeout} "
+                f"seconds"
+            )
+        await asyncio.sleep(0.1)
+
+
+async def _postings_source() -> str:
+    """Postings of all time for the first snapshot, archived ones included"""
+    archived = await db.fetch_all(
+        SELECT_ARCHIVED_POSTINGS, {"schema": partitions.ARCHIVE_SCHEMA}
+    )
+    tables = ["posting"] + [row[0] for row in archived]
+    union = " UNION ALL ".join(
+        f"SELECT wallet_id, amount, created_at FROM {table}" for table in tables
+    )
+    return f"({union}) AS posting"
+
+
+async def take_snapshots(now: datetime.datetime = None) -> List[datetime.datetime]:
+    """
+    Take snapshots of boundaries after the last taken one up to now, return
+    the boundaries. The first run starts from the boundary after the first
+    posting, so snapshots cover the whole history
+    """
+    period = datetime.timedelta(seconds=settings.balance_snapshot_period)
+    if now is None:
+        # the clock of created_at of postings
+        now = await db.fetch_val("SELECT clock_timestamp();")
+    end = period_start(now)
+    last = await db.fetch_val(SELECT_LAST_RUN)
+    if last is None:
+        first = await db.fetch_val(
+            f"SELECT min(created_at) FROM {await _postings_source()};"
+        )
+        start = end if first is None else min(period_start(first) + period, end)
+    else:
+        start = last + period
+    if start > end:
+        return []
+    await _wait_for_transactions(end)
+
+    taken = []
+    boundary = start
+    while boundary <= end:
+        async with db.transaction():
+            # one run at a time across app workers and cli
+            await db.execute("SELECT pg_advisory_xact_lock(hashtext('snapshots'));")
+            last = await db.fetch_val(SELECT_LAST_RUN)
+            if last is None or last < boundary:
+                if last is None:
+                    postings = await _postings_source()
+                    since = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+                else:
+                    postings, since = "posting", last
+                await db.execute(
+                    INSERT_SNAPSHOTS.format(postings=postings),
+                    {"since": since, "taken_at": boundary},
+                )
+                taken.append(boundary)
+        boundary += period
+    return taken
+
+
+async def take_periodically():
+    while True:
+        try:
+            taken = await take_snapshots()
+            if taken:
+                logger.info(
+                    "balance snapshots taken at %s",
+                    ", ".join(boundary.isoformat() for boundary in taken),
+                )
+        except Exception as e:
+            logger.exception(e)
+        await asyncio.sleep(settings.balance_snapshot_check_interval)
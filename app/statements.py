@@ -0,0 +1,135 @@
+"""
+Wallet statements: postings created in [since, until), oldest first, with
+the running balance of the wallet after every posting, as CSV or NDJSON.
+The opening balance (wallet_balance_at before since) and postings
+(archived partitions included) are read in one repeatable read snapshot;
+postings are read from a server-side cursor by settings.statement_chunk_size
+rows and sent as they are formatted, so memory of the app doesn't depend on
+the length of the statement
+"""
+import csv
+import datetime
+import decimal
+import io
+import uuid
+from typing import AsyncIterator, Iterable, List, Optional
+
+import asyncpg
+
+from app import crud, dal, ndjson, partitions, replicas
+from app.config import settings
+from app.schemas import StatementFormat
+
+CSV_MEDIA_TYPE = "text/csv"
+FIELDS = ("created_at", "transaction_id", "type", "amount", "currency", "balance")
+
+SELECT_ARCHIVED_POSTINGS = (
+    "SELECT tablename FROM pg_tables "
+    "WHERE schemaname = $1 AND tablename LIKE 'posting\\_%';"
+)
+# postings of an archived month are looked up in its archived transactions
+SELECT_POSTINGS = (
+    "SELECT posting.created_at, posting.transaction_id, "
+    "(SELECT type FROM {transaction} AS transaction "
+    "WHERE transaction.id = posting.transaction_id "
+    "AND transaction.created_at = posting.created_at) AS type, "
+    "posting.amount, posting.currency, posting.id "
+    "FROM {posting} AS posting "
+    "WHERE posting.wallet_id = $1 AND posting.created_at >= $2 "
+    "AND posting.created_at < $3"
+)
+
+MIN_TIME = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+MAX_TIME = datetime.datetime.max.replace(tzinfo=datetime.timezone.utc)
+
+
+def media_type(statement_format: StatementFormat) -> str:
+    if statement_format is StatementFormat.csv:
+        return CSV_MEDIA_TYPE
+    return ndjson.MEDIA_TYPE
+
+
+async def _select_postings(connection: asyncpg.Connection) -> str:
+    archived = await connection.fetch(
+        SELECT_ARCHIVED_POSTINGS, partitions.ARCHIVE_SCHEMA
+    )
+    tables = [("posting", "transaction")] + [
+        (
+            f'{partitions.ARCHIVE_SCHEMA}."{name}"',
+            f'{partitions.ARCHIVE_SCHEMA}."transaction{name[len("posting"):]}"',
+        )
+        for name in sorted(row[0] for row in archived)
+    ]
+    union = " UNION ALL ".join(
+        SELECT_POSTINGS.format(posting=posting, transaction=transaction)
+        for posting, transaction in tables
+    )
+    return f"{union} ORDER BY created_at, transaction_id, id"
+
+
+def _format_csv(rows: Iterable[tuple]) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerows(rows)
+    return buffer.getvalue().encode()
+
+
+def _format_ndjson(rows: Iterable[tuple]) -> bytes:
+    return b"".join(ndjson.dumps(dict(zip(FIELDS, row))) for row in rows)
+
+
+async def stream(
+    wallet_id: uuid.UUID,
+    since: Optional[datetime.datetime],
+    until: Optional[datetime.datetime],
+    statement_format: StatementFormat,
+) -> AsyncIterator[bytes]:
+    """
+    Statement of the wallet by chunks of lines. The first chunk (CSV header,
+    empty for NDJSON) is yielded after the wallet is found, so NotFound is
+    raised before anything is sent
+    """
+    if statement_format is StatementFormat.csv:
+        format_rows, header = _format_csv, _format_csv([FIELDS])
+    else:
+        format_rows, header = _format_ndjson, b""
+    # created_at has microsecond resolution: the balance before since
+    opening_at = MIN_TIME
+    if since is not None:
+        opening_at = since - datetime.timedelta(microseconds=1)
+    async with replicas.database().connection() as connection:
+        raw_connection = connection.raw_connection
+        # nested into outer transaction (tests) uses its snapshot
+        isolation = None
+        if not raw_connection.is_in_transaction():
+            isolation = "repeatable_read"
+        async with raw_connection.transaction(isolation=isolation, readonly=True):
+            opening = await dal.select_balance_at(wallet_id, opening_at)
+            if opening["currency"] is None:
+                raise crud.NotFound("wallet", {"wallet_id": wallet_id})
+            yield header
+
+            balance: decimal.Decimal = opening["amount"]
+            cursor = await raw_connection.cursor(
+                await _select_postings(raw_connection),
+                wallet_id,
+                MIN_TIME if since is None else since,
+                MAX_TIME if until is None else until,
+            )
+            while True:
+                rows = await cursor.fetch(settings.statement_chunk_size)
+                if not rows:
+                    return
+                lines: List[tuple] = []
+                for created_at, transaction_id, type_, amount, currency, _ in rows:
+                    balance += amount
+                    lines.append(
+                        (
+                            created_at.isoformat(),
+                            transaction_id,
+                            type_,
+                            str(amount),
+                            currency,
+                            str(balance),
+                        )
+                    )
+                yield format_rows(lines)
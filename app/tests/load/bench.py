@@ -0,0 +1,478 @@
+"""
+Load benchmark of the HTTP API.
+
+Starts a throwaway Postgres (initdb from --pg-bin or PATH, must not run as
+root) and the app under gunicorn, creates and funds wallets through the API
+and runs one workload profile against it:
+- uniform: transfers between random wallets
+- zipf: transfers between wallets picked by Zipf law, few wallets are hot
+- bidirectional: transfers back and forth within wallet pairs
+- read-heavy: --read-ratio of GET /accounts/{account_id}, transfers otherwise
+
+With --rate requests are sent open loop at constant arrival rate and latency
+is measured from the time the request was scheduled to be sent, so a stalled
+server is not hidden by the client waiting for it (coordinated omission).
+Without --rate --concurrency clients send requests one after another.
+
+Results (p50/p99/p999 latency, throughput and errors by operation) are written
+as JSON to --output and compared with a saved --baseline run:
+    python -m app.tests.load.bench --profile zipf --rate 500 --duration 30 \\
+        --output zipf.json --baseline zipf-base.json --max-regression 10
+Pass --database-url and/or --url to use already running database or app
+"""
+
+import argparse
+import asyncio
+import collections
+import contextlib
+import datetime
+import decimal
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import aiohttp
+
+ROOT_DIR = os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+)
+APP_DIR = os.path.join(ROOT_DIR, "app")
+PROFILES = ("uniform", "zipf", "bidirectional", "read-heavy")
+PERCENTILES = (("p50", 0.5), ("p99", 0.99), ("p999", 0.999))
+INITIAL_AMOUNT = decimal.Decimal(10 ** 9)
+TRANSFER_AMOUNT = "0.01"
+# accounts per setup request
+SETUP_CHUNK_SIZE = 1000
+
+Request = Tuple[str, str, str, Optional[dict]]  # operation, method, path, json
+
+
+class Sample(NamedTuple):
+    operation: str
+    scheduled: float
+    sent: float
+    finished: float
+    outcome: str  # "ok", status code or exception name
+
+
+def free_port() -> int:
+    with contextlib.closing(socket.socket()) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class LocalPostgres:
+    """Postgres cluster in a temporary directory, removed on stop"""
+
+    def __init__(self, bin_dir: Optional[str]):
+        initdb = shutil.which("initdb", path=bin_dir)
+        if initdb is None:
+            raise SystemExit("initdb not found: pass --pg-bin or --database-url")
+        self.bin_dir = os.path.dirname(initdb)
+        self.dir = tempfile.mkdtemp(prefix="bench-pg-")
+        self.port = free_port()
+        self.url = f"postgresql://bench@127.0.0.1:{self.port}/bench"
+
+    def _run(self, name, *args):
+        command = [os.path.join(self.bin_dir, name), *args]
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+
+    def start(self):
+        data_dir = os.path.join(self.dir, "data")
+        self._run("initdb", "-D", data_dir, "-U", "bench", "--auth=trust")
+        options = f"-p {self.port} -k {self.dir} -c listen_addresses=127.0.0.1"
+        log = os.path.join(self.dir, "postgres.log")
+        self._run("pg_ctl", "-D", data_dir, "-l", log, "-o", options, "-w", "start")
+        self._run(
+            "createdb", "-h", "127.0.0.1", "-p", str(self.port), "-U", "bench", "bench"
+        )
+
+    def stop(self):
+        data_dir = os.path.join(self.dir, "data")
+        if os.path.exists(data_dir):
+            self._run("pg_ctl", "-D", data_dir, "-m", "fast", "-w", "stop")
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def migrate(database_url: str):
+    env = dict(os.environ, DATABASE_URL=database_url, PYTHONPATH=ROOT_DIR)
+    subprocess.run(
+        [sys.executable, "-m", "alembic", "upgrade", "head"],
+        cwd=APP_DIR,
+        env=env,
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+class AppServer:
+    """The app under gunicorn with uvicorn workers"""
+
+    def __init__(self, database_url: str, workers: int):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.metrics_dir = tempfile.mkdtemp(prefix="bench-metrics-")
+        self.env = dict(
+            os.environ,
+            DATABASE_URL=database_url,
+            TESTING="0",
+            PROMETHEUS_MULTIPROC_DIR=self.metrics_dir,
+        )
+        self.workers = workers
+        self.process = None
+
+    def start(self):
+        command = [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "app.main:app",
+            "--worker-class",
+            "uvicorn.workers.UvicornWorker",
+            "--workers",
+            str(self.workers),
+            "--bind",
+            f"127.0.0.1:{self.port}",
+        ]
+        self.process = subprocess.Popen(command, cwd=ROOT_DIR, env=self.env)
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+        shutil.rmtree(self.metrics_dir, ignore_errors=True)
+
+
+async def wait_ready(session: aiohttp.ClientSession, url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            async with session.get(f"{url}/pool/stats") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        if time.monotonic() > deadline:
+            raise SystemExit(f"app at {url} is not ready in {timeout} s")
+        await asyncio.sleep(0.2)
+
+
+async def create_accounts(
+    session: aiohttp.ClientSession, url: str, num: int
+) -> List[Tuple[str, str]]:
+    """Create and fund accounts, return (account_id, wallet_id) list"""
+    accounts = []
+    for start in range(0, num, SETUP_CHUNK_SIZE):
+        names = [{"name": "bench"} for _ in range(min(SETUP_CHUNK_SIZE, num - start))]
+        async with session.post(f"{url}/accounts/bulk", json=names) as response:
+            response.raise_for_status()
+            created = [json.loads(line) async for line in response.content]
+        errors = [line for line in created if "error" in line]
+        if errors:
+            raise SystemExit(f"can't create accounts: {errors[0]}")
+        replenishments = [
+            {
+                "wallet_id": line["wallet_id"],
+                "amount": str(INITIAL_AMOUNT),
+                "currency": "USD",
+            }
+            for line in created
+        ]
+        body = {"mode": "atomic", "replenishments": replenishments}
+        async with session.post(f"{url}/replenish/batch", json=body) as response:
+            response.raise_for_status()
+        accounts.extend((line["account_id"], line["wallet_id"]) for line in created)
+    return accounts
+
+
+def transfer(from_wallet_id: str, to_wallet_id: str) -> Request:
+    body = {
+        "from_wallet_id": from_wallet_id,
+        "from_currency": "USD",
+        "to_wallet_id": to_wallet_id,
+        "to_currency": "USD",
+        "amount": TRANSFER_AMOUNT,
+    }
+    return "transfer", "POST", "/transfer", body
+
+
+def make_profile(
+    name: str, accounts: List[Tuple[str, str]], rng: random.Random, args
+) -> Callable[[], Request]:
+    """Return function which makes next request of the profile"""
+    wallet_ids = [wallet_id for _, wallet_id in accounts]
+
+    if name == "uniform":
+        return lambda: transfer(*rng.sample(wallet_ids, 2))
+
+    if name == "zipf":
+        weights = [1 / rank ** args.zipf_s for rank in range(1, len(wallet_ids) + 1)]
+        cum_weights = list(itertools.accumulate(weights))
+
+        def zipf_transfer():
+            while True:
+                from_wallet_id, to_wallet_id = rng.choices(
+                    wallet_ids, cum_weights=cum_weights, k=2
+                )
+                if from_wallet_id != to_wallet_id:
+                    return transfer(from_wallet_id, to_wallet_id)
+
+        return zipf_transfer
+
+    if name == "bidirectional":
+
+        def pair_transfer():
+            i = rng.randrange(0, len(wallet_ids) - 1, 2)
+            return transfer(*rng.sample(wallet_ids[i:i + 2], 2))
+
+        return pair_transfer
+
+    if name == "read-heavy":
+
+        def read_or_transfer():
+            if rng.random() < args.read_ratio:
+                account_id, _ = rng.choice(accounts)
+                return "get_account", "GET", f"/accounts/{account_id}", None
+            return transfer(*rng.sample(wallet_ids, 2))
+
+        return read_or_transfer
+
+    raise ValueError(f"unknown profile {name}")
+
+
+async def send(
+    session: aiohttp.ClientSession, url: str, request: Request, scheduled: float
+) -> Sample:
+    operation, method, path, body = request
+    sent = time.perf_counter()
+    try:
+        async with session.request(method, url + path, json=body) as response:
+            await response.read()
+            outcome = "ok" if response.status < 400 else str(response.status)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        outcome = type(e).__name__
+    return Sample(operation, scheduled, sent, time.perf_counter(), outcome)
+
+
+async def run_open_loop(session, url, next_request, rate, duration) -> List[Sample]:
+    """Send requests at constant rate regardless of responses"""
+    start = time.perf_counter()
+    tasks = []
+    for i in itertools.count():
+        scheduled = start + i / rate
+        if scheduled - start >= duration:
+            break
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(
+            asyncio.ensure_future(send(session, url, next_request(), scheduled))
+        )
+    return await asyncio.gather(*tasks)
+
+
+async def run_closed_loop(session, url, next_request, concurrency, duration):
+    """Every client sends next request when previous one is answered"""
+    end = time.perf_counter() + duration
+    samples = []
+
+    async def client():
+        while time.perf_counter() < end:
+            samples.append(
+                await send(session, url, next_request(), time.perf_counter())
+            )
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return samples
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile"""
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def latency_stats(values: List[float]) -> dict:
+    values = sorted(value * 1000 for value in values)
+    if not values:
+        return {}
+    stats = {name: round(percentile(values, q), 3) for name, q in PERCENTILES}
+    stats["max"] = round(values[-1], 3)
+    stats["mean"] = round(sum(values) / len(values), 3)
+    return stats
+
+
+def summarize(samples: List[Sample], duration: float) -> Dict[str, dict]:
+    """Stats by operation and of all requests ("all")"""
+    by_operation = collections.defaultdict(list)
+    for sample in samples:
+        by_operation[sample.operation].append(sample)
+        by_operation["all"].append(sample)
+
+    summary = {}
+    for operation, operation_samples in sorted(by_operation.items()):
+        outcomes = collections.Counter(sample.outcome for sample in operation_samples)
+        summary[operation] = {
+            "requests": len(operation_samples),
+            "throughput": round(outcomes["ok"] / duration, 1),
+            "errors": {k: v for k, v in sorted(outcomes.items()) if k != "ok"},
+            # from scheduled time, includes time the request waited to be sent
+            "latency_ms": latency_stats(
+                [sample.finished - sample.scheduled for sample in operation_samples]
+            ),
+            "service_time_ms": latency_stats(
+                [sample.finished - sample.sent for sample in operation_samples]
+            ),
+        }
+    return summary
+
+
+def compare(run: dict, baseline: dict, max_regression: Optional[float]) -> bool:
+    """Print changes against baseline, return False if latency regressed"""
+    ok = True
+    print(f"{'operation':<14}{'metric':<12}{'baseline':>12}{'run':>12}{'change':>10}")
+    for operation, stats in run["results"].items():
+        base_stats = baseline["results"].get(operation)
+        if base_stats is None:
+            continue
+        metrics = [("throughput", stats["throughput"], base_stats["throughput"])]
+        for name, _ in PERCENTILES:
+            metrics.append(
+                (
+                    name,
+                    stats["latency_ms"].get(name),
+                    base_stats["latency_ms"].get(name),
+                )
+            )
+        for metric, value, base_value in metrics:
+            if not value or not base_value:
+                continue
+            change = (value - base_value) / base_value * 100
+            worse = -change if metric == "throughput" else change
+            mark = ""
+            if max_regression is not None and worse > max_regression:
+                mark = " !"
+                ok = False
+            print(
+                f"{operation:<14}{metric:<12}{base_value:>12}{value:>12}"
+                f"{change:>+9.1f}%{mark}"
+            )
+    return ok
+
+
+def git_commit() -> Optional[str]:
+    result = subprocess.run(
+        ["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True
+    )
+    return result.stdout.strip() or None
+
+
+async def bench(args, url: str) -> dict:
+    rng = random.Random(args.seed)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        await wait_ready(session, url)
+        accounts = await create_accounts(session, url, args.accounts)
+        next_request = make_profile(args.profile, accounts, rng, args)
+
+        if args.warmup:
+            await run_closed_loop(
+                session, url, next_request, args.concurrency, args.warmup
+            )
+        if args.rate:
+            samples = await run_open_loop(
+                session, url, next_request, args.rate, args.duration
+            )
+        else:
+            samples = await run_closed_loop(
+                session, url, next_request, args.concurrency, args.duration
+            )
+
+    return {
+        "meta": {
+            "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "args": vars(args),
+        },
+        "results": summarize(samples, args.duration),
+    }
+
+
+def main(args) -> int:
+    postgres = server = None
+    try:
+        url = args.url
+        if url is None:
+            database_url = args.database_url
+            if database_url is None:
+                postgres = LocalPostgres(args.pg_bin)
+                postgres.start()
+                database_url = postgres.url
+            migrate(database_url)
+            server = AppServer(database_url, args.workers)
+            server.start()
+            url = server.url
+        run = asyncio.run(bench(args, url))
+    finally:
+        if server is not None:
+            server.stop()
+        if postgres is not None:
+            postgres.stop()
+
+    print(json.dumps(run["results"], indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(run, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(run, baseline, args.max_regression):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="load benchmark of the API")
+    parser.add_argument("--profile", choices=PROFILES, default="uniform")
+    parser.add_argument(
+        "--rate",
+        type=float,
+        help="requests per second (open loop); closed loop if not set",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=10, help="clients of closed loop and warmup"
+    )
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds")
+    parser.add_argument("--accounts", type=int, default=1000)
+    parser.add_argument("--zipf-s", type=float, default=1.1, help="zipf exponent")
+    parser.add_argument("--read-ratio", type=float, default=0.9)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=30, help="request timeout")
+    parser.add_argument(
+        "--connections", type=int, default=1000, help="max open client connections"
+    )
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--pg-bin", help="directory with initdb and pg_ctl")
+    parser.add_argument("--database-url", help="use this database, don't start one")
+    parser.add_argument("--url", help="use app running at this url, don't start it")
+    parser.add_argument("--output", help="write results JSON to the file")
+    parser.add_argument("--baseline", help="compare with results JSON of other run")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        help="exit with 1 if p50/p99/p999 or throughput is worse by more percent",
+    )
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,180 @@
+"""
+Micro-benchmark of crud hot statements: databases text queries (named
+parameters compiled by SQLAlchemy on every call) against app/dal.py
+(asyncpg prepared statements with positional arguments).
+
+Run against a migrated database (TESTING=0):
+    python -m app.tests.load.bench_dal --wallets 100 --calls 5000
+"""
+import argparse
+import asyncio
+import decimal
+import random
+import time
+import uuid
+
+from app import crud, dal
+from app.config import settings
+from app.database import db
+from app.schemas import AccountCreateIn, Currency, TransactionType
+
+# replenish of the baseline as prepared statements, crud credits a wallet
+# with one credit_wallet call now
+SELECT_WALLET_FOR_UPDATE = (
+    "SELECT id, account_id, currency, amount FROM wallet "
+    "WHERE id = $1 AND currency = $2 FOR UPDATE;"
+)
+UPDATE_WALLET_AMOUNT = "UPDATE wallet SET amount = $2 WHERE id = $1;"
+
+
+async def legacy_get_account(account_id):
+    query = (
+        "SELECT "
+        "account.id as account_id, account.name, "
+        "account.created_at, wallet.id as wallet_id, "
+        "wallet.currency, wallet.amount "
+        "FROM account JOIN wallet "
+        "ON wallet.account_id = account.id  "
+        "WHERE  account.id = :account_id;"
+    )
+    return await db.fetch_one(query=query, values={"account_id": account_id})
+
+
+async def legacy_replenish(wallet_id, amount):
+    async with db.transaction():
+        query = (
+            "SELECT * FROM wallet WHERE id = :wallet_id "
+            "AND currency = :currency FOR UPDATE;"
+        )
+        values = {"wallet_id": wallet_id, "currency": Currency.USD.value}
+        wallet = await db.fetch_one(query=query, values=values)
+        update = "UPDATE wallet SET amount = :amount WHERE id = :wallet_id;"
+        values = {"amount": wallet["amount"] + amount, "wallet_id": wallet_id}
+        await db.execute(update, values=values)
+        transaction_id = await db.execute(
+            "INSERT INTO transaction(type) VALUES(:transaction_type) RETURNING id;",
+            values={"transaction_type": TransactionType.replenish.value},
+        )
+        add_posting = (
+            "INSERT INTO posting(transaction_id, wallet_id, amount, currency) "
+            "VALUES(:transaction_id, :wallet_id, :amount, :currency);"
+        )
+        values = {
+            "transaction_id": transaction_id,
+            "wallet_id": wallet_id,
+            "amount": amount,
+            "currency": Currency.USD.value,
+        }
+        await db.execute(add_posting, values=values)
+
+
+async def dal_replenish(wallet_id, amount):
+    async with db.transaction(), db.connection() as connection:
+        wallet = await connection.raw_connection.fetchrow(
+            SELECT_WALLET_FOR_UPDATE, wallet_id, Currency.USD.value
+        )
+        await connection.raw_connection.execute(
+            UPDATE_WALLET_AMOUNT, wallet_id, wallet["amount"] + amount
+        )
+        await dal.insert_transaction_with_posting(
+            TransactionType.replenish.value, wallet_id, amount, Currency.USD.value
+        )
+
+
+async def legacy_transfer_money(from_wallet_id, to_wallet_id, amount):
+    query = (
+        "SELECT status, from_amount, to_amount FROM transfer_money("
+        ":from_wallet_id, :from_currency, :to_wallet_id, :to_currency, "
+        ":amount, :max_amount, :transaction_type);"
+    )
+    values = {
+        "from_wallet_id": from_wallet_id,
+        "from_currency": Currency.USD.value,
+        "to_wallet_id": to_wallet_id,
+        "to_currency": Currency.USD.value,
+        "amount": amount,
+        "max_amount": settings.max_amount,
+        "transaction_type": TransactionType.transfer.value,
+    }
+    return await db.fetch_one(query=query, values=values)
+
+
+async def dal_transfer_money(from_wallet_id, to_wallet_id, amount):
+    return await dal.transfer_money(
+        from_wallet_id,
+        Currency.USD.value,
+        to_wallet_id,
+        Currency.USD.value,
+        amount,
+        settings.max_amount,
+        TransactionType.transfer.value,
+    )
+
+
+async def create_accounts(num):
+    accounts = []
+    for i in range(num):
+        account = await crud.create_account_with_wallet(AccountCreateIn(name="bench"))
+        wallet_id = uuid.UUID(account.wallet_id)
+        await db.execute(
+            "UPDATE wallet SET amount = :amount WHERE id = :wallet_id;",
+            {"amount": decimal.Decimal(10 ** 9), "wallet_id": wallet_id},
+        )
+        accounts.append((uuid.UUID(account.account_id), wallet_id))
+    return accounts
+
+
+async def run(call, calls, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with sem:
+            await call()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(calls)))
+    return int(calls / (time.perf_counter() - start))
+
+
+async def main(args):
+    await db.connect()
+    try:
+        # databases keeps connection in a context variable, so setup runs in
+        # its own task to not share one connection with all calls
+        accounts = await asyncio.ensure_future(create_accounts(args.wallets))
+        account_ids = [account_id for account_id, _ in accounts]
+        wallet_ids = [wallet_id for _, wallet_id in accounts]
+        amount = decimal.Decimal("0.01")
+        cases = [
+            (
+                "get account",
+                lambda: legacy_get_account(random.choice(account_ids)),
+                lambda: dal.select_account_with_wallet(random.choice(account_ids)),
+            ),
+            (
+                "replenish",
+                lambda: legacy_replenish(random.choice(wallet_ids), amount),
+                lambda: dal_replenish(random.choice(wallet_ids), amount),
+            ),
+            (
+                "transfer_money",
+                lambda: legacy_transfer_money(*random.sample(wallet_ids, 2), amount),
+                lambda: dal_transfer_money(*random.sample(wallet_ids, 2), amount),
+            ),
+        ]
+        for name, legacy, prepared in cases:
+            legacy_rps = await run(legacy, args.calls, args.concurrency)
+            prepared_rps = await run(prepared, args.calls, args.concurrency)
+            print(f"{name}: databases {legacy_rps} rps, dal {prepared_rps} rps")
+    finally:
+        await db.disconnect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark app/dal.py statements")
+    parser.add_argument(
+        "--wallets", type=int, default=100, help="num wallets to create"
+    )
+    parser.add_argument("--calls", type=int, default=5000, help="num calls of each")
+    parser.add_argument("--concurrency", type=int, default=10, help="parallel calls")
+    asyncio.run(main(parser.parse_args()))
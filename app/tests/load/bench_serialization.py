@@ -0,0 +1,104 @@
+"""
+CPU time of the app process per request of GET /accounts/{account_id},
+POST /replenish and POST /transfer. Requests are passed to the ASGI app
+directly (no HTTP server and client in the measurement), time of the
+database process is not counted.
+
+Run against a migrated database (TESTING=0):
+    python -m app.tests.load.bench_serialization --requests 5000
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from app import crud
+from app.database import db
+from app.main import app
+from app.schemas import AccountCreateIn, Currency, ReplenishWalletInfo
+
+
+async def call(method: str, path: str, body: dict = None):
+    """Call the app as ASGI server would, return status and response body"""
+    content = json.dumps(body).encode() if body is not None else b""
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"content-type", b"application/json")],
+        "server": ("bench", 80),
+        "client": ("bench", 1),
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": content, "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    return messages[0]["status"], b"".join(m.get("body", b"") for m in messages[1:])
+
+
+async def measure(name, requests, method, path, body=None):
+    status, response = await call(method, path, body)
+    assert status == 200, response
+    cpu, wall = time.process_time(), time.perf_counter()
+    for _ in range(requests):
+        await call(method, path, body)
+    cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+    print(
+        f"{name}: {cpu / requests * 1e6:.0f} us CPU, "
+        f"{wall / requests * 1e6:.0f} us wall per request"
+    )
+
+
+async def main(args):
+    await db.connect()
+    try:
+        accounts = []
+        for _ in range(2):
+            account = await crud.create_account_with_wallet(
+                AccountCreateIn(name="bench")
+            )
+            await crud.replenish(
+                ReplenishWalletInfo(
+                    wallet_id=account.wallet_id, currency=Currency.USD, amount=10 ** 9
+                )
+            )
+            accounts.append(account)
+        from_account, to_account = accounts
+
+        await measure(
+            "get account", args.requests, "GET", f"/accounts/{from_account.account_id}"
+        )
+        replenish = {
+            "wallet_id": to_account.wallet_id,
+            "currency": Currency.USD.value,
+            "amount": "0.01",
+        }
+        await measure("replenish", args.requests, "POST", "/replenish", replenish)
+        transfer = {
+            "from_wallet_id": from_account.wallet_id,
+            "from_currency": Currency.USD.value,
+            "to_wallet_id": to_account.wallet_id,
+            "to_currency": Currency.USD.value,
+            "amount": "0.01",
+        }
+        await measure("transfer", args.requests, "POST", "/transfer", transfer)
+    finally:
+        await db.disconnect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark CPU time per request")
+    parser.add_argument(
+        "--requests", type=int, default=5000, help="num requests to each endpoint"
+    )
+    asyncio.run(main(parser.parse_args()))
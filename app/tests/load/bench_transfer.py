@@ -0,0 +1,182 @@
+"""
+Compare crud.transfer (transfer_money stored function, one round trip)
+with the previous implementation (select for update, update and insert
+statements sent one by one inside a transaction).
+
+Run against a migrated database (TESTING=0), add --coalesce-window 0.002
+to compare with group commit of transfers (app/batcher.py):
+    python -m app.tests.load.bench_transfer --wallets 100 --transfers 5000
+"""
+import argparse
+import asyncio
+import decimal
+import random
+import statistics
+import time
+import uuid
+
+from app import crud
+from app.batcher import TransferBatcher
+from app.config import settings
+from app.database import db
+from app.schemas import (AccountCreateIn, Currency, TransactionType,
+                         TransferMoneyIn, TransferMoneyOut)
+
+
+async def legacy_get_wallet(wallet_id, currency):
+    query = (
+        "SELECT * FROM wallet WHERE id = :wallet_id "
+        "AND currency = :currency FOR UPDATE;"
+    )
+    values = {"wallet_id": wallet_id, "currency": currency.value}
+    wallet = await db.fetch_one(query=query, values=values)
+    if wallet is None:
+        raise crud.NotFound("wallet", values)
+    return wallet
+
+
+async def legacy_transfer(data: TransferMoneyIn) -> TransferMoneyOut:
+    """crud.transfer before it was moved to transfer_money stored function"""
+    async with db.transaction():
+        from_wallet = await legacy_get_wallet(data.from_wallet_id, data.from_currency)
+        from_wallet_amount = from_wallet["amount"] - data.amount
+        if from_wallet_amount < 0:
+            raise crud.CRUDException("not enough amount")
+        to_wallet = await legacy_get_wallet(data.to_wallet_id, data.to_currency)
+        to_wallet_amount = to_wallet["amount"] + data.amount
+        if to_wallet_amount > settings.max_amount:
+            raise crud.CRUDException("max amount exceeded")
+
+        update_wallet = "UPDATE wallet SET amount = :amount WHERE id = :wallet_id;"
+        await db.execute(
+            update_wallet,
+            {"wallet_id": data.from_wallet_id, "amount": from_wallet_amount},
+        )
+        await db.execute(
+            update_wallet, {"wallet_id": data.to_wallet_id, "amount": to_wallet_amount}
+        )
+        transaction_id = await db.execute(
+            "INSERT INTO transaction(type) VALUES (:transaction_type) RETURNING id;",
+            {"transaction_type": TransactionType.transfer.value},
+        )
+        add_posting = (
+            "INSERT INTO posting(transaction_id, wallet_id, amount, currency) "
+            "VALUES(:transaction_id, :wallet_id, :amount, :currency);"
+        )
+        await db.execute(
+            add_posting,
+            {
+                "transaction_id": transaction_id,
+                "wallet_id": data.from_wallet_id,
+                "amount": -data.amount,
+                "currency": data.from_currency.value,
+            },
+        )
+        await db.execute(
+            add_posting,
+            {
+                "transaction_id": transaction_id,
+                "wallet_id": data.to_wallet_id,
+                "amount": data.amount,
+                "currency": data.to_currency.value,
+            },
+        )
+        return TransferMoneyOut(
+            from_wallet_id=data.from_wallet_id,
+            from_amount=from_wallet_amount,
+            from_currency=data.from_currency,
+            to_wallet_id=data.to_wallet_id,
+            to_amount=to_wallet_amount,
+            to_currency=data.to_currency,
+        )
+
+
+async def create_wallets(num):
+    wallets = []
+    for i in range(num):
+        account = await crud.create_account_with_wallet(AccountCreateIn(name="bench"))
+        wallet_id = uuid.UUID(account.wallet_id)
+        await db.execute(
+            "UPDATE wallet SET amount = :amount WHERE id = :wallet_id;",
+            {"amount": decimal.Decimal(10 ** 9), "wallet_id": wallet_id},
+        )
+        wallets.append(wallet_id)
+    return wallets
+
+
+async def run(transfer_func, wallets, transfers, concurrency, bidirectional):
+    sem = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one():
+        nonlocal errors
+        if bidirectional:
+            # A->B and B->A transfers between neighbour wallets
+            i = random.randrange(0, len(wallets) - 1, 2)
+            from_wallet_id, to_wallet_id = random.sample(wallets[i:i + 2], 2)
+        else:
+            from_wallet_id, to_wallet_id = random.sample(wallets, 2)
+        data = TransferMoneyIn(
+            from_wallet_id=from_wallet_id,
+            from_currency=Currency.USD,
+            to_wallet_id=to_wallet_id,
+            to_currency=Currency.USD,
+            amount=decimal.Decimal("0.01"),
+        )
+        async with sem:
+            start = time.perf_counter()
+            try:
+                await transfer_func(data)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(transfers)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "rps": int(transfers / elapsed),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2),
+        "errors": errors,
+    }
+
+
+async def main(args):
+    await db.connect()
+    try:
+        # databases keeps connection in a context variable, so setup runs in
+        # its own task to not share one connection with all transfers
+        wallets = await asyncio.ensure_future(create_wallets(args.wallets))
+        funcs = [("legacy", legacy_transfer), ("transfer_money", crud.transfer)]
+        if args.coalesce_window:
+            batcher = TransferBatcher(args.coalesce_window, args.concurrency)
+            funcs.append(("coalesced", batcher.transfer))
+        for name, func in funcs:
+            result = await run(
+                func, wallets, args.transfers, args.concurrency, args.bidirectional
+            )
+            print(f"{name}: {result}")
+    finally:
+        await db.disconnect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark crud.transfer")
+    parser.add_argument("--wallets", type=int, default=100, help="num wallets to create")
+    parser.add_argument("--transfers", type=int, default=5000, help="num transfers to make")
+    parser.add_argument("--concurrency", type=int, default=10, help="parallel transfers")
+    parser.add_argument(
+        "--bidirectional",
+        action="store_true",
+        help="transfer back and forth within wallet pairs",
+    )
+    parser.add_argument(
+        "--coalesce-window",
+        type=float,
+        default=0,
+        help="also run transfers through group commit with this window in seconds",
+    )
+    asyncio.run(main(parser.parse_args()))
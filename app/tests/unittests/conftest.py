@@ -1,4 +1,10 @@
+import asyncio
+import socket
+import threading
+import time
+
 import pytest
+import uvicorn
 from starlette.testclient import TestClient
 
 from app.main import app
@@ -8,3 +14,35 @@ from app.main import app
 def test_app():
     with TestClient(app) as client:
         yield client
+
+
+@pytest.fixture
+def live_app():
+    """
+    The app served by uvicorn in a thread, for requests TestClient can't
+    make (it never waits in receive for the next chunk of a request body).
+    Startup is not run, so the database is not connected
+    """
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    host, port = sock.getsockname()
+    server = uvicorn.Server(
+        uvicorn.Config(app, lifespan="off", log_level="warning")
+    )
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.serve(sockets=[sock]))
+        loop.close()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    try:
+        yield f"http://{host}:{port}"
+    finally:
+        server.should_exit = True
+        thread.join()
+        sock.close()
@@ -0,0 +1,191 @@
+import asyncio
+import datetime
+import time
+import uuid
+
+import asyncpg
+import pytest
+
+from app import crud, replicas
+from app.account_cache import CHANNEL, AccountCache
+from app.config import settings
+from app.database import db
+from app.schemas import Currency, ExtendedAccountOut
+
+
+def account_out(account_id):
+    return ExtendedAccountOut(
+        account_id=account_id,
+        name="testname",
+        wallet_id=uuid.uuid4(),
+        currency=Currency.USD,
+        amount=0,
+        created_at=datetime.datetime.now(tz=datetime.timezone.utc),
+    )
+
+
+class FakeListener:
+    def is_closed(self):
+        return False
+
+
+async def wait_for(condition):
+    for _ in range(500):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("condition is not met")
+
+
+@pytest.mark.asyncio
+async def test_account_cached_until_notification(monkeypatch):
+    reads = []
+
+    async def mock_get_account_with_wallet(account_id):
+        reads.append(account_id)
+        return account_out(account_id)
+
+    monkeypatch.setattr(crud, "get_account_with_wallet", mock_get_account_with_wallet)
+    cache = AccountCache(maxsize=10, ttl=60)
+    listen = asyncio.ensure_future(cache.listen(settings.db_url))
+    connection = await asyncpg.connect(settings.db_url)
+    try:
+        await wait_for(lambda: cache.listening)
+        account_id = uuid.uuid4()
+
+        first = await cache.get(account_id)
+        assert await cache.get(account_id) == first
+        assert reads == [account_id]
+
+        await connection.execute("SELECT pg_notify($1, $2);", CHANNEL, str(account_id))
+        await wait_for(lambda: len(cache.accounts) == 0)
+        await cache.get(account_id)
+        assert reads == [account_id, account_id]
+        assert cache.stats()["hits"] == 1
+    finally:
+        await connection.close()
+        listen.cancel()
+
+
+@pytest.mark.asyncio
+async def test_account_not_cached_without_listener(monkeypatch):
+    async def mock_get_account_with_wallet(account_id):
+        return account_out(account_id)
+
+    monkeypatch.setattr(crud, "get_account_with_wallet", mock_get_account_with_wallet)
+    cache = AccountCache(maxsize=10, ttl=60)
+
+    await cache.get(uuid.uuid4())
+
+    assert len(cache.accounts) == 0
+
+
+@pytest.mark.asyncio
+async def test_account_invalidated_while_loading_not_cached(monkeypatch):
+    loading, invalidated = asyncio.Event(), asyncio.Event()
+
+    async def mock_get_account_with_wallet(account_id):
+        loading.set()
+        await invalidated.wait()
+        return account_out(account_id)
+
+    monkeypatch.setattr(crud, "get_account_with_wallet", mock_get_account_with_wallet)
+    cache = AccountCache(maxsize=10, ttl=60)
+    cache._listener = FakeListener()
+    account_id = uuid.uuid4()
+
+    get = asyncio.ensure_future(cache.get(account_id))
+    await loading.wait()
+    cache.invalidate(account_id)
+    invalidated.set()
+    await get
+
+    assert len(cache.accounts) == 0
+    await cache.get(account_id)
+    assert len(cache.accounts) == 1
+
+
+@pytest.mark.asyncio
+async def test_accounts_of_written_wallets_invalidated(monkeypatch):
+    loading, written = asyncio.Event(), asyncio.Event()
+    accounts = {}
+
+    async def mock_get_account_with_wallet(account_id):
+        if account_id not in accounts:
+            accounts[account_id] = account_out(account_id)
+            loading.set()
+            await written.wait()
+        return accounts[account_id]
+
+    monkeypatch.setattr(crud, "get_account_with_wallet", mock_get_account_with_wallet)
+    cache = AccountCache(maxsize=10, ttl=60)
+    cache._listener = FakeListener()
+    cached_id, loading_id = uuid.uuid4(), uuid.uuid4()
+    written.set()
+    await cache.get(cached_id)
+    loading.clear()
+    written.clear()
+
+    get = asyncio.ensure_future(cache.get(loading_id))
+    await loading.wait()
+    # the wallet of the account being read is changed before it's read
+    cache.invalidate_wallets(
+        [accounts[cached_id].wallet_id, accounts[loading_id].wallet_id]
+    )
+    written.set()
+    await get
+
+    assert len(cache.accounts) == 0
+    await cache.get(loading_id)
+    assert len(cache.accounts) == 1
+
+
+@pytest.mark.asyncio
+async def test_changed_account_loaded_from_primary(monkeypatch):
+    databases = []
+
+    async def mock_get_account_with_wallet(account_id):
+        databases.append(replicas.database())
+        return account_out(account_id)
+
+    monkeypatch.setattr(crud, "get_account_with_wallet", mock_get_account_with_wallet)
+    replica_set = replicas.ReplicaSet([settings.db_url], db)
+    monkeypatch.setattr(replicas, "replica_set", replica_set)
+    (replica,) = replica_set.replicas
+    replica.caught_up_at = time.monotonic()
+    cache = AccountCache(maxsize=10, ttl=60)
+    cache._listener = FakeListener()
+    account_id = uuid.uuid4()
+
+    with replicas.reading_from(replica.db):
+        await cache.get(account_id)
+        # the replica hasn't replayed the change yet
+        cache.invalidate(account_id)
+        await cache.get(account_id)
+        cache.invalidate(account_id)
+        replica.caught_up_at = time.monotonic()
+        await cache.get(account_id)
+
+    assert databases == [replica.db, db, replica.db]
+
+
+@pytest.mark.asyncio
+async def test_session_reads_skip_cache(monkeypatch):
+    reads = []
+
+    async def mock_get_account_with_wallet(account_id):
+        reads.append(account_id)
+        return account_out(account_id)
+
+    monkeypatch.setattr(crud, "get_account_with_wallet", mock_get_account_with_wallet)
+    cache = AccountCache(maxsize=10, ttl=60)
+    cache._listener = FakeListener()
+    account_id = uuid.uuid4()
+    await cache.get(account_id)
+
+    # the cached account may miss the write of the session
+    with replicas.reading_from(db, session=True):
+        await cache.get(account_id)
+    await cache.get(account_id)
+
+    assert reads == [account_id, account_id]
@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+from app import admission
+from app.config import settings
+
+
+@pytest.fixture
+def budget_settings(monkeypatch):
+    monkeypatch.setattr(settings, "admission_queue_size", 1)
+    monkeypatch.setattr(settings, "admission_queue_timeout", 0.05)
+    monkeypatch.setattr(settings, "admission_target", 0.005)
+    monkeypatch.setattr(settings, "admission_interval", 0.02)
+    monkeypatch.setattr(settings, "admission_min_limit", 1)
+    return monkeypatch
+
+
+@pytest.mark.asyncio
+async def test_budget_queue(budget_settings):
+    budget = admission.Budget("test", 1)
+    await budget.acquire()
+    waiting = asyncio.ensure_future(budget.acquire())
+    await asyncio.sleep(0)
+    with pytest.raises(admission.Overloaded):
+        await budget.acquire()
+    assert budget.stats() == {
+        "limit": 1,
+        "running": 1,
+        "queued": 1,
+        "rejected": {"queue_full": 1},
+    }
+
+    budget.release()
+    await waiting
+    assert (budget.running, len(budget.waiters)) == (1, 0)
+    with pytest.raises(admission.Overloaded):
+        await budget.acquire()
+    assert budget.rejected["timeout"] == 1
+
+    # a queue which isn't empty for interval makes waiting short
+    budget_settings.setattr(settings, "admission_queue_size", 2)
+    waiting = asyncio.ensure_future(budget.acquire())
+    await asyncio.sleep(0.03)
+    started = asyncio.get_event_loop().time()
+    with pytest.raises(admission.Overloaded):
+        await budget.acquire()
+    assert asyncio.get_event_loop().time() - started < 0.015
+    budget.release()
+    await waiting
+
+
+@pytest.mark.asyncio
+async def test_budget_adapts_to_pool(budget_settings):
+    acquire_times = [1.0, 1.0, None, 0.001]
+    budget = admission.Budget("test", 8, min_acquire_time=lambda: acquire_times.pop(0))
+    limits = []
+    for _ in range(4):
+        await asyncio.sleep(0.02)
+        await budget.acquire()
+        budget.release()
+        limits.append(budget.limit)
+    assert limits == [4, 2, 3, 4]
+
+
+@pytest.mark.asyncio
+async def test_middleware_keeps_reads_running(budget_settings, monkeypatch):
+    monkeypatch.setattr(settings, "admission_queue_size", 0)
+    release = asyncio.Event()
+
+    async def app(scope, receive, send):
+        if scope["method"] == "POST":
+            await release.wait()
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    middleware = admission.AdmissionMiddleware(
+        app, admission.Budget("reads", 1), admission.Budget("writes", 1)
+    )
+
+    async def request(method):
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {"type": "http", "method": method, "path": "/", "headers": []}
+        await middleware(scope, None, send)
+        return messages[0]
+
+    transfer = asyncio.ensure_future(request("POST"))
+    await asyncio.sleep(0)
+    refused = await request("POST")
+    assert refused["status"] == 503
+    assert (b"retry-after", b"1") in refused["headers"]
+    assert (await request("GET"))["status"] == 200
+    release.set()
+    assert (await transfer)["status"] == 200
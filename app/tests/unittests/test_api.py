@@ -1,11 +1,17 @@
+import asyncio
 import datetime
 import decimal
+import json
+import time
 import uuid
 
 import asyncpg
+import requests
 
-from app.schemas import AccountCreateOut, ExtendedAccountOut, Currency, ReplenishWalletInfo, TransferMoneyOut
+from app.schemas import AccountCreateOut, BatchMode, ExtendedAccountOut, Currency, ReplenishWalletInfo, TransferMoneyOut
+from app.schemas import BalanceOut, PostingOut, PostingsPage, TransactionType
 from app.api import crud
+from app import idempotency, statements
 from fastapi import status
 
 from app.config import settings
@@ -161,6 +167,69 @@ def test_get_account_exception(test_app, monkeypatch, caplog):
     assert "Exception from test" in caplog.text
 
 
+def test_get_account_after_own_write(test_app, monkeypatch):
+    # tests run in one transaction which is never committed, so notifications
+    # of the writes never come; the listener connects while requests run
+    for _ in range(500):
+        if test_app.get("/cache/stats").json()["accounts"]["listening"]:
+            break
+        time.sleep(0.01)
+    else:
+        raise AssertionError("account cache is not listening")
+    accounts = [
+        test_app.post("/accounts", json={"name": "testname"}).json()
+        for _ in range(2)
+    ]
+    for account in accounts:
+        response = test_app.get(f"/accounts/{account['account_id']}")
+        assert response.json()["amount"] == 0
+
+    replenish = {
+        "wallet_id": accounts[0]["wallet_id"],
+        "amount": 100,
+        "currency": Currency.USD.value,
+    }
+    response = test_app.post("/replenish", json=replenish)
+    assert response.status_code == status.HTTP_200_OK
+    response = test_app.get(f"/accounts/{accounts[0]['account_id']}")
+    assert response.json()["amount"] == 100
+
+    transfer = {
+        "from_wallet_id": accounts[0]["wallet_id"],
+        "from_currency": Currency.USD.value,
+        "to_wallet_id": accounts[1]["wallet_id"],
+        "to_currency": Currency.USD.value,
+        "amount": 30,
+    }
+    response = test_app.post("/transfer", json=transfer)
+    assert response.status_code == status.HTTP_200_OK
+    amounts = [
+        test_app.get(f"/accounts/{account['account_id']}").json()["amount"]
+        for account in accounts
+    ]
+    assert amounts == [70, 30]
+
+    monkeypatch.setattr(settings, "transfer_coalescing", True)
+    response = test_app.post("/transfer", json=transfer)
+    assert response.status_code == status.HTTP_200_OK
+    amounts = [
+        test_app.get(f"/accounts/{account['account_id']}").json()["amount"]
+        for account in accounts
+    ]
+    assert amounts == [40, 60]
+
+    response = test_app.post("/transfers/batch", json={"transfers": [transfer]})
+    assert response.status_code == status.HTTP_200_OK
+    body = {"replenishments": [dict(replenish, wallet_id=accounts[1]["wallet_id"])]}
+    response = test_app.post("/replenish/batch", json=body)
+    assert response.status_code == status.HTTP_200_OK
+    amounts = [
+        test_app.get(f"/accounts/{account['account_id']}").json()["amount"]
+        for account in accounts
+    ]
+    assert amounts == [10, 190]
+
+
 def test_replenish_wallet_ok(test_app, monkeypatch):
     wallet_id = uuid.uuid4()
     amount = decimal.Decimal(1000)
@@ -340,3 +409,390 @@ def test_transfer_limit_exception(test_app, monkeypatch):
 def test_super_hard_test():
     # number of tests must be 20
     assert True
+
+
+def test_transfer_deadlock(test_app, monkeypatch):
+    test_request_payload = {
+        "from_wallet_id": str(uuid.uuid4()),
+        "to_wallet_id": str(uuid.uuid4()),
+        "from_currency": Currency.USD.value,
+        "to_currency": Currency.USD.value,
+        "amount": 1000,
+    }
+
+    async def mock_transfer_money(payload):
+        raise asyncpg.exceptions.DeadlockDetectedError("deadlock detected")
+
+    monkeypatch.setattr(crud, "transfer", mock_transfer_money)
+
+    response = test_app.post(f"/transfer", json=test_request_payload)
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+
+
+def test_transfer_batch(test_app, monkeypatch):
+    from_wallet_id = uuid.uuid4()
+    to_wallet_id = uuid.uuid4()
+    transfer = {
+        "from_wallet_id": str(from_wallet_id),
+        "to_wallet_id": str(to_wallet_id),
+        "from_currency": Currency.USD.value,
+        "to_currency": Currency.USD.value,
+        "amount": 10,
+    }
+    test_request_payload = {"mode": "atomic", "transfers": [transfer] * 3}
+    test_response_payload = {
+        "results": [
+            {"status": "rolled_back", "result": None, "error": "rolled back"},
+            {
+                "status": "not_found",
+                "result": None,
+                "error": "wallet with {'wallet_id': 1} not found",
+            },
+            {"status": "failed", "result": None, "error": "failed"},
+        ]
+    }
+
+    async def mock_transfer_batch(transfers, mode):
+        assert mode == BatchMode.atomic
+        assert len(transfers) == 3
+        return [
+            crud.BatchRolledBack("rolled back"),
+            crud.NotFound("wallet", {"wallet_id": 1}),
+            crud.CRUDException("failed"),
+        ]
+
+    monkeypatch.setattr(crud, "transfer_batch", mock_transfer_batch)
+    response = test_app.post("/transfers/batch", json=test_request_payload)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == test_response_payload
+
+
+def test_replenish_batch(test_app, monkeypatch):
+    wallet_id = uuid.uuid4()
+    replenishment = {
+        "wallet_id": str(wallet_id),
+        "amount": 10,
+        "currency": Currency.USD.value,
+    }
+    test_request_payload = {"replenishments": [replenishment] * 2}
+    test_response_payload = {
+        "results": [
+            {"status": "ok", "result": replenishment, "error": None},
+            {"status": "failed", "result": None, "error": "failed"},
+        ]
+    }
+
+    async def mock_replenish_batch(replenishments, mode):
+        assert mode == BatchMode.independent
+        return [replenishments[0], crud.CRUDException("failed")]
+
+    monkeypatch.setattr(crud, "replenish_batch", mock_replenish_batch)
+    response = test_app.post("/replenish/batch", json=test_request_payload)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == test_response_payload
+
+
+def test_create_accounts_bulk_ndjson(test_app, monkeypatch):
+    created = []
+
+    async def mock_create_accounts_bulk(accounts):
+        result = [
+            AccountCreateOut(account_id=str(uuid.uuid4()), wallet_id=str(uuid.uuid4()))
+            for _ in accounts
+        ]
+        created.extend(result)
+        return result
+
+    monkeypatch.setattr(crud, "create_accounts_bulk", mock_create_accounts_bulk)
+    monkeypatch.setattr(settings, "copy_chunk_size", 2)
+
+    body = b'{"name": "name1"}\n\n{"name": "name2"}\nnot json\n{"name": "name3"}'
+    response = test_app.post(
+        "/accounts/bulk",
+        data=body,
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert len(lines) == 4
+    assert lines[0] == created[0].dict()
+    assert lines[1] == created[1].dict()
+    assert lines[2]["error"].startswith("invalid JSON")
+    assert lines[3] == created[2].dict()
+
+
+def test_create_accounts_bulk_ndjson_chunked(live_app, monkeypatch):
+    created = []
+
+    async def mock_create_accounts_bulk(accounts):
+        # suspends like COPY does, while the next chunk may arrive
+        await asyncio.sleep(0.01)
+        result = [
+            AccountCreateOut(account_id=str(uuid.uuid4()), wallet_id=str(uuid.uuid4()))
+            for _ in accounts
+        ]
+        created.extend(result)
+        return result
+
+    monkeypatch.setattr(crud, "create_accounts_bulk", mock_create_accounts_bulk)
+    monkeypatch.setattr(settings, "copy_chunk_size", 2)
+
+    def body():
+        # the server waits for every chunk while the response is being sent
+        for i in range(10):
+            yield f'{{"name": "name{i}"}}\n'.encode()
+            time.sleep(0.02)
+
+    response = requests.post(
+        f"{live_app}/accounts/bulk",
+        data=body(),
+        headers={"Content-Type": "application/x-ndjson"},
+        timeout=5,
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines == [account.dict() for account in created]
+    assert len(lines) == 10
+
+
+def test_create_accounts_bulk_bad_body(test_app):
+    response = test_app.post("/accounts/bulk", json={"name": "name1"})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+def test_create_accounts_bulk_json_too_large(test_app, monkeypatch):
+    monkeypatch.setattr(settings, "max_bulk_json_size", 20)
+    body = [{"name": "name1"}, {"name": "name2"}]
+    response = test_app.post("/accounts/bulk", json=body)
+    assert response.status_code == status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    assert "NDJSON" in response.json()["detail"]
+
+
+def test_replenish_wallet_idempotency_key(test_app, monkeypatch):
+    wallet_id = uuid.uuid4()
+    test_request_payload = {
+        "wallet_id": str(wallet_id),
+        "amount": 1000,
+        "currency": Currency.USD.value,
+    }
+    calls = []
+
+    async def mock_replenish(payload):
+        calls.append(payload)
+        return ReplenishWalletInfo(
+            wallet_id=wallet_id, amount=len(calls) * 1000, currency=Currency.USD
+        )
+
+    monkeypatch.setattr(crud, "replenish", mock_replenish)
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+
+    response = test_app.post("/replenish", json=test_request_payload, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == test_request_payload
+
+    # replayed from cache and from database without replenishing again
+    replay = test_app.post("/replenish", json=test_request_payload, headers=headers)
+    idempotency.cache.clear()
+    db_replay = test_app.post("/replenish", json=test_request_payload, headers=headers)
+    assert len(calls) == 1
+    assert replay.status_code == db_replay.status_code == status.HTTP_200_OK
+    assert replay.json() == db_replay.json() == test_request_payload
+
+    # the key can't be used for another request
+    test_request_payload["amount"] = 1
+    response = test_app.post("/replenish", json=test_request_payload, headers=headers)
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    assert len(calls) == 1
+
+
+def test_idempotency_key_expired_after_conflict(test_app, monkeypatch):
+    wallet_id = uuid.uuid4()
+    test_request_payload = {
+        "wallet_id": str(wallet_id),
+        "amount": 1000,
+        "currency": Currency.USD.value,
+    }
+    calls = []
+
+    async def mock_replenish(payload):
+        calls.append(payload)
+        return payload
+
+    save_response = idempotency.save_response
+
+    async def mock_save_response(endpoint, key, response):
+        # a concurrent request saved its response, which expires before it's read
+        if len(calls) == 1:
+            raise idempotency.KeyTaken()
+        await save_response(endpoint, key, response)
+
+    monkeypatch.setattr(crud, "replenish", mock_replenish)
+    monkeypatch.setattr(idempotency, "save_response", mock_save_response)
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+
+    response = test_app.post("/replenish", json=test_request_payload, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == test_request_payload
+    assert len(calls) == 2
+
+
+def test_transfer_idempotency_key_not_saved_on_error(test_app, monkeypatch):
+    test_request_payload = {
+        "from_wallet_id": str(uuid.uuid4()),
+        "to_wallet_id": str(uuid.uuid4()),
+        "from_currency": Currency.USD.value,
+        "to_currency": Currency.USD.value,
+        "amount": 1000,
+    }
+    calls = []
+
+    async def mock_transfer_money(payload):
+        calls.append(payload)
+        raise crud.CRUDException("some text")
+
+    monkeypatch.setattr(crud, "transfer", mock_transfer_money)
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+
+    for _ in range(2):
+        response = test_app.post("/transfer", json=test_request_payload, headers=headers)
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert len(calls) == 2
+
+
+def test_metrics(test_app, monkeypatch):
+    async def mock_get_account_with_wallet(payload):
+        raise crud.NotFound("account", {"account_id": payload})
+
+    monkeypatch.setattr(
+        crud, "get_account_with_wallet", mock_get_account_with_wallet
+    )
+
+    response = test_app.get(f"/accounts/{uuid.uuid4()}")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    response = test_app.get("/metrics")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"].startswith("text/plain")
+    assert (
+        'crud_errors_total{error="NotFound",operation="get_account"}' in response.text
+    )
+    assert (
+        'http_request_duration_seconds_count{method="GET",'
+        'route="/accounts/{account_id}",status="404"}' in response.text
+    )
+
+
+def test_get_wallet_postings(test_app, monkeypatch):
+    wallet_id = uuid.uuid4()
+    dt = datetime.datetime.utcnow()
+    calls = []
+
+    async def mock_get_postings(*args):
+        calls.append(args)
+        posting = PostingOut(
+            transaction_id=7,
+            type=TransactionType.transfer,
+            amount=decimal.Decimal("-1.5"),
+            currency=Currency.USD,
+            created_at=dt,
+        )
+        return PostingsPage(postings=[posting], next_cursor="Nzo5")
+
+    monkeypatch.setattr(crud, "get_postings", mock_get_postings)
+
+    response = test_app.get(
+        f"/wallets/{wallet_id}/postings",
+        params={"limit": 1, "cursor": "Nzo4", "type": TransactionType.transfer.value},
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {
+        "postings": [
+            {
+                "transaction_id": 7,
+                "type": TransactionType.transfer.value,
+                "amount": -1.5,
+                "currency": Currency.USD.value,
+                "created_at": dt.isoformat(),
+            }
+        ],
+        "next_cursor": "Nzo5",
+    }
+    assert calls == [(wallet_id, 1, "Nzo4", TransactionType.transfer, None, None)]
+
+    response = test_app.get(f"/wallets/{wallet_id}/postings", params={"limit": 0})
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+def test_get_wallet_postings_errors(test_app, monkeypatch):
+    async def mock_get_postings(wallet_id, limit, cursor, *args):
+        if cursor is None:
+            raise crud.NotFound("wallet", {"wallet_id": wallet_id})
+        raise crud.CRUDException(f"invalid cursor '{cursor}'")
+
+    monkeypatch.setattr(crud, "get_postings", mock_get_postings)
+
+    response = test_app.get(f"/wallets/{uuid.uuid4()}/postings")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    response = test_app.get(f"/wallets/{uuid.uuid4()}/postings?cursor=x")
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+def test_get_wallet_balance(test_app, monkeypatch):
+    wallet_id = uuid.uuid4()
+    at = datetime.datetime(2026, 10, 1, 12, tzinfo=datetime.timezone.utc)
+
+    async def mock_get_balance(wallet_id, at):
+        if at.year < 2000:
+            raise crud.NotFound("wallet", {"wallet_id": wallet_id})
+        return BalanceOut(
+            wallet_id=wallet_id, at=at, currency=Currency.USD, amount=decimal.Decimal(5)
+        )
+
+    monkeypatch.setattr(crud, "get_balance", mock_get_balance)
+
+    response = test_app.get(
+        f"/wallets/{wallet_id}/balance", params={"at": at.isoformat()}
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {
+        "wallet_id": str(wallet_id),
+        "at": at.isoformat(),
+        "currency": Currency.USD.value,
+        "amount": 5,
+    }
+
+    response = test_app.get(f"/wallets/{wallet_id}/balance")
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    response = test_app.get(
+        f"/wallets/{wallet_id}/balance", params={"at": "1999-01-01T00:00:00"}
+    )
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_get_wallet_statement(test_app, monkeypatch):
+    wallet_id = uuid.uuid4()
+
+    async def mock_stream(stream_wallet_id, since, until, statement_format):
+        if stream_wallet_id != wallet_id:
+            raise crud.NotFound("wallet", {"wallet_id": stream_wallet_id})
+        yield b"created_at,amount\n" if statement_format.value == "csv" else b""
+        yield b"2100-01-01T10:00:00+00:00,10.00\n"
+        raise RuntimeError("connection lost")
+
+    monkeypatch.setattr(statements, "stream", mock_stream)
+
+    response = test_app.get(
+        f"/wallets/{wallet_id}/statement", params={"format": "ndjson"}
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert response.text.splitlines()[-1] == json.dumps(
+        {"error": "can't export statement; try again later"}, separators=(",", ":")
+    )
+
+    response = test_app.get(f"/wallets/{uuid.uuid4()}/statement")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    response = test_app.get(
+        f"/wallets/{wallet_id}/statement", params={"format": "xml"}
+    )
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
@@ -0,0 +1,143 @@
+import asyncio
+import decimal
+import uuid
+
+import asyncpg
+import pytest
+
+from app import crud
+from app.batcher import TransferBatcher
+from app.schemas import BatchMode, Currency, TransferMoneyIn, TransferMoneyOut
+
+
+def transfer_in(amount):
+    return TransferMoneyIn(
+        from_wallet_id=uuid.uuid4(),
+        from_currency=Currency.USD,
+        to_wallet_id=uuid.uuid4(),
+        to_currency=Currency.USD,
+        amount=decimal.Decimal(amount),
+    )
+
+
+def transfer_out(data):
+    return TransferMoneyOut(
+        from_wallet_id=data.from_wallet_id,
+        from_amount=0,
+        from_currency=data.from_currency,
+        to_wallet_id=data.to_wallet_id,
+        to_amount=data.amount,
+        to_currency=data.to_currency,
+    )
+
+
+@pytest.mark.asyncio
+async def test_transfers_coalesced(monkeypatch):
+    batches = []
+
+    async def mock_transfer_batch(transfers, mode):
+        assert mode == BatchMode.independent
+        batches.append(transfers)
+        error = crud.CRUDException("not enough amount")
+        return [error if data.amount == 2 else transfer_out(data) for data in transfers]
+
+    monkeypatch.setattr(crud, "transfer_batch", mock_transfer_batch)
+    batcher = TransferBatcher(window=0.01, max_size=100)
+    transfers = [transfer_in(1), transfer_in(2), transfer_in(3)]
+
+    results = await asyncio.gather(
+        *(batcher.transfer(data) for data in transfers), return_exceptions=True
+    )
+
+    assert batches == [transfers]
+    assert results[0] == transfer_out(transfers[0])
+    assert results[1].message == "not enough amount"
+    assert results[2] == transfer_out(transfers[2])
+
+
+@pytest.mark.asyncio
+async def test_batch_flushed_on_max_size(monkeypatch):
+    batches = []
+
+    async def mock_transfer_batch(transfers, mode):
+        batches.append(transfers)
+        return [transfer_out(data) for data in transfers]
+
+    monkeypatch.setattr(crud, "transfer_batch", mock_transfer_batch)
+    # window is too long for the test to pass without flush by size
+    batcher = TransferBatcher(window=60, max_size=2)
+    transfers = [transfer_in(1), transfer_in(2), transfer_in(3), transfer_in(4)]
+
+    await asyncio.wait_for(
+        asyncio.gather(*(batcher.transfer(data) for data in transfers)), timeout=5
+    )
+
+    assert batches == [transfers[:2], transfers[2:]]
+
+
+@pytest.mark.asyncio
+async def test_batch_error(monkeypatch):
+    async def mock_transfer_batch(transfers, mode):
+        raise Exception("Exception from test")
+
+    async def mock_transfer(data):
+        raise Exception("Exception from test")
+
+    monkeypatch.setattr(crud, "transfer_batch", mock_transfer_batch)
+    monkeypatch.setattr(crud, "transfer", mock_transfer)
+    batcher = TransferBatcher(window=0, max_size=100)
+
+    with pytest.raises(Exception, match="Exception from test"):
+        await batcher.transfer(transfer_in(1))
+    await batcher.close()
+
+
+@pytest.mark.asyncio
+async def test_batch_error_applies_transfers_one_by_one(monkeypatch):
+    async def mock_transfer_batch(transfers, mode):
+        raise asyncpg.exceptions.NumericValueOutOfRangeError("out of range")
+
+    async def mock_transfer(data):
+        if data.amount == 2:
+            raise asyncpg.exceptions.NumericValueOutOfRangeError("out of range")
+        if data.amount == 3:
+            raise crud.CRUDException("not enough amount")
+        return transfer_out(data)
+
+    monkeypatch.setattr(crud, "transfer_batch", mock_transfer_batch)
+    monkeypatch.setattr(crud, "transfer", mock_transfer)
+    batcher = TransferBatcher(window=0.01, max_size=100)
+    transfers = [transfer_in(1), transfer_in(2), transfer_in(3), transfer_in(4)]
+
+    results = await asyncio.gather(
+        *(batcher.transfer(data) for data in transfers), return_exceptions=True
+    )
+
+    assert results[0] == transfer_out(transfers[0])
+    assert isinstance(results[1], asyncpg.exceptions.NumericValueOutOfRangeError)
+    assert results[2].message == "not enough amount"
+    assert results[3] == transfer_out(transfers[3])
+
+
+@pytest.mark.asyncio
+async def test_batch_error_not_rolled_back_is_not_applied_again(monkeypatch):
+    async def mock_transfer_batch(transfers, mode):
+        raise asyncpg.exceptions.ConnectionDoesNotExistError("connection lost")
+
+    async def mock_transfer(data):
+        raise AssertionError("transfer of a batch which may be committed")
+
+    monkeypatch.setattr(crud, "transfer_batch", mock_transfer_batch)
+    monkeypatch.setattr(crud, "transfer", mock_transfer)
+    batcher = TransferBatcher(window=0.01, max_size=100)
+
+    results = await asyncio.gather(
+        batcher.transfer(transfer_in(1)),
+        batcher.transfer(transfer_in(2)),
+        return_exceptions=True,
+    )
+
+    assert all(
+        isinstance(result, asyncpg.exceptions.ConnectionDoesNotExistError)
+        for result in results
+    )
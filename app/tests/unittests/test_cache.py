@@ -0,0 +1,47 @@
+from app.cache import TTLCache
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_cache_expires():
+    timer = FakeTimer()
+    cache = TTLCache(maxsize=10, ttl=5, timer=timer)
+    cache.set("key", "value")
+    assert cache.get("key") == "value"
+
+    timer.now = 5
+    assert cache.get("key") is None
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_ttl_cache_item_ttl():
+    timer = FakeTimer()
+    cache = TTLCache(maxsize=10, ttl=5, timer=timer)
+    cache.set("sooner", 1, ttl=2)
+    cache.set("later", 2, ttl=10)
+
+    timer.now = 2
+    assert cache.get("sooner") is None
+    assert cache.get("later") == 2
+    timer.now = 5
+    assert cache.get("later") is None
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=5)
+    cache.set("key1", 1)
+    cache.set("key2", 2)
+    cache.get("key1")
+    cache.set("key3", 3)
+
+    assert cache.get("key2") is None
+    assert cache.get("key1") == 1
+    assert cache.get("key3") == 3
+    assert cache.evictions == 1
@@ -1,11 +1,15 @@
+import asyncio
 import datetime
 import decimal
 
+import asyncpg
+from prometheus_client import REGISTRY
+
 from app.database import db
-from app.schemas import AccountCreateIn, Currency, ExtendedAccountOut, ReplenishWalletInfo, TransactionType, \
+from app.schemas import AccountCreateIn, BatchMode, Currency, ExtendedAccountOut, ReplenishWalletInfo, TransactionType, \
     TransferMoneyOut, TransferMoneyIn
 from app.crud import uuid
-from app import crud
+from app import crud, idempotency
 from app.config import settings
 import pytest
 
@@ -375,3 +379,490 @@ async def test_replenish_exceptions():
         assert replenished_wallet["amount"] == amount
     finally:
         await db.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_transfer_to_same_wallet():
+    await db.connect()
+    try:
+        account_id = uuid.uuid4()
+        wallet_id = uuid.uuid4()
+        amount = decimal.Decimal("100.50")
+        transfer_amount = decimal.Decimal("10.25")
+        currency = Currency.USD
+        await db.execute(
+            "INSERT INTO account(id, name) VALUES (:account_id, :name);",
+            {"account_id": account_id, "name": "testname"},
+        )
+        await db.execute(
+            "INSERT INTO wallet(id, account_id, amount, currency) "
+            "VALUES (:wallet_id, :account_id, :amount, :currency);",
+            {
+                "account_id": account_id,
+                "wallet_id": wallet_id,
+                "amount": amount,
+                "currency": currency.value,
+            },
+        )
+        await crud.transfer(
+            TransferMoneyIn(
+                from_wallet_id=wallet_id,
+                from_currency=currency,
+                to_wallet_id=wallet_id,
+                to_currency=currency,
+                amount=transfer_amount,
+            )
+        )
+        select_wallet = "SELECT amount FROM wallet WHERE id = :wallet_id"
+        wallet = await db.fetch_one(select_wallet, {"wallet_id": wallet_id})
+        # money is not created or lost
+        assert wallet["amount"] == amount
+    finally:
+        await db.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_retry_on_conflict(monkeypatch):
+    await db.connect()
+    try:
+        calls = []
+
+        async def not_in_transaction():
+            return False
+
+        @crud.retry_on_conflict
+        async def deadlocked_once():
+            calls.append(1)
+            if len(calls) == 1:
+                raise asyncpg.exceptions.DeadlockDetectedError("deadlock detected")
+            return "done"
+
+        monkeypatch.setattr(crud, "_in_transaction", not_in_transaction)
+        monkeypatch.setattr(settings, "db_retry_base_delay", 0)
+        labels = {"error": "DeadlockDetectedError", "outcome": "retried"}
+        retried = REGISTRY.get_sample_value("db_retries_total", labels) or 0
+
+        assert await deadlocked_once() == "done"
+        assert len(calls) == 2
+        assert REGISTRY.get_sample_value("db_retries_total", labels) == retried + 1
+    finally:
+        await db.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_retry_on_conflict_releases_connection_while_backing_off(monkeypatch):
+    await db.connect()
+    try:
+        held = db.connection()._connection_counter
+        held_in_calls = []
+        held_in_sleeps = []
+
+        async def not_in_transaction():
+            return False
+
+        async def sleep(delay):
+            held_in_sleeps.append(db.connection()._connection_counter)
+
+        @crud.retry_on_conflict
+        async def deadlocked_twice():
+            held_in_calls.append(db.connection()._connection_counter)
+            if len(held_in_calls) < 3:
+                raise asyncpg.exceptions.DeadlockDetectedError("deadlock detected")
+            return "done"
+
+        monkeypatch.setattr(crud, "_in_transaction", not_in_transaction)
+        monkeypatch.setattr(crud.asyncio, "sleep", sleep)
+
+        assert await deadlocked_twice() == "done"
+        # every attempt acquires the connection again
+        assert held_in_calls == [held + 1] * 3
+        assert held_in_sleeps == [held] * 2
+    finally:
+        await db.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_retry_on_conflict_inside_transaction():
+    await db.connect()
+    try:
+        calls = []
+
+        @crud.retry_on_conflict
+        async def deadlocked():
+            calls.append(1)
+            raise asyncpg.exceptions.DeadlockDetectedError("deadlock detected")
+
+        # tests run inside one transaction, so it can't be retried
+        with pytest.raises(asyncpg.exceptions.DeadlockDetectedError):
+            await deadlocked()
+        assert len(calls) == 1
+    finally:
+        await db.disconnect()
+
+
+async def _add_wallet(amount):
+    account_id = uuid.uuid4()
+    wallet_id = uuid.uuid4()
+    await db.execute(
+        "INSERT INTO account(id, name) VALUES (:account_id, :name);",
+        {"account_id": account_id, "name": "testname"},
+    )
+    await db.execute(
+        "INSERT INTO wallet(id, account_id, amount, currency) "
+        "VALUES (:wallet_id, :account_id, :amount, :currency);",
+        {
+            "account_id": account_id,
+            "wallet_id": wallet_id,
+            "amount": amount,
+            "currency": Currency.USD.value,
+        },
+    )
+    return wallet_id
+
+
+async def _wallet_amount(wallet_id):
+    select_wallet = "SELECT amount FROM wallet WHERE id = :wallet_id"
+    wallet = await db.fetch_one(select_wallet, {"wallet_id": wallet_id})
+    return wallet["amount"]
+
+
+def _transfer_in(from_wallet_id, to_wallet_id, amount):
+    return TransferMoneyIn(
+        from_wallet_id=from_wallet_id,
+        from_currency=Currency.USD,
+        to_wallet_id=to_wallet_id,
+        to_currency=Currency.USD,
+        amount=decimal.Decimal(amount),
+    )
+
+
+@pytest.mark.asyncio
+async def test_transfer_batch_independent():
+    await db.connect()
+    try:
+        wallet_1 = await _add_wallet(decimal.Decimal("100"))
+        wallet_2 = await _add_wallet(decimal.Decimal("0"))
+        missing_wallet = uuid.uuid4()
+        transfers = [
+            _transfer_in(wallet_1, wallet_2, "60"),
+            # not enough amount after the first transfer
+            _transfer_in(wallet_1, wallet_2, "60"),
+            _transfer_in(wallet_1, missing_wallet, "1"),
+            _transfer_in(wallet_2, wallet_1, "10.50"),
+        ]
+        results = await crud.transfer_batch(transfers, BatchMode.independent)
+
+        assert results[0] == TransferMoneyOut(
+            from_wallet_id=wallet_1,
+            from_amount=decimal.Decimal("40"),
+            from_currency=Currency.USD,
+            to_wallet_id=wallet_2,
+            to_amount=decimal.Decimal("60"),
+            to_currency=Currency.USD,
+        )
+        assert results[1].message == (
+            f"can't transfer 60 USD from wallet {wallet_1}: not enough amount"
+        )
+        assert isinstance(results[2], crud.NotFound)
+        assert results[3].from_amount == decimal.Decimal("49.50")
+        assert results[3].to_amount == decimal.Decimal("50.50")
+        assert await _wallet_amount(wallet_1) == decimal.Decimal("50.50")
+        assert await _wallet_amount(wallet_2) == decimal.Decimal("49.50")
+
+        select_postings = (
+            "SELECT posting.transaction_id, posting.wallet_id, posting.amount "
+            "FROM posting JOIN transaction ON transaction.id = posting.transaction_id "
+            "WHERE posting.wallet_id = :wallet_id ORDER BY posting.id;"
+        )
+        postings = await db.fetch_all(select_postings, {"wallet_id": wallet_1})
+        assert [p["amount"] for p in postings] == [
+            decimal.Decimal("-60"),
+            decimal.Decimal("10.50"),
+        ]
+        assert postings[0]["transaction_id"] < postings[1]["transaction_id"]
+    finally:
+        await db.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_transfer_batch_atomic():
+    await db.connect()
+    try:
+        wallet_1 = await _add_wallet(decimal.Decimal("100"))
+        wallet_2 = await _add_wallet(settings.max_amount - 1)
+        transfers = [
+            _transfer_in(wallet_1, wallet_2, "1"),
+            _transfer_in(wallet_1, wallet_2, "1"),
+        ]
+        results = await crud.transfer_batch(transfers, BatchMode.atomic)
+
+        assert isinstance(results[0], crud.BatchRolledBack)
+        assert results[0].message == "not applied: item #1 failed"
+        assert results[1].message == (
+            f"can't transfer to {wallet_2}; "
+            f"resulting amount is greater that max amount = {settings.max_amount}; "
+            f"current amount = {settings.max_amount}"
+        )
+        assert await _wallet_amount(wallet_1) == decimal.Decimal("100")
+        assert await _wallet_amount(wallet_2) == settings.max_amount - 1
+    finally:
+        await db.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_replenish_batch():
+    await db.connect()
+    try:
+        wallet_1 = await _add_wallet(decimal.Decimal("10"))
+        wallet_2 = await _add_wallet(settings.max_amount - 5)
+        replenishments = [
+            ReplenishWalletInfo(wallet_id=wallet_1, amount=5, currency=Currency.USD),
+            ReplenishWalletInfo(wallet_id=wallet_2, amount=5, currency=Currency.USD),
+            # wallet 2 is full after the previous replenishment
+            ReplenishWalletInfo(wallet_id=wallet_2, amount=1, currency=Currency.USD),
+            ReplenishWalletInfo(wallet_id=wallet_1, amount=1, currency=Currency.USD),
+        ]
+        results = await crud.replenish_batch(replenishments, BatchMode.independent)
+
+        assert results[0].amount == decimal.Decimal("15")
+        assert results[1].amount == settings.max_amount
+        assert results[2].message == (
+            f"can't replenish to {wallet_2}; "
+            f"resulting amount is greater that max amount = {settings.max_amount}; "
+            f"current amount = {settings.max_amount}"
+        )
+        assert results[3].amount == decimal.Decimal("16")
+        assert await _wallet_amount(wallet_1) == decimal.Decimal("16")
+        assert await _wallet_amount(wallet_2) == settings.max_amount
+
+        select_postings = (
+            "SELECT posting.amount FROM posting "
+            "JOIN transaction ON transaction.id = posting.transaction_id "
+            "WHERE posting.wallet_id = :wallet_id AND transaction.type = :type "
+            "ORDER BY posting.id;"
+        )
+        values = {"wallet_id": wallet_1, "type": TransactionType.replenish.value}
+        postings = await db.fetch_all(select_postings, values)
+        assert [p["amount"] for p in postings] == [5, 1]
+    finally:
+        await db.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_create_accounts_bulk():
+    await db.connect()
+    try:
+        accounts = [AccountCreateIn(name=f"testname{i}") for i in range(3)]
+        created = await crud.create_accounts_bulk(accounts)
+
+        assert len(created) == 3
+        for account, ids in zip(accounts, created):
+            row = await db.fetch_one(
+                "SELECT account.name, wallet.id as wallet_id, wallet.amount, "
+                "wallet.currency, account.created_at "
+                "FROM account JOIN wallet ON wallet.account_id = account.id "
+                "WHERE account.id = :account_id;",
+                {"account_id": uuid.UUID(ids.account_id)},
+            )
+            assert row["name"] == account.name
+            assert str(row["wallet_id"]) == ids.wallet_id
+            assert row["amount"] == 0
+            assert row["currency"] == Currency.USD.value
+            assert row["created_at"] is not None
+    finally:
+        await db.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_purge_expired_idempotency_keys():
+    await db.connect()
+    try:
+        insert_key = (
+            "INSERT INTO idempotency_key"
+            "(endpoint, key, request_hash, status_code, response, expires_at) "
+            "VALUES ('test', :key, '', 200, '{}', now() + :ttl * interval '1 second');"
+        )
+        await db.execute(insert_key, {"key": "expired", "ttl": -1})
+        await db.execute(insert_key, {"key": "active", "ttl": 60})
+
+        assert await idempotency.purge_expired() >= 1
+        rows = await db.fetch_all("SELECT key FROM idempotency_key WHERE endpoint = 'test'")
+        assert [row["key"] for row in rows] == ["active"]
+    finally:
+        await db.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_idempotency_response_cached_until_key_expires():
+    await db.connect()
+    try:
+        await db.execute(
+            "INSERT INTO idempotency_key"
+            "(endpoint, key, request_hash, status_code, response, expires_at) "
+            "VALUES ('test', 'expiring', 'hash', 200, '{}', now() + interval '0.2 second');"
+        )
+        idempotency.cache.clear()
+        stored = await idempotency.get_response("test", "expiring", "hash")
+        assert stored == idempotency.StoredResponse("hash", 200, {})
+        await asyncio.sleep(0.5)
+        assert idempotency.cache.get(("test", "expiring")) is None
+    finally:
+        await db.execute("DELETE FROM idempotency_key WHERE endpoint = 'test';")
+        await db.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_get_postings():
+    await db.connect()
+    try:
+        from_account = await crud.create_account_with_wallet(AccountCreateIn(name="from"))
+        to_account = await crud.create_account_with_wallet(AccountCreateIn(name="to"))
+        wallet_id = uuid.UUID(from_account.wallet_id)
+        await crud.replenish(
+            ReplenishWalletInfo(wallet_id=wallet_id, currency=Currency.USD, amount=100)
+        )
+        for amount in (1, 2, 3):
+            await crud.transfer(
+                TransferMoneyIn(
+                    from_wallet_id=wallet_id,
+                    from_currency=Currency.USD,
+                    to_wallet_id=to_account.wallet_id,
+                    to_currency=Currency.USD,
+                    amount=amount,
+                )
+            )
+
+        page = await crud.get_postings(wallet_id, limit=2)
+        assert [p.amount for p in page.postings] == [-3, -2]
+        assert page.postings[0].type == TransactionType.transfer
+        assert page.postings[0].transaction_id > page.postings[1].transaction_id
+        page = await crud.get_postings(wallet_id, limit=2, cursor=page.next_cursor)
+        assert [p.amount for p in page.postings] == [-1, 100]
+        assert page.next_cursor is None
+
+        page = await crud.get_postings(
+            wallet_id, limit=10, transaction_type=TransactionType.replenish
+        )
+        assert [p.amount for p in page.postings] == [100]
+        created_at = page.postings[0].created_at
+        page = await crud.get_postings(
+            wallet_id, limit=10, since=created_at + datetime.timedelta(days=1)
+        )
+        assert page.postings == []
+        page = await crud.get_postings(wallet_id, limit=10, until=created_at)
+        assert page.postings == []
+
+        with pytest.raises(crud.NotFound):
+            await crud.get_postings(uuid.uuid4(), limit=10)
+        with pytest.raises(crud.CRUDException):
+            await crud.get_postings(wallet_id, limit=10, cursor="not a cursor")
+    finally:
+        await db.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_ledger_ids():
+    await db.connect()
+    try:
+        account = await crud.create_account_with_wallet(AccountCreateIn(name="ids"))
+        wallet_id = uuid.UUID(account.wallet_id)
+        before = await db.fetch_val("SELECT ledger_id_floor(clock_timestamp());")
+        for amount in (1, 2):
+            await crud.replenish(
+                ReplenishWalletInfo(
+                    wallet_id=wallet_id, currency=Currency.USD, amount=amount
+                )
+            )
+        after = await db.fetch_val("SELECT ledger_id_floor(clock_timestamp());")
+
+        rows = await db.fetch_all(
+            "SELECT transaction_id, id FROM posting WHERE wallet_id = :wallet_id "
+            "ORDER BY created_at;",
+            {"wallet_id": wallet_id},
+        )
+        ids = [(row["transaction_id"], row["id"]) for row in rows]
+        assert len(ids) == 2
+        for transaction_id, posting_id in ids:
+            assert 2 ** 31 < before <= transaction_id < posting_id < after + 4096
+            # exact as JSON numbers
+            assert posting_id < 2 ** 53
+        assert ids == sorted(ids)
+    finally:
+        await db.disconnect()
+
+
+async def _shard_amounts(wallet_id):
+    select_shards = (
+        "SELECT amount FROM wallet_shard WHERE wallet_id = :wallet_id ORDER BY shard;"
+    )
+    rows = await db.fetch_all(select_shards, {"wallet_id": wallet_id})
+    return [row["amount"] for row in rows]
+
+
+@pytest.mark.asyncio
+async def test_sharded_wallet(monkeypatch):
+    await db.connect()
+    try:
+        # every shard row of 4 holds 25 at most
+        monkeypatch.setattr(settings, "max_amount", decimal.Decimal(100))
+        customer = await _add_wallet(decimal.Decimal(60))
+        merchant = await _add_wallet(decimal.Decimal("10.01"))
+        assert await crud.shard_wallet(merchant, 4) == decimal.Decimal("10.01")
+        assert await _wallet_amount(merchant) == 0
+        assert await _shard_amounts(merchant) == [
+            decimal.Decimal("2.51"),
+            decimal.Decimal("2.50"),
+            decimal.Decimal("2.50"),
+            decimal.Decimal("2.50"),
+        ]
+
+        for _ in range(5):
+            result = await crud.transfer(_transfer_in(customer, merchant, 10))
+        assert result.from_amount == 10
+        assert result.to_amount == decimal.Decimal("60.01")
+        # no shard row can take 30 more
+        with pytest.raises(crud.CRUDException) as error_info:
+            await crud.replenish(
+                ReplenishWalletInfo(wallet_id=merchant, amount=30, currency=Currency.USD)
+            )
+        assert error_info.value.message.endswith("current amount = 60.01")
+        replenished = await crud.replenish(
+            ReplenishWalletInfo(wallet_id=merchant, amount=5, currency=Currency.USD)
+        )
+        assert replenished.amount == decimal.Decimal("65.01")
+        account_id = await db.fetch_val(
+            "SELECT account_id FROM wallet WHERE id = :wallet_id;",
+            {"wallet_id": merchant},
+        )
+        account = await crud.get_account_with_wallet(account_id)
+        assert account.amount == decimal.Decimal("65.01")
+
+        with pytest.raises(crud.CRUDException):
+            await crud.transfer(_transfer_in(merchant, customer, 70))
+        result = await crud.transfer(_transfer_in(merchant, customer, "65.01"))
+        assert result.from_amount == 0
+        assert await _shard_amounts(merchant) == [0] * 4
+
+        results = await crud.replenish_batch(
+            [
+                ReplenishWalletInfo(wallet_id=merchant, amount=99, currency=Currency.USD),
+                ReplenishWalletInfo(wallet_id=merchant, amount=2, currency=Currency.USD),
+            ],
+            BatchMode.independent,
+        )
+        assert results[0].amount == 99
+        assert isinstance(results[1], crud.CRUDException)
+        assert await _shard_amounts(merchant) == [decimal.Decimal("24.75")] * 4
+
+        assert await crud.shard_wallet(merchant, 0) == 99
+        assert await _wallet_amount(merchant) == 99
+        assert await _shard_amounts(merchant) == []
+
+        full = await _add_wallet(decimal.Decimal(100))
+        # 3 shard rows hold 33.33 each
+        with pytest.raises(crud.CRUDException):
+            await crud.shard_wallet(full, 3)
+        with pytest.raises(crud.NotFound):
+            await crud.shard_wallet(uuid.uuid4(), 3)
+    finally:
+        await db.disconnect()
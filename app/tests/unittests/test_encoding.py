@@ -0,0 +1,75 @@
+import datetime
+import decimal
+import uuid
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+
+from app.encoding import ModelResponse, encode
+from app.schemas import (BatchItemStatus, Currency, ExtendedAccountOut,
+                         TransferBatchItemOut, TransferBatchOut,
+                         TransferMoneyOut)
+
+
+def fastapi_body(model):
+    """Response body FastAPI makes for response_model"""
+    return JSONResponse(jsonable_encoder(model)).body
+
+
+@pytest.mark.parametrize(
+    "amount",
+    [
+        "0.00",
+        "0.01",
+        "100.00",
+        "9999999.12",
+        # floats from 1e16 are written in exponent form
+        "10000000000000000.00",
+        "99999999999999999.99",
+    ],
+)
+def test_encode_same_as_fastapi(amount):
+    amount = decimal.Decimal(amount)
+    transfer = TransferMoneyOut.construct(
+        from_wallet_id=uuid.uuid4(),
+        from_currency=Currency.USD,
+        from_amount=amount,
+        to_wallet_id=uuid.uuid4(),
+        to_currency=Currency.USD,
+        to_amount=amount,
+    )
+    account = ExtendedAccountOut.construct(
+        account_id=uuid.uuid4(),
+        name='имя "name"\n',
+        wallet_id=uuid.uuid4(),
+        currency=Currency.USD,
+        amount=amount,
+        created_at=datetime.datetime.now(tz=datetime.timezone.utc),
+    )
+    batch = TransferBatchOut.construct(
+        results=[
+            TransferBatchItemOut.construct(status=BatchItemStatus.ok, result=transfer),
+            TransferBatchItemOut.construct(status=BatchItemStatus.failed, error="x"),
+        ]
+    )
+
+    for model in (transfer, account, batch):
+        assert encode(model) == fastapi_body(model)
+
+
+def test_model_response():
+    transfer = TransferMoneyOut.construct(
+        from_wallet_id=uuid.uuid4(),
+        from_currency=Currency.USD,
+        from_amount=decimal.Decimal("1.50"),
+        to_wallet_id=uuid.uuid4(),
+        to_currency=Currency.USD,
+        to_amount=decimal.Decimal("2.50"),
+    )
+
+    response = ModelResponse(transfer, status_code=201)
+
+    assert response.status_code == 201
+    assert response.headers["content-type"] == "application/json"
+    assert response.body == fastapi_body(transfer)
@@ -0,0 +1,251 @@
+import asyncio
+import contextvars
+import datetime
+import decimal
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from app import api, crud, dal, ledger_stats, partitions, replicas
+from app.config import settings
+from app.database import db
+from app.pool import Database
+from app.schemas import (AccountCreateIn, Currency, ReplenishWalletInfo,
+                         TransferMoneyIn)
+
+# totals of the ledger, counted the same as the trigger counts them
+LEDGER_TOTALS = (
+    "SELECT posting.currency, "
+    "count(DISTINCT posting.transaction_id) "
+    "FILTER (WHERE transaction.type = 'TRANSFER') AS transfers, "
+    "coalesce(sum(posting.amount) "
+    "FILTER (WHERE transaction.type = 'TRANSFER' AND posting.amount > 0), 0) "
+    "AS transfer_volume, "
+    "count(*) FILTER (WHERE transaction.type = 'REPLENISH') AS replenishments, "
+    "coalesce(sum(posting.amount) FILTER (WHERE transaction.type = 'REPLENISH'), 0) "
+    "AS replenished "
+    "FROM posting JOIN transaction ON transaction.id = posting.transaction_id "
+    "AND transaction.created_at = posting.created_at "
+    "GROUP BY posting.currency ORDER BY posting.currency;"
+)
+DELETE_LEDGER = (
+    "WITH posting AS ("
+    "DELETE FROM posting WHERE wallet_id = ANY(:wallet_ids) "
+    "RETURNING transaction_id, created_at"
+    "), transaction AS ("
+    "DELETE FROM transaction USING posting "
+    "WHERE transaction.id = posting.transaction_id "
+    "AND transaction.created_at = posting.created_at"
+    ") "
+    "DELETE FROM outbox WHERE (payload->>'wallet_id')::uuid = ANY(:wallet_ids) "
+    "OR EXISTS (SELECT 1 FROM jsonb_array_elements(payload->'postings') AS p "
+    "WHERE (p->>'wallet_id')::uuid = ANY(:wallet_ids));"
+)
+DELETE_ACCOUNTS = (
+    "WITH wallet AS ("
+    "DELETE FROM wallet WHERE id = ANY(:wallet_ids) RETURNING account_id"
+    ") "
+    "DELETE FROM account USING wallet WHERE account.id = wallet.account_id;"
+)
+
+
+def _today(stats):
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    return next(
+        (
+            day
+            for day in stats.days
+            if day.day == today and day.currency is Currency.USD
+        ),
+        None,
+    )
+
+
+async def _create_wallets(names):
+    wallet_ids = []
+    for name in names:
+        account = await crud.create_account_with_wallet(AccountCreateIn(name=name))
+        wallet_ids.append(account.wallet_id)
+        await crud.replenish(
+            ReplenishWalletInfo(
+                wallet_id=account.wallet_id, currency=Currency.USD, amount=100
+            )
+        )
+    return wallet_ids
+
+
+def _transfer(from_wallet_id, to_wallet_id, amount):
+    return crud.transfer(
+        TransferMoneyIn(
+            from_wallet_id=from_wallet_id,
+            from_currency=Currency.USD,
+            to_wallet_id=to_wallet_id,
+            to_currency=Currency.USD,
+            amount=amount,
+        )
+    )
+
+
+@pytest.mark.asyncio
+async def test_ledger_stats():
+    await db.connect()
+    try:
+        # counters of today may be left from other tests
+        before = _today(await ledger_stats.get_stats(1))
+        wallet_ids = await _create_wallets(("from", "to"))
+        await _transfer(wallet_ids[0], wallet_ids[1], 30)
+
+        stats = await ledger_stats.get_stats(2)
+        after = _today(stats)
+        assert after.transfers == (before.transfers if before else 0) + 1
+        assert after.transfer_volume == (
+            before.transfer_volume if before else 0
+        ) + decimal.Decimal(30)
+        assert after.replenishments == (before.replenishments if before else 0) + 2
+        assert after.replenished == (
+            before.replenished if before else 0
+        ) + decimal.Decimal(200)
+        assert len(stats.days) <= 2
+        (total,) = [t for t in stats.totals if t.currency is Currency.USD]
+        assert total.in_circulation == total.replenished >= after.replenished
+        assert await ledger_stats.verify() == []
+    finally:
+        await db.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_verify_fixes_mismatches():
+    await db.connect()
+    try:
+        await _create_wallets(("replenished",))
+        after = _today(await ledger_stats.get_stats(1))
+        # counters out of sync are found and fixed
+        await db.execute(
+            "UPDATE ledger_stats SET transfers = transfers + 2, "
+            "replenished = replenished - 1 "
+            "WHERE day = :day AND currency = 'USD' AND shard = "
+            "(SELECT min(shard) FROM ledger_stats WHERE day = :day);",
+            {"day": after.day},
+        )
+        mismatches = await ledger_stats.verify(fix=True)
+        assert mismatches == [
+            ledger_stats.Mismatch(
+                after.day, "USD", -2, decimal.Decimal(0), 0, decimal.Decimal(1)
+            )
+        ]
+        assert await ledger_stats.verify() == []
+        assert _today(await ledger_stats.get_stats(1)) == after
+    finally:
+        await db.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_archived_postings_counted():
+    month = datetime.datetime(2100, 3, 1, tzinfo=datetime.timezone.utc)
+    await db.connect()
+    try:
+        await partitions.create_partitions(months_ahead=0, now=month)
+        (wallet_id,) = await _create_wallets(("archived",))
+        await db.execute(
+            "WITH new_transaction AS ("
+            "INSERT INTO transaction(type, created_at) "
+            "VALUES ('REPLENISH', '2100-03-10') RETURNING id, created_at"
+            ") "
+            "INSERT INTO posting(transaction_id, wallet_id, amount, currency, created_at) "
+            "SELECT id, :wallet_id, 5, 'USD', created_at FROM new_transaction;",
+            {"wallet_id": wallet_id},
+        )
+        archived = await partitions.archive_partitions(
+            keep_months=0, now=partitions.add_months(month, 1)
+        )
+        assert "posting_y2100m03" in archived
+        # the archived ledger still matches its counters
+        assert await ledger_stats.verify() == []
+
+        day = datetime.date(2100, 3, 10)
+        await db.execute("DELETE FROM ledger_stats WHERE day = :day;", {"day": day})
+        assert await ledger_stats.verify(fix=True) == [
+            ledger_stats.Mismatch(
+                day, "USD", 0, decimal.Decimal(0), 1, decimal.Decimal(5)
+            )
+        ]
+        assert await ledger_stats.verify() == []
+    finally:
+        await db.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_counters_of_concurrent_transfers(monkeypatch):
+    # all queries of tests are in one transaction, which takes one shard;
+    # transfers committed by connections of their own spread over shards
+    database = Database(settings.db_url, min_size=1, max_size=8)
+    for module in (crud, dal, ledger_stats, replicas):
+        monkeypatch.setattr(module, "db", database)
+    app = FastAPI()
+    app.include_router(api.router)
+    client = httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://test"
+    )
+    shards = (
+        "SELECT shard, transfers FROM ledger_stats "
+        "WHERE day = (now() AT TIME ZONE 'UTC')::date AND currency = 'USD';"
+    )
+    await database.connect()
+    wallet_ids = []
+    try:
+        before = {
+            row["shard"]: row["transfers"] for row in await database.fetch_all(shards)
+        }
+        stats_before = _today(await ledger_stats.get_stats(1))
+        wallet_ids = await _create_wallets(f"concurrent {i}" for i in range(8))
+
+        async def transfer_around(i):
+            for _ in range(5):
+                await _transfer(wallet_ids[i], wallet_ids[(i + 1) % 8], 1)
+
+        # databases keeps connection in context variable, transfers are run
+        # from empty contexts to get connections of their own
+        await asyncio.gather(
+            *(
+                contextvars.Context().run(asyncio.ensure_future, transfer_around(i))
+                for i in range(8)
+            )
+        )
+
+        after = {
+            row["shard"]: row["transfers"] for row in await database.fetch_all(shards)
+        }
+        added = {shard: after[shard] - before.get(shard, 0) for shard in after}
+        assert sum(added.values()) == 40
+        assert len([shard for shard in added if added[shard]]) > 1
+        stats = _today(await ledger_stats.get_stats(1))
+        assert stats.transfers - (stats_before.transfers if stats_before else 0) == 40
+        assert (
+            stats.transfer_volume
+            - (stats_before.transfer_volume if stats_before else 0)
+            == 40
+        )
+
+        response = await client.get("/stats", params={"days": 1})
+        assert response.status_code == 200
+        totals = {
+            total["currency"]: total
+            for total in response.json(parse_float=decimal.Decimal)["totals"]
+        }
+        for row in await database.fetch_all(LEDGER_TOTALS):
+            total = totals[row["currency"]]
+            assert total["transfers"] == row["transfers"]
+            assert total["transfer_volume"] == row["transfer_volume"]
+            assert total["replenishments"] == row["replenishments"]
+            assert total["replenished"] == row["replenished"]
+            assert total["in_circulation"] == row["replenished"]
+        assert await ledger_stats.verify() == []
+    finally:
+        # the ledger of the test is deleted, its counters are taken back
+        if wallet_ids:
+            await database.execute(DELETE_LEDGER, {"wallet_ids": wallet_ids})
+            await ledger_stats.verify(fix=True)
+            await database.execute(DELETE_ACCOUNTS, {"wallet_ids": wallet_ids})
+        await client.aclose()
+        await database.disconnect()
@@ -0,0 +1,237 @@
+import asyncio
+import contextvars
+import json
+
+import pytest
+
+from app import crud, horizon, outbox
+from app.config import settings
+from app.database import db
+from app.pool import Database
+from app.schemas import (AccountCreateIn, Currency, ReplenishWalletInfo,
+                         TransferMoneyIn)
+
+INSERT_EVENT = (
+    "INSERT INTO outbox(type, payload) VALUES ('TEST', CAST(:payload AS jsonb)) "
+    "RETURNING id;"
+)
+
+
+class ListSink(outbox.Sink):
+    def __init__(self):
+        self.events = []
+        self.batches = []
+
+    async def write(self, events):
+        self.events.extend(events)
+        self.batches.append([event.offset for event in events])
+
+
+class FailingSink(ListSink):
+    """Fails to write the first batches"""
+
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    async def write(self, events):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("sink is down")
+        await super().write(events)
+
+
+class BlockingSink(ListSink):
+    """Writes batches when released"""
+
+    def __init__(self):
+        super().__init__()
+        self.writing = asyncio.Event()
+        self.released = asyncio.Event()
+
+    async def write(self, events):
+        self.writing.set()
+        await self.released.wait()
+        await super().write(events)
+
+
+async def _horizon(database=db) -> int:
+    # events made in the millisecond of the horizon are left to the next
+    # batch
+    await asyncio.sleep(0.002)
+    async with database.connection() as connection:
+        return await horizon.wait_for_horizon(connection.raw_connection, 1)
+
+
+async def _relay_all(name, sink) -> int:
+    horizon_id = await _horizon()
+    relayed = 0
+    while True:
+        events = await outbox.relay_batch(name, sink, horizon_id)
+        if not events:
+            return relayed
+        relayed += len(events)
+
+
+@pytest.mark.asyncio
+async def test_relay(monkeypatch, tmp_path):
+    monkeypatch.setattr(outbox.settings, "outbox_batch_size", 2)
+    await db.connect()
+    try:
+        # relays start from the oldest event
+        await db.execute("DELETE FROM outbox;")
+        await db.execute("DELETE FROM outbox_relay;")
+        wallet_ids = []
+        for name in ("from", "to"):
+            account = await crud.create_account_with_wallet(AccountCreateIn(name=name))
+            wallet_ids.append(account.wallet_id)
+        await crud.replenish(
+            ReplenishWalletInfo(
+                wallet_id=wallet_ids[0], currency=Currency.USD, amount=100
+            )
+        )
+        await crud.transfer(
+            TransferMoneyIn(
+                from_wallet_id=wallet_ids[0],
+                from_currency=Currency.USD,
+                to_wallet_id=wallet_ids[1],
+                to_currency=Currency.USD,
+                amount=30,
+            )
+        )
+        sink = ListSink()
+        await outbox.register("test")
+        assert await _relay_all("test", sink) == len(sink.events)
+        offsets = [event.offset for event in sink.events]
+        assert offsets == sorted(set(offsets))
+        assert await _relay_all("test", sink) == 0
+
+        events = [
+            event
+            for event in sink.events
+            if event.payload.get("wallet_id") in wallet_ids
+            or any(
+                posting["wallet_id"] in wallet_ids
+                for posting in event.payload.get("postings", ())
+            )
+        ]
+        assert [event.type for event in events] == [
+            "ACCOUNT_CREATED",
+            "ACCOUNT_CREATED",
+            "REPLENISH",
+            "TRANSFER",
+        ]
+        assert events[0].payload["name"] == "from"
+        assert events[2].payload["postings"] == [
+            {"wallet_id": wallet_ids[0], "amount": "100.00", "currency": "USD"}
+        ]
+        assert [p["amount"] for p in events[3].payload["postings"]] == [
+            "-30.00",
+            "30.00",
+        ]
+
+        # a new sink gets the events again, as NDJSON lines
+        path = tmp_path / "events.ndjson"
+        file_sink = outbox.FileSink(str(path))
+        try:
+            await outbox.register("file")
+            await _relay_all("file", file_sink)
+        finally:
+            file_sink.close()
+        lines = [json.loads(line) for line in path.read_text().splitlines()]
+        assert [line["offset"] for line in lines] == offsets
+        assert lines[-1]["type"] == "TRANSFER"
+
+        # events delivered to all sinks are deleted
+        assert await outbox.purge_delivered() >= len(events)
+        assert not await db.fetch_val(
+            "SELECT count(*) FROM outbox WHERE id <= :offset;", {"offset": offsets[-1]}
+        )
+    finally:
+        await db.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_delivered_again(monkeypatch):
+    monkeypatch.setattr(outbox.settings, "outbox_batch_size", 2)
+    await db.connect()
+    try:
+        await db.execute("DELETE FROM outbox;")
+        await db.execute("DELETE FROM outbox_relay;")
+        offsets = [
+            await db.fetch_val(INSERT_EVENT, {"payload": json.dumps({"n": n})})
+            for n in range(3)
+        ]
+        horizon_id = await _horizon()
+        await outbox.register("test")
+
+        sink = FailingSink(failures=1)
+        with pytest.raises(ConnectionError):
+            await outbox.relay_batch("test", sink, horizon_id)
+        # the failed batch is not acknowledged
+        query = "SELECT delivered_id FROM outbox_relay WHERE name = 'test';"
+        assert await db.fetch_val(query) == 0
+
+        while await outbox.relay_batch("test", sink, horizon_id):
+            pass
+        assert sink.batches == [offsets[:2], offsets[2:]]
+        assert [event.payload for event in sink.events] == [
+            {"n": 0},
+            {"n": 1},
+            {"n": 2},
+        ]
+        assert await db.fetch_val(query) == offsets[-1]
+    finally:
+        await db.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_relays_of_sink_skip_batch_being_delivered(monkeypatch):
+    # the row of the sink is locked by the transaction of the delivering
+    # relay, relays with connections of their own commit like in production
+    database = Database(settings.db_url, min_size=1, max_size=2)
+    monkeypatch.setattr(outbox, "db", database)
+    name = "skip-locked-test"
+    blocking_sink, other_sink = BlockingSink(), ListSink()
+    await database.connect()
+    offsets = []
+    try:
+        await outbox.register(name)
+        # the sink starts after events which are there
+        await database.execute(
+            "UPDATE outbox_relay SET delivered_id = "
+            "(SELECT coalesce(max(id), 0) FROM outbox) WHERE name = :name;",
+            {"name": name},
+        )
+        for n in range(2):
+            offsets.append(
+                await database.fetch_val(
+                    INSERT_EVENT, {"payload": json.dumps({"n": n})}
+                )
+            )
+        horizon_id = await _horizon(database)
+
+        # databases keeps connection in context variable, relays are run
+        # from empty contexts to get connections of their own
+        def run(sink):
+            return contextvars.Context().run(
+                asyncio.ensure_future, outbox.relay_batch(name, sink, horizon_id)
+            )
+
+        delivering = run(blocking_sink)
+        await asyncio.wait_for(blocking_sink.writing.wait(), 5)
+        assert await asyncio.wait_for(run(other_sink), 5) == []
+        blocking_sink.released.set()
+        assert [event.offset for event in await delivering] == offsets
+        assert await run(other_sink) == []
+        assert other_sink.events == []
+    finally:
+        # the delivering relay ends its transaction, which locks the sink
+        blocking_sink.released.set()
+        await database.execute(
+            "DELETE FROM outbox WHERE id = ANY(:offsets);", {"offsets": offsets}
+        )
+        await database.execute(
+            "DELETE FROM outbox_relay WHERE name = :name;", {"name": name}
+        )
+        await database.disconnect()
@@ -0,0 +1,63 @@
+import datetime
+
+import pytest
+
+from app import partitions
+from app.database import db
+
+FUTURE = datetime.datetime(2100, 1, 15, tzinfo=datetime.timezone.utc)
+
+
+def test_months():
+    start = partitions.month_start(
+        datetime.datetime(2026, 12, 31, 23, 30, tzinfo=datetime.timezone.utc)
+    )
+    assert start == datetime.datetime(2026, 12, 1, tzinfo=datetime.timezone.utc)
+    assert partitions.add_months(start, 1).date() == datetime.date(2027, 1, 1)
+    assert partitions.add_months(start, -12).date() == datetime.date(2025, 12, 1)
+    assert partitions.partition_name("posting", start) == "posting_y2026m12"
+
+
+@pytest.mark.asyncio
+async def test_create_partitions():
+    await db.connect()
+    try:
+        created = await partitions.create_partitions(months_ahead=1, now=FUTURE)
+        assert created == [
+            "transaction_y2100m01",
+            "transaction_y2100m02",
+            "posting_y2100m01",
+            "posting_y2100m02",
+        ]
+        assert await partitions.create_partitions(months_ahead=1, now=FUTURE) == []
+
+        posting = await partitions.list_partitions("posting")
+        assert posting[-1] == (
+            "posting_y2100m02",
+            datetime.datetime(2100, 2, 1, tzinfo=datetime.timezone.utc),
+            datetime.datetime(2100, 3, 1, tzinfo=datetime.timezone.utc),
+        )
+    finally:
+        await db.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_archive_partitions():
+    await db.connect()
+    try:
+        await partitions.create_partitions(months_ahead=0, now=FUTURE)
+        await db.execute(
+            "INSERT INTO transaction(type, created_at) "
+            "VALUES ('replenish', '2100-01-20');"
+        )
+
+        archived = await partitions.archive_partitions(
+            keep_months=0, now=datetime.datetime(2100, 2, 1, tzinfo=FUTURE.tzinfo)
+        )
+        assert "transaction_y2100m01" in archived
+        assert "posting_y2100m01" in archived
+        assert await partitions.list_partitions("transaction") == []
+        query = "SELECT count(*) FROM archive.transaction_y2100m01;"
+        assert await db.fetch_val(query) == 1
+    finally:
+        await db.disconnect()
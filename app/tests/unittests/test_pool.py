@@ -0,0 +1,56 @@
+import asyncio
+import contextvars
+
+import pytest
+
+from app.config import settings
+from app.pool import Database, Histogram
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram([0.1, 1])
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(value)
+
+    stats = histogram.stats()
+
+    assert stats["buckets"] == {"0.1": 2, "1": 3, "+Inf": 4}
+    assert stats["count"] == 4
+    assert stats["sum"] == pytest.approx(2.65)
+
+
+@pytest.mark.asyncio
+async def test_pool_stats_and_acquire_timeout():
+    db = Database(settings.db_url, min_size=1, max_size=1, acquire_timeout=0.05)
+    await db.connect()
+    try:
+        async with db.connection():
+            # databases keeps connection in context variable, so the second
+            # connection is requested from empty context
+            query = db.fetch_val("SELECT 1;")
+            with pytest.raises(asyncio.TimeoutError):
+                await contextvars.Context().run(asyncio.ensure_future, query)
+            stats = db.pool_stats()
+            assert (stats["in_use"], stats["idle"], stats["timeouts"]) == (1, 0, 1)
+
+        stats = db.pool_stats()
+        assert (stats["in_use"], stats["idle"], stats["acquired"]) == (0, 1, 1)
+        assert stats["acquire_time"]["count"] == 1
+        assert db.take_min_acquire_time() < 0.05
+        assert db.take_min_acquire_time() is None
+    finally:
+        await db.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_pool_closes_expired_connections():
+    db = Database(settings.db_url, min_size=1, max_size=1, max_lifetime=0)
+    await db.connect()
+    try:
+        first_pid = await db.fetch_val("SELECT pg_backend_pid();")
+        second_pid = await db.fetch_val("SELECT pg_backend_pid();")
+
+        assert first_pid != second_pid
+        assert db.pool_stats()["expired"] == 2
+    finally:
+        await db.disconnect()
@@ -0,0 +1,94 @@
+import multiprocessing
+import uuid
+
+import pytest
+from fastapi import FastAPI
+from starlette.testclient import TestClient
+
+from app import api, ratelimit
+from app.api import crud
+from app.schemas import AccountCreateOut
+
+
+@pytest.mark.parametrize("locking", [True, False])
+def test_rate_limiter(tmp_path, monkeypatch, locking):
+    now = 1000 * 10 ** 9
+    monkeypatch.setattr(ratelimit.time, "monotonic_ns", lambda: now)
+    path = str(tmp_path / "buckets")
+    limit = ratelimit.Limit.from_rate(10, 3)
+    # two workers share the buckets
+    workers = [ratelimit.RateLimiter(path, 16, locking) for _ in range(2)]
+
+    assert [workers[i % 2].acquire(b"client", limit) for i in range(3)] == [0, 0, 0]
+    assert workers[1].acquire(b"client", limit) == 0.1
+    assert workers[0].acquire(b"other", limit) == 0
+
+    now += 10 ** 8
+    assert workers[0].acquire(b"client", limit) == 0
+    assert workers[1].acquire(b"client", limit) > 0
+
+    # keys which don't fit into their slots wait for one, buckets of other
+    # keys are not taken over
+    limiter = ratelimit.RateLimiter(str(tmp_path / "few"), 4, locking)
+    limit = ratelimit.Limit.from_rate(10, 1)
+    keys = [str(i).encode() for i in range(32)]
+    waits = [limiter.acquire(key, limit) for key in keys]
+    taken = [key for key, wait in zip(keys, waits) if wait == 0]
+    assert 0 < len(taken) <= 4 + ratelimit.PROBES - 1
+    assert all(0 < wait <= 0.1 for wait in waits if wait)
+    assert all(limiter.acquire(key, limit) == 0.1 for key in taken)
+
+    now += 10 ** 8
+    # buckets which are full again free their slots
+    assert limiter.acquire(keys[-1], limit) == 0
+
+
+def _acquire_many(path):
+    limiter = ratelimit.RateLimiter(path, 16)
+    limit = ratelimit.Limit.from_rate(0.001, 1000)
+    return sum(limiter.acquire(b"client", limit) == 0 for _ in range(1000))
+
+
+def test_rate_limiter_exact_across_workers(tmp_path):
+    path = str(tmp_path / "buckets")
+    # workers race for one bucket, none of them takes a request twice
+    with multiprocessing.get_context("fork").Pool(4) as pool:
+        assert sum(pool.map(_acquire_many, [path] * 4)) == 1000
+
+
+def test_rate_limit_middleware(tmp_path, monkeypatch):
+    async def mock_create_account_with_wallet(payload):
+        return AccountCreateOut(
+            account_id=str(uuid.uuid4()), wallet_id=str(uuid.uuid4())
+        )
+
+    monkeypatch.setattr(
+        crud, "create_account_with_wallet", mock_create_account_with_wallet
+    )
+    app = FastAPI()
+    app.include_router(api.router)
+    app.add_middleware(
+        ratelimit.RateLimitMiddleware,
+        limits={"POST /accounts": (1, 2), "*": (1, 1)},
+        client_limits={"vip": {"POST /accounts": (1, 3)}},
+        client_header="X-Client-Id",
+        limiter=ratelimit.RateLimiter(str(tmp_path / "buckets"), 64),
+    )
+    client = TestClient(app)
+
+    def create(client_id):
+        return client.post(
+            "/accounts", json={"name": "name"}, headers={"X-Client-Id": client_id}
+        ).status_code
+
+    assert [create("a") for _ in range(3)] == [201, 201, 429]
+    response = client.post(
+        "/accounts", json={"name": "name"}, headers={"X-Client-Id": "a"}
+    )
+    assert response.headers["Retry-After"] == "1"
+    assert [create("b") for _ in range(2)] == [201, 201]
+    assert [create("vip") for _ in range(4)] == [201, 201, 201, 429]
+
+    # other routes share the "*" bucket of the client
+    assert client.get("/cache/stats", headers={"X-Client-Id": "a"}).status_code == 200
+    assert client.get("/pool/stats", headers={"X-Client-Id": "a"}).status_code == 429
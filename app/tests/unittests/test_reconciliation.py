@@ -0,0 +1,74 @@
+import asyncio
+import uuid
+
+import pytest
+
+from app import crud, reconciliation
+from app.database import db
+from app.schemas import (AccountCreateIn, Currency, ReplenishWalletInfo,
+                         TransferMoneyIn)
+
+
+def test_shard_range():
+    ranges = [reconciliation.shard_range(3, shard) for shard in range(3)]
+    assert ranges[0][0] == uuid.UUID(int=0)
+    assert ranges[-1][1] == uuid.UUID(int=2 ** 128 - 1)
+    for (_, last), (first, _) in zip(ranges, ranges[1:]):
+        assert first.int == last.int + 1
+    with pytest.raises(ValueError):
+        reconciliation.shard_range(3, 3)
+
+
+async def _transfer(from_wallet_id, to_wallet_id, amount):
+    await crud.transfer(
+        TransferMoneyIn(
+            from_wallet_id=from_wallet_id,
+            from_currency=Currency.USD,
+            to_wallet_id=to_wallet_id,
+            to_currency=Currency.USD,
+            amount=amount,
+        )
+    )
+
+
+@pytest.mark.asyncio
+async def test_reconcile():
+    await db.connect()
+    try:
+        wallet_ids = []
+        for name in ("from", "to"):
+            account = await crud.create_account_with_wallet(AccountCreateIn(name=name))
+            wallet_ids.append(uuid.UUID(account.wallet_id))
+        from_wallet_id, to_wallet_id = wallet_ids
+        await crud.replenish(
+            ReplenishWalletInfo(
+                wallet_id=from_wallet_id, currency=Currency.USD, amount=100
+            )
+        )
+        await _transfer(from_wallet_id, to_wallet_id, 30)
+        # postings made in the millisecond of the horizon are left to the
+        # next run
+        await asyncio.sleep(0.002)
+
+        mismatches = []
+        summary = await reconciliation.reconcile(report=mismatches.append)
+        assert summary.from_posting_id == 0
+        assert summary.postings >= 3
+        assert not [m for m in mismatches if m.wallet_id in wallet_ids]
+
+        await _transfer(from_wallet_id, to_wallet_id, 20)
+        await db.execute(
+            "UPDATE wallet SET amount = amount + 1 WHERE id = :wallet_id;",
+            {"wallet_id": to_wallet_id},
+        )
+        mismatches = []
+        incremental = await reconciliation.reconcile(
+            incremental=True, report=mismatches.append
+        )
+        assert incremental.from_posting_id == summary.checkpoint
+        assert incremental.postings == 2
+        assert [m for m in mismatches if m.wallet_id in wallet_ids] == [
+            reconciliation.Mismatch(to_wallet_id, 51, 50)
+        ]
+    finally:
+        await db.disconnect()
@@ -0,0 +1,121 @@
+import asyncio
+import time
+import uuid
+
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from starlette.testclient import TestClient
+
+from app import api, replicas
+from app.api import crud
+from app.config import settings
+from app.database import db
+from app.schemas import AccountCreateOut
+
+
+def test_lsn_tokens():
+    assert replicas.format_lsn(0x16B374D848) == "16/B374D848"
+    assert replicas.parse_lsn("16/B374D848") == 0x16B374D848
+    with pytest.raises(ValueError):
+        replicas.parse_lsn("16")
+
+
+@pytest.mark.asyncio
+async def test_replica_positions():
+    await db.connect()
+    # the primary listed as replica is never behind, the other one is down
+    replica_set = replicas.ReplicaSet(
+        [settings.db_url, "postgresql://nobody@127.0.0.1:1/none"], db
+    )
+    up, down = replica_set.replicas
+    try:
+        await replica_set.check()
+        assert up.available and not down.available
+        assert replica_set.choose() is up.db
+        assert replica_set.choose(up.replay_lsn) is up.db
+
+        # callers at once share one query
+        lsns = await asyncio.gather(*(replica_set.commit_lsn() for _ in range(3)))
+        assert len(set(lsns)) == 1 and lsns[0] >= up.replay_lsn
+        # tokens the replica hasn't replayed yet are read from the primary
+        assert replica_set.choose(up.replay_lsn + 1) is db
+
+        up.caught_up_at = time.monotonic() - settings.db_replica_max_lag - 1
+        assert replica_set.choose() is db
+        await replica_set.check()
+        assert replica_set.choose() is up.db
+        stats = replica_set.stats()
+        assert stats["primary_reads"] == 2
+        assert [replica["available"] for replica in stats["replicas"]] == [True, False]
+        assert stats["replicas"][1]["name"] == "127.0.0.1:1/none"
+    finally:
+        await replica_set.disconnect()
+        await db.disconnect()
+
+
+def test_replica_middleware(monkeypatch):
+    databases = []
+
+    async def mock_create_account_with_wallet(payload):
+        return AccountCreateOut(
+            account_id=str(uuid.uuid4()), wallet_id=str(uuid.uuid4())
+        )
+
+    async def mock_get_account_with_wallet(account_id):
+        databases.append(replicas.database())
+        raise crud.NotFound("account", {"account_id": account_id})
+
+    monkeypatch.setattr(
+        crud, "create_account_with_wallet", mock_create_account_with_wallet
+    )
+    monkeypatch.setattr(crud, "get_account_with_wallet", mock_get_account_with_wallet)
+    replica_set = replicas.ReplicaSet([settings.db_url], db)
+    (replica,) = replica_set.replicas
+    replica.available = True
+    replica.caught_up_at = time.monotonic() + 60
+    replica.replay_lsn = 100
+    replayed = [150]
+
+    async def commit_lsn():
+        return 200
+
+    async def replay_lsn():
+        return replayed[0]
+
+    monkeypatch.setattr(replica_set, "commit_lsn", commit_lsn)
+    monkeypatch.setattr(replica._replay_lsn, "fetch", replay_lsn)
+    app = FastAPI()
+    app.include_router(api.router)
+
+    @app.post("/stream")
+    async def stream():
+        async def lines():
+            yield b"committed while sent\n"
+
+        return StreamingResponse(lines())
+
+    app.add_middleware(replicas.ReplicaMiddleware, replicas=replica_set)
+    client = TestClient(app)
+
+    response = client.post("/accounts", json={"name": "name"})
+    token = response.headers[replicas.SESSION_HEADER]
+    assert token == "0/C8"
+    # the token would be taken before the streamed writes are committed
+    response = client.post("/stream")
+    assert response.text == "committed while sent\n"
+    assert replicas.SESSION_HEADER not in response.headers
+
+    def get(headers=None):
+        client.get(f"/accounts/{uuid.uuid4()}", headers=headers)
+        return databases.pop()
+
+    # the replica hasn't replayed the write of the client
+    assert get({replicas.SESSION_HEADER: token}) is db
+    assert replica.replay_lsn == 150
+    assert get() is replica.db
+    assert get({replicas.SESSION_HEADER: "invalid"}) is db
+    replayed[0] = 200
+    assert get({replicas.SESSION_HEADER: token}) is replica.db
+    # reads of other requests use the primary
+    assert replicas.database() is db
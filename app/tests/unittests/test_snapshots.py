@@ -0,0 +1,94 @@
+import datetime
+import decimal
+import uuid
+
+import pytest
+
+from app import crud, partitions, snapshots
+from app.database import db
+from app.schemas import AccountCreateIn
+
+UTC = datetime.timezone.utc
+
+
+def test_period_start():
+    moment = datetime.datetime(2026, 10, 18, 21, 30, tzinfo=UTC)
+    assert snapshots.period_start(moment) == datetime.datetime(2026, 10, 18, tzinfo=UTC)
+
+
+async def _add_posting(wallet_id, amount, created_at):
+    transaction_id = await db.fetch_val(
+        "INSERT INTO transaction(type, created_at) "
+        "VALUES ('replenish', :created_at) RETURNING id;",
+        {"created_at": created_at},
+    )
+    await db.execute(
+        "INSERT INTO posting(transaction_id, wallet_id, amount, currency, created_at) "
+        "VALUES (:transaction_id, :wallet_id, :amount, 'USD', :created_at);",
+        {
+            "transaction_id": transaction_id,
+            "wallet_id": wallet_id,
+            "amount": amount,
+            "created_at": created_at,
+        },
+    )
+
+
+@pytest.mark.asyncio
+async def test_take_snapshots():
+    await db.connect()
+    try:
+        await partitions.create_partitions(
+            months_ahead=0, now=datetime.datetime(2100, 1, 1, tzinfo=UTC)
+        )
+        await db.execute(
+            "INSERT INTO balance_snapshot_run(taken_at, wallets) "
+            "VALUES ('2099-12-31T00:00:00Z', 0);"
+        )
+        account = await crud.create_account_with_wallet(
+            AccountCreateIn(name="snapshot")
+        )
+        wallet_id = uuid.UUID(account.wallet_id)
+        for day, amount in ((1, 10), (2, 5), (3, -3)):
+            await _add_posting(
+                wallet_id, amount, datetime.datetime(2100, 1, day, 10, tzinfo=UTC)
+            )
+
+        taken = await snapshots.take_snapshots(
+            now=datetime.datetime(2100, 1, 3, 12, tzinfo=UTC)
+        )
+        assert taken == [
+            datetime.datetime(2100, 1, day, tzinfo=UTC) for day in (1, 2, 3)
+        ]
+        rows = await db.fetch_all(
+            "SELECT taken_at, amount FROM balance_snapshot "
+            "WHERE wallet_id = :wallet_id ORDER BY taken_at;",
+            {"wallet_id": wallet_id},
+        )
+        assert [(row["taken_at"].day, row["amount"]) for row in rows] == [
+            (2, 10),
+            (3, 15),
+        ]
+
+        async def balance(day, hour):
+            at = datetime.datetime(2100, 1, day, hour, tzinfo=UTC)
+            return (await crud.get_balance(wallet_id, at)).amount
+
+        assert await balance(1, 9) == 0
+        assert await balance(1, 10) == 10
+        assert await balance(2, 12) == 15
+        assert await balance(3, 12) == 12
+
+        # answered from the snapshot, not from the whole history
+        await db.execute(
+            "UPDATE balance_snapshot SET amount = amount + 100 "
+            "WHERE wallet_id = :wallet_id AND taken_at = '2100-01-03T00:00:00Z';",
+            {"wallet_id": wallet_id},
+        )
+        assert await balance(3, 12) == decimal.Decimal(112)
+        assert await balance(2, 12) == 15
+
+        with pytest.raises(crud.NotFound):
+            await crud.get_balance(uuid.uuid4(), datetime.datetime.now(UTC))
+    finally:
+        await db.disconnect()
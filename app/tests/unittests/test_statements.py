@@ -0,0 +1,78 @@
+import csv
+import datetime
+import json
+import uuid
+
+import pytest
+
+from app import crud, partitions, statements
+from app.config import settings
+from app.database import db
+from app.schemas import AccountCreateIn, StatementFormat
+
+UTC = datetime.timezone.utc
+
+
+async def _add_posting(wallet_id, amount, created_at):
+    transaction_id = await db.fetch_val(
+        "INSERT INTO transaction(type, created_at) "
+        "VALUES ('REPLENISH', :created_at) RETURNING id;",
+        {"created_at": created_at},
+    )
+    await db.execute(
+        "INSERT INTO posting(transaction_id, wallet_id, amount, currency, created_at) "
+        "VALUES (:transaction_id, :wallet_id, :amount, 'USD', :created_at);",
+        {
+            "transaction_id": transaction_id,
+            "wallet_id": wallet_id,
+            "amount": amount,
+            "created_at": created_at,
+        },
+    )
+
+
+async def _read(*args) -> bytes:
+    return b"".join([chunk async for chunk in statements.stream(*args)])
+
+
+@pytest.mark.asyncio
+async def test_stream(monkeypatch):
+    monkeypatch.setattr(settings, "statement_chunk_size", 2)
+    await db.connect()
+    try:
+        await partitions.create_partitions(
+            months_ahead=0, now=datetime.datetime(2100, 1, 1, tzinfo=UTC)
+        )
+        account = await crud.create_account_with_wallet(
+            AccountCreateIn(name="statement")
+        )
+        wallet_id = uuid.UUID(account.wallet_id)
+        for day, amount in ((1, 10), (2, 5), (3, -3), (4, 7)):
+            await _add_posting(
+                wallet_id, amount, datetime.datetime(2100, 1, day, 10, tzinfo=UTC)
+            )
+
+        body = await _read(wallet_id, None, None, StatementFormat.csv)
+        rows = list(csv.DictReader(body.decode().splitlines()))
+        assert [row["amount"] for row in rows] == ["10.00", "5.00", "-3.00", "7.00"]
+        assert [row["balance"] for row in rows] == ["10.00", "15.00", "12.00", "19.00"]
+        assert rows[0]["type"] == "REPLENISH"
+        assert rows[0]["created_at"] == "2100-01-01T10:00:00+00:00"
+
+        # the opening balance of since is of postings before it
+        body = await _read(
+            wallet_id,
+            datetime.datetime(2100, 1, 2, 10, tzinfo=UTC),
+            datetime.datetime(2100, 1, 4, 10, tzinfo=UTC),
+            StatementFormat.ndjson,
+        )
+        lines = [json.loads(line) for line in body.splitlines()]
+        assert [(line["amount"], line["balance"]) for line in lines] == [
+            ("5.00", "15.00"),
+            ("-3.00", "12.00"),
+        ]
+
+        with pytest.raises(crud.NotFound):
+            await _read(uuid.uuid4(), None, None, StatementFormat.csv)
+    finally:
+        await db.disconnect()
@@ -8,6 +8,15 @@ done
 
 echo "PostgreSQL started"
 
+# metrics of previous run
+if [ -n "$PROMETHEUS_MULTIPROC_DIR" ]; then
+    rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+    mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+fi
+
+# rate limit buckets of previous run
+rm -f "${RATE_LIMIT_FILE:-/dev/shm/payment-system-rate-limit}"
+
 # apply migrations
 cd ./app
 alembic upgrade head